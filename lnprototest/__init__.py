@@ -11,80 +11,214 @@ reference material, and the tutorial should get you started.
 
 """
 
-from .errors import EventError, SpecFileError
-
-from .event import (
-    Event,
-    Connect,
-    Disconnect,
-    Msg,
-    RawMsg,
-    ExpectMsg,
-    MustNotMsg,
-    Block,
-    ExpectTx,
-    FundChannel,
-    InitRbf,
-    Invoice,
-    AddHtlc,
-    CheckEq,
-    ExpectError,
-    ResolvableInt,
-    ResolvableStr,
-    Resolvable,
-    ResolvableBool,
-    msat,
-    negotiated,
-    DualFundAccept,
-    Wait,
-    CloseChannel,
-    ExpectDisconnect,
-)
+import importlib
+from typing import Any, Dict, List, TYPE_CHECKING
 
-from .structure import Sequence, OneOf, AnyOrder, TryAll
-
-from .runner import (
-    Runner,
-    Conn,
-    remote_revocation_basepoint,
-    remote_payment_basepoint,
-    remote_delayed_payment_basepoint,
-    remote_htlc_basepoint,
-    remote_per_commitment_point,
-    remote_per_commitment_secret,
-    remote_funding_pubkey,
-    remote_funding_privkey,
-)
-from .dummyrunner import DummyRunner
+# These are cheap, and eagerly binding them stops the function of the same
+# name being shadowed when the lnprototest.namespace and
+# lnprototest.bitfield submodules get imported.
+from .errors import EventError, SpecFileError
 from .namespace import (
     peer_message_namespace,
     namespace,
     assign_namespace,
     make_namespace,
+    peer_message_csv,
 )
-from .bitfield import bitfield, has_bit, bitfield_len
-from .signature import SigType, Sig
-from .keyset import KeySet
-from .commit_tx import Commit, HTLC, UpdateCommit
-from .utils import (
-    Side,
-    privkey_expand,
-    wait_for,
-    LightningUtils,
-    ScriptType,
-    BitcoinUtils,
-)
-from .funding import (
-    AcceptFunding,
-    CreateFunding,
-    CreateDualFunding,
-    Funding,
-    AddInput,
-    AddOutput,
-    FinalizeFunding,
-    AddWitnesses,
-)
-from .proposals import dual_fund_csv, channel_type_csv
+from .bitfield import bitfield, has_bit, bitfield_len, FeatureBits
+
+if TYPE_CHECKING:
+    from .event import (
+        Event,
+        Connect,
+        Disconnect,
+        Msg,
+        RawMsg,
+        ExpectMsg,
+        MustNotMsg,
+        Block,
+        ExpectTx,
+        FundChannel,
+        InitRbf,
+        Invoice,
+        AddHtlc,
+        CheckEq,
+        ExpectError,
+        ResolvableInt,
+        ResolvableStr,
+        Resolvable,
+        ResolvableBool,
+        msat,
+        negotiated,
+        DualFundAccept,
+        Wait,
+        CloseChannel,
+        ExpectDisconnect,
+    )
+
+    from .structure import Sequence, OneOf, AnyOrder, TryAll
+
+    from .runner import (
+        Runner,
+        Conn,
+        remote_revocation_basepoint,
+        remote_payment_basepoint,
+        remote_delayed_payment_basepoint,
+        remote_htlc_basepoint,
+        remote_per_commitment_point,
+        remote_per_commitment_secret,
+        remote_funding_pubkey,
+        remote_funding_privkey,
+    )
+    from .dummyrunner import DummyRunner
+    from .signature import SigType, Sig
+    from .keyset import KeySet, ShachainReceiver
+    from .msgstash import MsgStash
+    from .resolution import ResolutionContext
+    from .latency import LatencyHistogram, LatencyRecorder
+    from .pingbench import PingBench
+    from .gossip_corpus import GossipCorpus, GossipFlood
+    from .gossip_query import QueryChannelRange
+    from .gossip_store import GossipStore, ServeGossip, ExpectGossipSync
+    from .htlc_churn import HtlcChurn, ExpectHtlcRemovals
+    from .snapshot import Snapshot, SnapshotStore
+    from .commit_tx import Commit, HTLC, UpdateCommit, check_revealed_secret
+    from .utils import (
+        Side,
+        privkey_expand,
+        wait_for,
+        LightningUtils,
+        ScriptType,
+        BitcoinUtils,
+    )
+    from .funding import (
+        AcceptFunding,
+        CreateFunding,
+        CreateDualFunding,
+        Funding,
+        AddInput,
+        AddOutput,
+        FinalizeFunding,
+        AddWitnesses,
+    )
+    from .proposals import dual_fund_csv, channel_type_csv
+
+# Everything else is only imported when first used, so that a runner
+# worker (or a tool) doesn't pay for python-bitcoinlib, the commitment
+# and funding machinery etc. unless it needs them.
+_lazy_modules = {
+    ".event": (
+        "Event",
+        "Connect",
+        "Disconnect",
+        "Msg",
+        "RawMsg",
+        "ExpectMsg",
+        "MustNotMsg",
+        "Block",
+        "ExpectTx",
+        "FundChannel",
+        "InitRbf",
+        "Invoice",
+        "AddHtlc",
+        "CheckEq",
+        "ExpectError",
+        "ResolvableInt",
+        "ResolvableStr",
+        "Resolvable",
+        "ResolvableBool",
+        "msat",
+        "negotiated",
+        "DualFundAccept",
+        "Wait",
+        "CloseChannel",
+        "ExpectDisconnect",
+    ),
+    ".structure": (
+        "Sequence",
+        "OneOf",
+        "AnyOrder",
+        "TryAll",
+    ),
+    ".runner": (
+        "Runner",
+        "Conn",
+        "remote_revocation_basepoint",
+        "remote_payment_basepoint",
+        "remote_delayed_payment_basepoint",
+        "remote_htlc_basepoint",
+        "remote_per_commitment_point",
+        "remote_per_commitment_secret",
+        "remote_funding_pubkey",
+        "remote_funding_privkey",
+    ),
+    ".dummyrunner": ("DummyRunner",),
+    ".signature": (
+        "SigType",
+        "Sig",
+    ),
+    ".keyset": ("KeySet", "ShachainReceiver"),
+    ".msgstash": ("MsgStash",),
+    ".resolution": ("ResolutionContext",),
+    ".latency": (
+        "LatencyHistogram",
+        "LatencyRecorder",
+    ),
+    ".pingbench": ("PingBench",),
+    ".gossip_corpus": (
+        "GossipCorpus",
+        "GossipFlood",
+    ),
+    ".gossip_query": ("QueryChannelRange",),
+    ".gossip_store": ("GossipStore", "ServeGossip", "ExpectGossipSync"),
+    ".htlc_churn": ("HtlcChurn", "ExpectHtlcRemovals"),
+    ".snapshot": ("Snapshot", "SnapshotStore"),
+    ".commit_tx": (
+        "Commit",
+        "HTLC",
+        "UpdateCommit",
+        "check_revealed_secret",
+    ),
+    ".utils": (
+        "Side",
+        "privkey_expand",
+        "wait_for",
+        "LightningUtils",
+        "ScriptType",
+        "BitcoinUtils",
+    ),
+    ".funding": (
+        "AcceptFunding",
+        "CreateFunding",
+        "CreateDualFunding",
+        "Funding",
+        "AddInput",
+        "AddOutput",
+        "FinalizeFunding",
+        "AddWitnesses",
+    ),
+    ".proposals": (
+        "dual_fund_csv",
+        "channel_type_csv",
+    ),
+}
+_lazy_exports: Dict[str, str] = {
+    name: modname for modname, names in _lazy_modules.items() for name in names
+}
+
+
+def __getattr__(name: str) -> Any:
+    modname = _lazy_exports.get(name)
+    if modname is None:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    val = getattr(importlib.import_module(modname, __name__), name)
+    globals()[name] = val
+    return val
+
+
+def __dir__() -> List[str]:
+    return sorted(set(globals()) | set(_lazy_exports))
+
 
 __all__ = [
     "EventError",
@@ -124,13 +258,31 @@ __all__ = [
     "Runner",
     "Conn",
     "KeySet",
+    "ShachainReceiver",
+    "MsgStash",
+    "ResolutionContext",
+    "LatencyHistogram",
+    "LatencyRecorder",
+    "PingBench",
+    "GossipCorpus",
+    "GossipFlood",
+    "QueryChannelRange",
+    "GossipStore",
+    "ServeGossip",
+    "ExpectGossipSync",
+    "HtlcChurn",
+    "ExpectHtlcRemovals",
+    "Snapshot",
+    "SnapshotStore",
     "peer_message_namespace",
     "namespace",
     "assign_namespace",
     "make_namespace",
+    "peer_message_csv",
     "bitfield",
     "has_bit",
     "bitfield_len",
+    "FeatureBits",
     "msat",
     "negotiated",
     "remote_revocation_basepoint",
@@ -144,11 +296,11 @@ __all__ = [
     "Commit",
     "HTLC",
     "UpdateCommit",
+    "check_revealed_secret",
     "Side",
     "AcceptFunding",
     "CreateFunding",
     "Funding",
-    "regtest_hash",
     "privkey_expand",
     "Wait",
     "dual_fund_csv",
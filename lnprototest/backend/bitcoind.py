@@ -8,12 +8,14 @@ import os
 import shutil
 import subprocess
 import logging
-import socket
 
-from contextlib import closing
-from typing import Any, Callable, Optional
+from typing import Any, Callable, Dict, Optional
 from bitcoin.rpc import RawProxy
 from .backend import Backend
+from ..trace import Tracer
+from ..utils.ports import PortLeases
+
+tracer = Tracer(__name__)
 
 
 class BitcoinProxy:
@@ -36,11 +38,9 @@ class BitcoinProxy:
         def f(*args: Any) -> Callable:
             self.__proxy = RawProxy(btc_conf_file=self.btc_conf_file)
 
-            logging.debug(
-                "Calling {name} with arguments {args}".format(name=name, args=args)
-            )
+            tracer.debug("bitcoind call", method=name, args=args)
             res = self.__proxy._call(name, *args)
-            logging.debug("Result for {name} call: {res}".format(name=name, res=res))
+            tracer.debug("bitcoind result", method=name, result=res)
             return res
 
         # Make debuggers show <function bitcoin.rpc.name> rather than <function
@@ -52,8 +52,15 @@ class BitcoinProxy:
 class Bitcoind(Backend):
     """Starts regtest bitcoind on an ephemeral port, and returns the RPC proxy"""
 
-    def __init__(self, basedir: str, with_wallet: Optional[str] = None):
+    def __init__(
+        self,
+        basedir: str,
+        with_wallet: Optional[str] = None,
+        ports: Optional[PortLeases] = None,
+    ):
         self.with_wallet = with_wallet
+        # Released by our owner (or reclaimed once this process exits).
+        self.ports = ports if ports is not None else PortLeases()
         self.rpc = None
         self.proc = None
         self.base_dir = basedir
@@ -67,21 +74,13 @@ class Bitcoind(Backend):
             "-regtest",
             "-logtimestamps",
             "-nolisten",
+            # So restarting the process is a way to empty the mempool.
+            "-persistmempool=0",
         ]
         self.btc_version = None
-
-    def __reserve(self) -> int:
-        """
-        When python asks for a free port from the os, it is possible that
-        with concurrent access, the port that is picked is a port that is not free
-        anymore when we go to bind the daemon like bitcoind port.
-
-        Source: https://stackoverflow.com/questions/1365265/on-localhost-how-do-i-pick-a-free-port-number
-        """
-        with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
-            s.bind(("", 0))
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            return s.getsockname()[1]
+        # The chain as start() leaves it: block 101, and its UTXO set.
+        self.base_tip: Optional[str] = None
+        self.base_utxos: Optional[Dict[str, Any]] = None
 
     def __init_bitcoin_conf(self):
         """Init the bitcoin core directory with all the necessary information
@@ -89,7 +88,7 @@ class Bitcoind(Backend):
         if not os.path.exists(self.bitcoin_dir):
             os.makedirs(self.bitcoin_dir)
             logging.debug(f"Creating {self.bitcoin_dir} directory")
-        self.port = self.__reserve()
+        self.port = self.ports.lease()
         logging.debug("Port is {}, dir is {}".format(self.port, self.bitcoin_dir))
         # For after 0.16.1 (eg. 3f398d7a17f136cd4a67998406ca41a124ae2966), this
         # needs its own [regtest] section.
@@ -130,22 +129,41 @@ class Bitcoind(Backend):
             # Sanity check
             raise ValueError("bitcoind not initialized")
 
-        # Wait for it to startup.
-        while b"Done loading" not in self.proc.stdout.readline():
-            pass
-        return True
+        # Wait for it to startup (or exit, e.g. if it can't bind the port).
+        for line in self.proc.stdout:
+            if b"Done loading" in line:
+                return True
+        self.proc.wait()
+        return False
 
-    def start(self) -> None:
-        if self.rpc is None:
-            self.__init_bitcoin_conf()
+    def __launch(self) -> bool:
         # TODO: We can move this to a single call and not use Popen
         self.proc = subprocess.Popen(self.cmd_line, stdout=subprocess.PIPE)
         assert self.proc.stdout
+        return self.__is__bitcoind_ready()
+
+    def __utxo_set(self) -> Dict[str, Any]:
+        """Enough of gettxoutsetinfo to tell if the UTXO set is the same"""
+        info = self.rpc.gettxoutsetinfo()
+        # hash_serialized_2 or hash_serialized_3, depending on version.
+        return {
+            k: v
+            for k, v in info.items()
+            if k in ("height", "bestblock", "txouts", "total_amount")
+            or k.startswith("hash_serialized")
+        }
 
-        # Wait for it to startup.
-        while not self.__is__bitcoind_ready():
-            logging.debug("Bitcoin core is loading")
-
+    def start(self) -> None:
+        for _ in range(3):
+            if self.rpc is None:
+                self.__init_bitcoin_conf()
+            if self.__launch():
+                break
+            # Someone else took our port after all?  Try another.
+            logging.debug(f"bitcoind exited on startup (rpc port {self.port})")
+            self.rpc = None
+        else:
+            raise RuntimeError("bitcoind would not start")
         self.__version_compatibility()
         # Block #1.
         # Privkey the coinbase spends to:
@@ -154,14 +172,82 @@ class Bitcoind(Backend):
             "0000002006226e46111a0b59caaf126043eb5bbf28c34f3a5e332a1fc7b2b73cf188910f84591a56720aabc8023cecf71801c5e0f9d049d0c550ab42412ad12a67d89f3a3dbb6c60ffff7f200400000001020000000001010000000000000000000000000000000000000000000000000000000000000000ffffffff03510101ffffffff0200f2052a0100000016001419f5016f07fe815f611df3a2a0802dbd74e634c40000000000000000266a24aa21a9ede2f61c3f71d1defd3fa999dfa36953755c690689799962b48bebd836974e8cf90120000000000000000000000000000000000000000000000000000000000000000000000000"
         )
         self.rpc.generatetoaddress(100, self.rpc.getnewaddress())
+        self.base_tip = self.rpc.getbestblockhash()
+        self.base_utxos = self.__utxo_set()
 
     def stop(self) -> None:
         self.rpc.stop()
         self.proc.kill()
         shutil.rmtree(os.path.join(self.bitcoin_dir, "regtest"))
 
+    def __evict_mempool(self) -> None:
+        """Transactions from blocks we invalidate go back into the mempool,
+        and there's no RPC to remove them: restart the process, keeping
+        the chain (we don't persist the mempool)."""
+        self.rpc.stop()
+        self.proc.wait(timeout=60)
+        self.__relaunch()
+
+    def rewind(self) -> bool:
+        """Return the chain to block 101 as start() left it, with an empty
+        mempool.  Returns False if we couldn't, and need to start afresh."""
+        if self.base_tip is None:
+            return False
+        try:
+            if (
+                self.rpc.getblockcount() < 101
+                or self.rpc.getblockhash(101) != self.base_tip
+            ):
+                # Someone invalidated our blocks: bring them back first.
+                self.rpc.reconsiderblock(self.base_tip)
+            if self.rpc.getblockcount() > 101:
+                self.rpc.invalidateblock(self.rpc.getblockhash(102))
+            if self.rpc.getbestblockhash() != self.base_tip:
+                return False
+
+            if self.rpc.getrawmempool() != []:
+                self.__evict_mempool()
+                if self.rpc.getrawmempool() != []:
+                    return False
+
+            # Paranoia: this should be the same chain we started with.
+            return self.__utxo_set() == self.base_utxos
+        except Exception as ex:
+            logging.debug(f"bitcoind rewind failed: {ex}")
+            return False
+
+    def __relaunch(self) -> None:
+        if not self.__launch():
+            raise RuntimeError("bitcoind did not restart")
+        if self.btc_version is not None and self.btc_version >= 210000:
+            self.rpc.loadwallet(
+                "main" if self.with_wallet is None else self.with_wallet
+            )
+
+    def snapshot(self, directory: str) -> Dict[str, Any]:
+        """Copy our chain and wallet into directory, for restore()"""
+        self.rpc.stop()
+        self.proc.wait(timeout=60)
+        shutil.copytree(os.path.join(self.bitcoin_dir, "regtest"), directory)
+        self.__relaunch()
+        return {"base_tip": self.base_tip, "base_utxos": self.base_utxos}
+
+    def restore(self, directory: str, state: Dict[str, Any]) -> None:
+        """Replace our chain and wallet with those snapshot() saved"""
+        self.rpc.stop()
+        self.proc.wait(timeout=60)
+        regtest = os.path.join(self.bitcoin_dir, "regtest")
+        shutil.rmtree(regtest)
+        shutil.copytree(directory, regtest)
+        self.__relaunch()
+        # rewind() goes back to *its* block 101, not the one we started with.
+        self.base_tip = state["base_tip"]
+        self.base_utxos = state["base_utxos"]
+
     def restart(self) -> None:
         # Only restart if we have to.
-        if self.rpc.getblockcount() != 101 or self.rpc.getrawmempool() != []:
-            self.stop()
-            self.start()
+        if self.rewind():
+            return
+        logging.debug("bitcoind rewind failed, restarting")
+        self.stop()
+        self.start()
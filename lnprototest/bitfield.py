@@ -1,37 +1,133 @@
 #! /usr/bin/python3
+import functools
 from typing import Union, List
 
 
+@functools.lru_cache(maxsize=1024)
+def _hex_bits(hexstr: str) -> int:
+    return int(hexstr, 16) if hexstr else 0
+
+
+@functools.lru_cache(maxsize=1024)
+def _pairs(bits: int) -> int:
+    """Both bits of every feature pair where either bit is set"""
+    # 0b...010101, as long as bits.
+    evenmask = (4 ** (bits.bit_length() // 2 + 1) - 1) // 3
+    even = (bits | (bits >> 1)) & evenmask
+    return even | (even << 1)
+
+
+class FeatureBits(str):
+    """A features bitfield, backed by an int.
+
+    This is still the hex string it always was, so it can go anywhere a
+    features string could (init messages, runner_features(), Commit,
+    negotiated()), but queries don't have to parse the hex again.
+    """
+
+    bits: int
+
+    def __new__(cls, val: Union[int, str, bytes, List[int]] = 0) -> "FeatureBits":
+        if isinstance(val, FeatureBits):
+            return val
+        if isinstance(val, int):
+            hexstr = val.to_bytes((val.bit_length() + 7) // 8, "big").hex()
+            bits = val
+        elif isinstance(val, str):
+            hexstr = val
+            bits = _hex_bits(val)
+        else:
+            # Internal to a msg, it's a list of int.
+            hexstr = bytes(val).hex()
+            bits = _hex_bits(hexstr)
+        self = super().__new__(cls, hexstr)
+        self.bits = bits
+        return self
+
+    @classmethod
+    def from_bitnums(cls, *bitnums: int) -> "FeatureBits":
+        bits = 0
+        for bitnum in bitnums:
+            bits |= 1 << bitnum
+        return cls(bits)
+
+    def has(self, bitnum: int) -> bool:
+        """Test bit in this bitfield (little-endian, as per BOLTs)"""
+        return (self.bits >> bitnum) & 1 == 1
+
+    def has_feature(self, fbit: int) -> bool:
+        """Feature bits go in optional/compulsory pairs: is either set?"""
+        return (self.bits >> (fbit & ~1)) & 3 != 0
+
+    def to_hex(self) -> str:
+        return str.__str__(self)
+
+    @staticmethod
+    def negotiate(
+        a: Union["FeatureBits", str], b: Union["FeatureBits", str]
+    ) -> "FeatureBits":
+        """The features both sides have (both bits of each pair)"""
+        return FeatureBits(_pairs(FeatureBits(a).bits) & _pairs(FeatureBits(b).bits))
+
+    def __repr__(self) -> str:
+        return "FeatureBits({!r})".format(self.to_hex())
+
+
 def bitfield_len(bitfield: Union[List[int], str]) -> int:
     """Return length of this field in bits (assuming it's a bitfield!)"""
     if isinstance(bitfield, str):
-        return len(bytes.fromhex(bitfield)) * 8
+        return len(bitfield) // 2 * 8
     else:
         return len(bitfield) * 8
 
 
 def has_bit(bitfield: Union[List[int], str], bitnum: int) -> bool:
     """Test bit in this bitfield (little-endian, as per BOLTs)"""
+    if isinstance(bitfield, str):
+        return FeatureBits(bitfield).has(bitnum)
+
+    # internal to a msg, it's a list of int.
     bitlen = bitfield_len(bitfield)
     if bitnum >= bitlen:
         return False
 
-    # internal to a msg, it's a list of int.
-    if isinstance(bitfield, str):
-        byte = bytes.fromhex(bitfield)[bitlen // 8 - 1 - bitnum // 8]
-    else:
-        byte = bitfield[bitlen // 8 - 1 - bitnum // 8]
-
+    byte = bitfield[bitlen // 8 - 1 - bitnum // 8]
     if (byte & (1 << (bitnum % 8))) != 0:
         return True
     else:
         return False
 
 
-def bitfield(*args: int) -> str:
+def bitfield(*args: int) -> FeatureBits:
     """Create a bitfield hex value with these bit numbers set"""
-    bytelen = (max(args) + 8) // 8
-    bfield = bytearray(bytelen)
-    for bitnum in args:
-        bfield[bytelen - 1 - bitnum // 8] |= 1 << (bitnum % 8)
-    return bfield.hex()
+    return FeatureBits.from_bitnums(*args)
+
+
+def test_featurebits() -> None:
+    assert bitfield(0) == "01"
+    assert bitfield(7) == "80"
+    assert bitfield(8) == "0100"
+    assert bitfield(1, 12) == "1002"
+    assert FeatureBits("") == "" and FeatureBits(0) == ""
+
+    # Leading zeroes are preserved, for the wire.
+    f = FeatureBits("000a")
+    assert f == "000a" and f.to_hex() == "000a" and bitfield_len(f) == 16
+    assert f.has(1) and f.has(3) and not f.has(0) and not f.has(100)
+    assert has_bit("000a", 3) and not has_bit("000a", 2)
+    assert has_bit([0, 10], 3) and not has_bit([0, 10], 16)
+    assert FeatureBits([0, 10]) == f and FeatureBits(f) is f
+    assert FeatureBits(bytes([0x02])).bits == 2
+
+    # Either bit of the pair counts.
+    assert f.has_feature(0) and f.has_feature(1) and f.has_feature(2)
+    assert not f.has_feature(4)
+
+    # static_remotekey (12/13) both sides, anchors (20/21) only one side.
+    a = bitfield(13, 21)
+    b = bitfield(12, 8)
+    n = FeatureBits.negotiate(a, b)
+    assert n.has_feature(12) and n.has(12) and n.has(13)
+    assert not n.has_feature(20) and not n.has_feature(8)
+    assert FeatureBits.negotiate(a, b) == n
+    assert FeatureBits.negotiate("", b) == ""
@@ -4,6 +4,7 @@
 # Released by Rusty Russell under CC0:
 # https://creativecommons.org/publicdomain/zero/1.0/
 
+import collections
 import hashlib
 import pyln.client
 import pyln.proto.wire
@@ -15,12 +16,14 @@ import struct
 import shutil
 import logging
 import socket
+import stat
 import time
 
-from contextlib import closing
 from datetime import date
 from concurrent import futures
 from lnprototest.backend import Bitcoind
+from lnprototest.utils.ports import PortLeases
+from .tasks import TaskGroup, pool_stats
 from lnprototest import (
     Event,
     EventError,
@@ -31,27 +34,59 @@ from lnprototest import (
     MustNotMsg,
 )
 from lnprototest import wait_for
-from typing import Dict, Any, Callable, List, Optional, cast
+from lnprototest.snapshot import RunnerSnapshot
+from typing import Dict, Any, Callable, List, Optional, Union, cast
 
 TIMEOUT = int(os.getenv("TIMEOUT", "60"))
+# Set to 0 to always stop and restart lightningd between paths.
+SOFT_RESET = os.getenv("LNPROTOTEST_SOFT_RESET", "1") != "0"
+# "unix" to talk to lightningd over a unix socket in its directory, not TCP.
+TRANSPORT = os.getenv("LNPROTOTEST_TRANSPORT", "tcp")
 LIGHTNING_SRC = os.path.join(os.getcwd(), os.getenv("LIGHTNING_SRC", "../lightning/"))
 
 
+def _sockets(directory: str, names: List[str]) -> List[str]:
+    """shutil.copytree() ignore function: we can't copy unix sockets"""
+    return [
+        n for n in names if stat.S_ISSOCK(os.lstat(os.path.join(directory, n)).st_mode)
+    ]
+
+
 class CLightningConn(lnprototest.Conn):
-    def __init__(self, connprivkey: str, port: int):
+    def __init__(self, connprivkey: str, addr: Union[int, str]):
+        """addr is a TCP port on localhost, or a unix socket path"""
         super().__init__(connprivkey)
+        if isinstance(addr, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(addr)
+        else:
+            sock = socket.create_connection(("127.0.0.1", addr))
+            # Otherwise Nagle and delayed acks add ~40ms to each exchange.
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         # FIXME: pyln.proto.wire should just use coincurve PrivateKey!
-        self.connection = pyln.proto.wire.connect(
-            pyln.proto.wire.PrivateKey(bytes.fromhex(self.connprivkey.to_hex())),
+        self.connection = pyln.proto.wire.LightningConnection(
+            sock,
             # FIXME: Ask node for pubkey
             pyln.proto.wire.PublicKey(
                 bytes.fromhex(
                     "0279be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798"
                 )
             ),
-            "127.0.0.1",
-            port,
+            pyln.proto.wire.PrivateKey(bytes.fromhex(self.connprivkey.to_hex())),
+            is_initiator=True,
         )
+        self.connection.shake()
+        # A read which timed out, but may still deliver a message.
+        self.pending_read: Optional[futures.Future] = None
+
+    def close(self) -> None:
+        """Close, waking any pending read (close() alone doesn't)"""
+        sock = self.connection.connection
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
 
 
 class Runner(lnprototest.Runner):
@@ -64,7 +99,15 @@ class Runner(lnprototest.Runner):
         self.cleanup_callbacks: List[Callable[[], None]] = []
         self.fundchannel_future: Optional[Any] = None
         self.is_fundchannel_kill = False
-        self.executor = futures.ThreadPoolExecutor(max_workers=20)
+        # Ports we hold (for us and bitcoind) until teardown().
+        self.ports = PortLeases()
+        self.lightning_port: Optional[int] = None
+        # If set, lightningd listens for peers here instead.
+        self.peer_socket: Optional[str] = None
+        # Our tasks on the (process-wide) thread pool.
+        self.tasks = TaskGroup("clightning.Runner")
+        # How each restart() was done: "soft", or "full: <reason>".
+        self.restart_stats: Dict[str, int] = collections.Counter()
 
         self.startup_flags = []
         for flag in config.getoption("runner_args"):
@@ -103,19 +146,6 @@ class Runner(lnprototest.Runner):
                 k, v = o.split("/")
                 self.options[k] = v
 
-    def __reserve(self) -> int:
-        """
-        When python asks for a free port from the os, it is possible that
-        with concurrent access, the port that is picked is a port that is not free
-        anymore when we go to bind the daemon like bitcoind port.
-
-        Source: https://stackoverflow.com/questions/1365265/on-localhost-how-do-i-pick-a-free-port-number
-        """
-        with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
-            s.bind(("", 0))
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            return s.getsockname()[1]
-
     def __init_sandbox_dir(self) -> None:
         """Create the tmp directory for lnprotest and lightningd"""
         self.lightning_dir = os.path.join(self.directory, "lightningd")
@@ -143,14 +173,47 @@ class Runner(lnprototest.Runner):
     def start(self, also_bitcoind: bool = True) -> None:
         self.logger.debug("[START]")
         self.__init_sandbox_dir()
-        self.lightning_port = self.__reserve()
+        if TRANSPORT == "unix":
+            path = os.path.join(self.lightning_dir, "peer-socket")
+            # sun_path is only 108 bytes.
+            if len(path) < 100:
+                self.peer_socket = path
+            else:
+                self.logger.debug("{} too long for a unix socket".format(path))
         if also_bitcoind:
-            self.bitcoind = Bitcoind(self.directory)
+            self.bitcoind = Bitcoind(self.directory, ports=self.ports)
             try:
                 self.bitcoind.start()
             except Exception as ex:
                 self.logger.debug(f"Exception with message {ex}")
             self.logger.debug("RUN Bitcoind")
+
+        for _ in range(3):
+            if self.lightning_port is None and self.peer_socket is None:
+                self.lightning_port = self.ports.lease()
+            if self.__start_lightningd():
+                break
+            # Lost a race for the port?  Try another rather than timing out.
+            self.logger.debug(
+                "lightningd exited on startup (port {})".format(self.lightning_port)
+            )
+            self.lightning_port = None
+        else:
+            raise RuntimeError("lightningd would not start")
+        logging.debug("Waited for core-lightning")
+
+        # Make sure that we see any funds that come to our wallet
+        for i in range(5):
+            self.rpc.newaddr()
+
+    def __start_lightningd(self) -> bool:
+        """Start lightningd, and wait until it's ready (True) or exited (False)"""
+        if self.peer_socket is not None:
+            bind_addr = self.peer_socket
+            if os.path.exists(bind_addr):
+                os.unlink(bind_addr)
+        else:
+            bind_addr = "127.0.0.1:{}".format(self.lightning_port)
         self.proc = subprocess.Popen(
             [
                 "{}/lightningd/lightningd".format(LIGHTNING_SRC),
@@ -163,7 +226,7 @@ class Runner(lnprototest.Runner):
                 "--dev-fast-gossip",
                 "--dev-allow-localhost",
                 "--dev-no-htlc-timeout",
-                "--bind-addr=127.0.0.1:{}".format(self.lightning_port),
+                "--bind-addr={}".format(bind_addr),
                 "--network=regtest",
                 "--bitcoin-rpcuser=rpcuser",
                 "--bitcoin-rpcpassword=rpcpass",
@@ -174,6 +237,7 @@ class Runner(lnprototest.Runner):
             ]
             + self.startup_flags
         )
+        self.started_flags = list(self.startup_flags)
         self.running = True
         self.rpc = pyln.client.LightningRpc(
             os.path.join(self.lightning_dir, "regtest", "lightning-rpc")
@@ -188,17 +252,18 @@ class Runner(lnprototest.Runner):
                 logging.debug(f"waiting for core-lightning: Exception received {ex}")
                 return False
 
-        wait_for(lambda: node_ready(self.rpc), timeout=TIMEOUT)
-        logging.debug("Waited for core-lightning")
-
-        # Make sure that we see any funds that come to our wallet
-        for i in range(5):
-            self.rpc.newaddr()
+        wait_for(
+            lambda: self.proc.poll() is not None or node_ready(self.rpc),
+            timeout=TIMEOUT,
+        )
+        return self.proc.poll() is None
 
     def shutdown(self, also_bitcoind: bool = True) -> None:
         for cb in self.cleanup_callbacks:
             cb()
-        self.rpc.stop()
+        # It may have crashed, in which case there's nothing to stop.
+        if self.proc is not None and self.proc.poll() is None:
+            self.rpc.stop()
         if also_bitcoind:
             self.bitcoind.stop()
 
@@ -207,7 +272,10 @@ class Runner(lnprototest.Runner):
         self.shutdown(also_bitcoind=also_bitcoind)
         self.running = False
         for c in self.conns.values():
-            cast(CLightningConn, c).connection.connection.close()
+            cast(CLightningConn, c).close()
+        self.tasks.cancel()
+        self.logger.debug("thread pool: {}".format(pool_stats()))
+        self.logger.debug("restarts: {}".format(dict(self.restart_stats)))
         if print_logs:
             log_path = f"{self.lightning_dir}/regtest/log"
             with open(log_path) as log:
@@ -220,16 +288,138 @@ class Runner(lnprototest.Runner):
                 )
         shutil.rmtree(os.path.join(self.lightning_dir, "regtest"))
 
+    def _soft_reset_blocker(self) -> Optional[str]:
+        """Why we can't just rewind the running node, or None if we can"""
+        if not SOFT_RESET:
+            return "disabled"
+        if self.startup_flags != self.started_flags:
+            return "startup flags changed"
+        if self.fundchannel_future is not None:
+            return "fundchannel in progress"
+        if self.proc is None or self.proc.poll() is not None:
+            return "lightningd not running"
+        funds = self.rpc.listfunds()
+        if funds["channels"] or funds["outputs"]:
+            return "node has channels or funds"
+        if self.rpc.listinvoices()["invoices"]:
+            return "node has invoices"
+        if self.rpc.listsendpays()["payments"]:
+            return "node has payments"
+        if self.rpc.listchannels()["channels"]:
+            return "node has gossip"
+        return None
+
+    def soft_reset(self) -> Optional[str]:
+        """If lightningd has nothing to remember from this path, disconnect
+        everyone and rewind the chain to 101, rather than restarting it.
+        Returns None on success, otherwise why we need a full restart"""
+        try:
+            return self._soft_reset()
+        except Exception as ex:
+            # e.g. lightningd crashed or hung during the path.
+            self.logger.debug("[RESTART] soft reset failed: {}".format(ex))
+            return "rpc failed: {}".format(type(ex).__name__)
+
+    def _soft_reset(self) -> Optional[str]:
+        reason = self._soft_reset_blocker()
+        if reason is not None:
+            return reason
+
+        for c in self.conns.values():
+            cast(CLightningConn, c).close()
+        if self.tasks.cancel() != 0:
+            return "tasks still running"
+        for peer in self.rpc.listpeers()["peers"]:
+            if peer["connected"]:
+                self.rpc.disconnect(peer["id"], force=True)
+        if not self.bitcoind.rewind():
+            return "chain did not rewind"
+
+        try:
+            wait_for(
+                lambda: self.rpc.getinfo()["blockheight"] == 101
+                and self.rpc.listpeers()["peers"] == [],
+                timeout=TIMEOUT,
+            )
+        except ValueError:
+            return "node did not rewind"
+        return None
+
     def restart(self) -> None:
         self.logger.debug("[RESTART]")
+        reason = self.soft_reset()
+        if reason is None:
+            self.restart_stats["soft"] += 1
+            super().restart()
+            return
+
+        self.logger.debug("[RESTART] full restart: {}".format(reason))
+        self.restart_stats["full: {}".format(reason)] += 1
         self.stop(also_bitcoind=False)
         # Make a clean start
         super().restart()
         self.bitcoind.restart()
         self.start(also_bitcoind=False)
 
+    def __stop_lightningd(self) -> None:
+        self.rpc.stop()
+        self.proc.wait(timeout=TIMEOUT)
+
+    def __restart_lightningd(self) -> None:
+        if not self.__start_lightningd():
+            raise RuntimeError("lightningd would not restart")
+
+    def snapshot(self, event: Event, directory: str) -> Optional[RunnerSnapshot]:
+        """Stop lightningd and bitcoind long enough to copy their
+        directories, then carry on (reconnect to use the channels!)"""
+        if self.fundchannel_future is not None:
+            return None
+        snapshot = super().snapshot(event, directory)
+        assert snapshot is not None
+        self.tasks.cancel()
+
+        self.__stop_lightningd()
+        snapshot.node["bitcoind"] = self.bitcoind.snapshot(
+            os.path.join(directory, "bitcoind")
+        )
+        shutil.copytree(
+            os.path.join(self.lightning_dir, "regtest"),
+            os.path.join(directory, "lightningd"),
+            ignore=_sockets,
+        )
+        snapshot.node["startup_flags"] = list(self.started_flags)
+        self.__restart_lightningd()
+        return snapshot
+
+    def restore(self, event: Event, snapshot: RunnerSnapshot) -> bool:
+        """Replace lightningd and bitcoind's directories with snapshot's"""
+        if self.fundchannel_future is not None:
+            return False
+        if snapshot.node.get("startup_flags") != self.startup_flags:
+            return False
+        super().restore(event, snapshot)
+        self.tasks.cancel()
+
+        self.__stop_lightningd()
+        self.bitcoind.restore(
+            os.path.join(snapshot.directory, "bitcoind"), snapshot.node["bitcoind"]
+        )
+        regtest = os.path.join(self.lightning_dir, "regtest")
+        shutil.rmtree(regtest)
+        shutil.copytree(os.path.join(snapshot.directory, "lightningd"), regtest)
+        self.__restart_lightningd()
+        wait_for(lambda: self.rpc.getinfo()["blockheight"] == snapshot.blockheight)
+        return True
+
+    def teardown(self) -> None:
+        self.tasks.cancel()
+        self.ports.release()
+        super().teardown()
+
     def connect(self, _: Event, connprivkey: str) -> None:
-        self.add_conn(CLightningConn(connprivkey, self.lightning_port))
+        addr = self.peer_socket if self.peer_socket is not None else self.lightning_port
+        assert addr is not None
+        self.add_conn(CLightningConn(connprivkey, addr))
 
     def getblockheight(self) -> int:
         return self.bitcoind.rpc.getblockcount()
@@ -251,13 +441,7 @@ class Runner(lnprototest.Runner):
         except BrokenPipeError:
             # This happens when they've sent an error and closed; try
             # reading it to figure out what went wrong.
-            fut = self.executor.submit(
-                cast(CLightningConn, conn).connection.read_message
-            )
-            try:
-                msg = fut.result(1)
-            except futures.TimeoutError:
-                msg = None
+            msg = self.read_message(conn, 1)
             if msg:
                 raise EventError(
                     event, "Connection closed after sending {}".format(msg.hex())
@@ -338,9 +522,7 @@ class Runner(lnprototest.Runner):
         # This required some more analysis from core lightning side
         time.sleep(1)
 
-        fut = self.executor.submit(
-            _fundchannel, self, conn, amount, feerate, expect_fail
-        )
+        fut = self.tasks.submit(_fundchannel, self, conn, amount, feerate, expect_fail)
         fut.add_done_callback(_done)
         self.fundchannel_future = fut
         self.cleanup_callbacks.append(self.kill_fundchannel)
@@ -407,7 +589,7 @@ class Runner(lnprototest.Runner):
             if exception:
                 raise (exception)
 
-        fut = self.executor.submit(_run_rbf, self, conn)
+        fut = self.tasks.submit(_run_rbf, self, conn)
         fut.add_done_callback(_done)
 
     def invoice(self, event: Event, amount: int, preimage: str) -> None:
@@ -441,15 +623,32 @@ class Runner(lnprototest.Runner):
         }
         self.rpc.sendpay([routestep], payhash)
 
+    def read_message(self, conn: Conn, timeout: float) -> Optional[bytes]:
+        """Read a message from conn, or None on timeout.
+
+        A read which times out is left pending, and the next call waits on
+        it rather than starting another thread on the same socket: so
+        we never lose a late message, and never pile up blocked readers.
+        Closing the connection wakes it."""
+        c = cast(CLightningConn, conn)
+        fut = c.pending_read
+        if fut is None:
+            fut = self.tasks.submit(c.connection.read_message, wake=c.close)
+            c.pending_read = fut
+        done, _ = futures.wait([fut], timeout)
+        if not done:
+            return None
+        c.pending_read = None
+        return fut.result()
+
     def get_output_message(
         self, conn: Conn, event: Event, timeout: int = TIMEOUT
     ) -> Optional[bytes]:
-        fut = self.executor.submit(cast(CLightningConn, conn).connection.read_message)
         try:
-            return fut.result(timeout)
-        except futures.TimeoutError as ex:
-            logging.error(f"timeout exception {ex}")
-            return None
+            msg = self.read_message(conn, timeout)
+            if msg is None:
+                logging.error(f"timeout reading from {conn}")
+            return msg
         except Exception as ex:
             logging.error(f"{ex}")
             return None
@@ -488,7 +687,7 @@ class Runner(lnprototest.Runner):
                 if msgtype == namespace().get_msgtype("error").number:
                     raise EventError(event, "Got error msg: {}".format(binmsg.hex()))
 
-        cast(CLightningConn, conn).connection.connection.close()
+        cast(CLightningConn, conn).close()
 
     def expect_tx(self, event: Event, txid: str) -> None:
         # Ah bitcoin endianness...
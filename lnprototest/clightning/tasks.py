@@ -0,0 +1,155 @@
+#! /usr/bin/python3
+# One thread pool for every runner in the process.
+#
+# Runners push blocking calls (reading from the peer, fundchannel, RBF)
+# onto threads.  A pool per runner, never shut down, means a pytest worker
+# which runs hundreds of tests collects thousands of idle (or worse, stuck
+# in recv()) threads.  Instead there is one bounded pool, and each runner
+# submits through its own TaskGroup so it can cancel what it started.
+import atexit
+import logging
+import os
+import threading
+from concurrent import futures
+from typing import Any, Callable, Dict, Optional
+
+# Same as each runner used to have to itself.
+MAX_WORKERS = int(os.getenv("LNPROTOTEST_MAX_WORKERS", "20"))
+
+_lock = threading.Lock()
+_executor: Optional[futures.ThreadPoolExecutor] = None
+_stats: Dict[str, int] = {
+    "submitted": 0,
+    "running": 0,
+    "peak_running": 0,
+    "completed": 0,
+    "cancelled": 0,
+    "woken": 0,
+}
+
+
+def shared_executor() -> futures.ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = futures.ThreadPoolExecutor(
+                max_workers=MAX_WORKERS, thread_name_prefix="lnprototest"
+            )
+            atexit.register(_executor.shutdown, wait=False, cancel_futures=True)
+        return _executor
+
+
+def pool_stats() -> Dict[str, int]:
+    """Occupancy of the shared pool: queued is submitted, but waiting for a
+    thread"""
+    with _lock:
+        ret = dict(_stats)
+    ret["max_workers"] = MAX_WORKERS
+    ret["queued"] = (
+        ret["submitted"] - ret["running"] - ret["completed"] - ret["cancelled"]
+    )
+    return ret
+
+
+def _run(fn: Callable[..., Any], *args: Any) -> Any:
+    with _lock:
+        _stats["running"] += 1
+        _stats["peak_running"] = max(_stats["peak_running"], _stats["running"])
+    try:
+        return fn(*args)
+    finally:
+        with _lock:
+            _stats["running"] -= 1
+            _stats["completed"] += 1
+
+
+class TaskGroup(object):
+    """The tasks one runner has submitted to the shared pool.
+
+    submit() takes an optional wake function, which unblocks the task if
+    it is stuck (usually by closing the socket it is reading from);
+    cancel() drops anything still queued and wakes anything running.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._tasks: Dict[futures.Future, Optional[Callable[[], None]]] = {}
+
+    def submit(
+        self,
+        fn: Callable[..., Any],
+        *args: Any,
+        wake: Optional[Callable[[], None]] = None,
+    ) -> futures.Future:
+        with _lock:
+            _stats["submitted"] += 1
+        fut = shared_executor().submit(_run, fn, *args)
+        with self._lock:
+            self._tasks[fut] = wake
+        fut.add_done_callback(self._forget)
+        return fut
+
+    def _forget(self, fut: futures.Future) -> None:
+        with self._lock:
+            self._tasks.pop(fut, None)
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._tasks)
+
+    def cancel(self, timeout: float = 5) -> int:
+        """Cancel or wake all our tasks, and wait up to timeout seconds for
+        them.  Returns the number still running."""
+        with self._lock:
+            tasks = list(self._tasks.items())
+
+        for fut, wake in tasks:
+            if fut.cancel():
+                with _lock:
+                    _stats["cancelled"] += 1
+            elif wake is not None and not fut.done():
+                try:
+                    wake()
+                except Exception as ex:
+                    logging.debug("{}: waking task: {}".format(self.name, ex))
+                with _lock:
+                    _stats["woken"] += 1
+
+        _, not_done = futures.wait([f for f, _ in tasks], timeout=timeout)
+        if not_done:
+            logging.warning(
+                "{}: {} tasks still running after cancel".format(
+                    self.name, len(not_done)
+                )
+            )
+        return len(not_done)
+
+
+def test_taskgroup() -> None:
+    import socket
+
+    before = pool_stats()
+    group = TaskGroup("test_taskgroup")
+    assert group.submit(lambda x: x + 1, 1).result(5) == 2
+
+    # A reader blocked forever, unless we close its socket.
+    a, b = socket.socketpair()
+    fut = group.submit(a.recv, 1, wake=lambda: a.shutdown(socket.SHUT_RDWR))
+    try:
+        fut.result(0.1)
+        assert False, "recv should block"
+    except futures.TimeoutError:
+        pass
+    assert group.pending() == 1
+    assert group.cancel() == 0
+    assert fut.done() and group.pending() == 0
+    a.close()
+    b.close()
+
+    stats = pool_stats()
+    assert stats["submitted"] == before["submitted"] + 2
+    assert stats["completed"] == before["completed"] + 2
+    assert stats["woken"] == before["woken"] + 1
+    assert stats["running"] == 0 and stats["queued"] == 0
+    assert stats["peak_running"] >= 1
@@ -0,0 +1,497 @@
+#! /usr/bin/python3
+# Fast wire encoding/decoding for high-volume, fixed-layout messages.
+#
+# pyln's Message.read/write go field by field (and byte arrays byte by
+# byte!) over an io.BytesIO.  For the messages we send and receive
+# thousands of times (pings, HTLC updates, commitments), we precompile the
+# layout into struct.Struct runs instead.  The results are identical to the
+# generic path, and anything we don't understand (TLVs which are actually
+# present, bad values, truncated input) is handed back to it.
+import collections.abc
+import io
+import struct
+import weakref
+from pyln.proto.message import (
+    Message,
+    MessageNamespace,
+    MessageType,
+    SizedArrayType,
+    DynamicArrayType,
+    TlvStreamType,
+    FieldType,
+)
+from pyln.proto.message.array_types import LengthFieldType
+from pyln.proto.message.fundamental_types import (
+    IntegerType,
+    ShortChannelIDType,
+    FundamentalHexType,
+)
+from .namespace import namespace
+from .signature import Sig, SigType
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+# Message types we compile codecs for: see register_codec().
+_fast_msgtypes: Set[str] = {
+    "ping",
+    "pong",
+    "update_add_htlc",
+    "commitment_signed",
+    "revoke_and_ack",
+    # These can be large: decoding them leaves the byte arrays in place.
+    "reply_channel_range",
+    "tx_add_input",
+}
+
+# Compiled codec (or None if it can't be compiled) for each MessageType.
+_codecs: "weakref.WeakKeyDictionary[MessageType, Optional[MessageCodec]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+class _Run(object):
+    """Consecutive fixed-size fields, packed with a single struct"""
+
+    def __init__(self) -> None:
+        self.fmt = ">"
+        # (fieldname, kind, size)
+        self.fields: List[Tuple[str, str, int]] = []
+        # Length fields: fieldname -> the fields whose length it is
+        self.len_for: Dict[str, List[str]] = {}
+
+    def add(self, name: str, kind: str, fmt: str, size: int) -> None:
+        self.fmt += fmt
+        self.fields.append((name, kind, size))
+
+
+class _Array(object):
+    """A byte or signature array: count is fixed, or given by lenfield"""
+
+    def __init__(
+        self,
+        name: str,
+        kind: str,
+        elemsize: int,
+        lenfield: Optional[str] = None,
+        count: int = 0,
+    ):
+        self.name = name
+        self.kind = kind
+        self.elemsize = elemsize
+        self.lenfield = lenfield
+        self.count = count
+
+
+class ByteView(collections.abc.Sequence):
+    """A decoded byte array field which still points into the received
+    message: it acts like the list of ints pyln uses, but only copies (or
+    hex-encodes) when someone asks"""
+
+    __slots__ = ("_view",)
+
+    def __init__(self, view: Union[bytes, memoryview]):
+        self._view = memoryview(view)
+
+    def __len__(self) -> int:
+        return len(self._view)
+
+    def __getitem__(self, idx: Any) -> Any:
+        if isinstance(idx, slice):
+            return list(self._view[idx])
+        return self._view[idx]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._view)
+
+    def __bytes__(self) -> bytes:
+        return self._view.tobytes()
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, ByteView):
+            return self._view == other._view
+        if isinstance(other, (bytes, bytearray)):
+            return self._view == other
+        if isinstance(other, list):
+            return list(self._view) == other
+        return NotImplemented
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return (ByteView, (bytes(self),))
+
+    def __repr__(self) -> str:
+        return repr(list(self._view))
+
+    def hex(self) -> str:
+        return self._view.hex()
+
+
+class MessageCodec(object):
+    """Precompiled encoder/decoder for one MessageType"""
+
+    def __init__(
+        self,
+        msgtype: MessageType,
+        segments: List[Union[_Run, _Array]],
+        tail: List[Tuple[str, Optional[TlvStreamType]]],
+    ):
+        self.msgtype = msgtype
+        self.prefix = struct.pack(">H", msgtype.number)
+        self.segments = segments
+        self.structs = [
+            struct.Struct(s.fmt) if isinstance(s, _Run) else None for s in segments
+        ]
+        # Trailing optional fields (name, tlvstream or None).  A TLV stream
+        # is handed to pyln, other optional fields send us down the generic
+        # path if present.
+        self.tail = tail
+
+    @staticmethod
+    def _scalar(ftype: FieldType) -> Optional[Tuple[str, str, int]]:
+        """(kind, structfmt, size) for a fixed-size field type, or None"""
+        if isinstance(ftype, SigType):
+            return ("sig", "64s", 64)
+        if type(ftype) in (IntegerType, ShortChannelIDType):
+            return ("int", ftype.structfmt.lstrip("<>!="), ftype.bytelen)
+        if type(ftype) is FundamentalHexType:
+            return ("hex", "{}s".format(ftype.bytelen), ftype.bytelen)
+        return None
+
+    @classmethod
+    def compile(cls, msgtype: MessageType) -> Optional["MessageCodec"]:
+        segments: List[Union[_Run, _Array]] = []
+        tail: List[Tuple[str, Optional[TlvStreamType]]] = []
+
+        def run() -> _Run:
+            last = segments[-1] if segments else None
+            if not isinstance(last, _Run):
+                last = _Run()
+                segments.append(last)
+            return last
+
+        for f in msgtype.fields:
+            ftype = f.fieldtype
+            # Once things get optional, the rest must be too.
+            if tail or f.option is not None or isinstance(ftype, TlvStreamType):
+                if f.option is None and not isinstance(ftype, TlvStreamType):
+                    return None
+                if f.option is not None:
+                    tail.append((f.name, None))
+                else:
+                    tail.append((f.name, ftype))
+                continue
+
+            if type(ftype) is LengthFieldType:
+                r = run()
+                r.add(f.name, "len", ftype.underlying_type.structfmt.lstrip(">"), 0)
+                r.len_for[f.name] = [lf.name for lf in ftype.len_for]
+                continue
+
+            if type(ftype) is SizedArrayType:
+                if ftype.elemtype.name != "byte":
+                    return None
+                segments.append(_Array(f.name, "bytes", 1, count=ftype.arraysize))
+                continue
+
+            if type(ftype) is DynamicArrayType:
+                if ftype.elemtype.name == "byte":
+                    kind, size = "bytes", 1
+                else:
+                    scalar = cls._scalar(ftype.elemtype)
+                    if scalar is None or scalar[0] != "sig":
+                        return None
+                    kind, size = "sigs", 64
+                segments.append(_Array(f.name, kind, size, ftype.lenfield.name))
+                continue
+
+            scalar = cls._scalar(ftype)
+            if scalar is None:
+                return None
+            run().add(f.name, scalar[0], scalar[1], scalar[2])
+
+        return cls(msgtype, segments, tail)
+
+    def encode(self, fields: Dict[str, Any]) -> Optional[bytes]:
+        """Wire encoding of fields, or None if we need the generic path"""
+        for name, tlvtype in self.tail:
+            if fields.get(name) is not None and tlvtype is None:
+                return None
+
+        parts = [self.prefix]
+        for seg, st in zip(self.segments, self.structs):
+            if isinstance(seg, _Array):
+                val = fields[seg.name]
+                if seg.kind == "bytes":
+                    val = bytes(val)
+                    # Generic path gives the proper complaint.
+                    if seg.lenfield is None and len(val) != seg.count:
+                        return None
+                    parts.append(val)
+                else:
+                    parts.append(b"".join(v.to_bin() for v in val))
+                continue
+
+            assert st is not None
+            vals: List[Any] = []
+            for name, kind, size in seg.fields:
+                if kind == "len":
+                    lens = set(len(fields[lf]) for lf in seg.len_for[name])
+                    if len(lens) != 1:
+                        return None
+                    vals.append(lens.pop())
+                    continue
+                val = fields[name]
+                if kind == "int":
+                    vals.append(val)
+                elif kind == "sig":
+                    vals.append(val.to_bin())
+                else:
+                    # struct would silently pad or truncate these.
+                    val = bytes(val)
+                    if len(val) != size:
+                        return None
+                    vals.append(val)
+            parts.append(st.pack(*vals))
+
+        for name, tlvtype in self.tail:
+            if fields.get(name) and tlvtype is not None:
+                buf = io.BytesIO()
+                tlvtype.write(buf, fields[name], fields)
+                parts.append(buf.getvalue())
+        return b"".join(parts)
+
+    def decode(self, binmsg: Union[bytes, memoryview]) -> Optional[Message]:
+        """Message from binmsg (including type), or None if we need the
+        generic path.  Byte arrays are views into binmsg, not copies."""
+        view = memoryview(binmsg)
+        fields: Dict[str, Any] = {}
+        lens: Dict[str, int] = {}
+        off = 2
+        for seg, st in zip(self.segments, self.structs):
+            if isinstance(seg, _Array):
+                if seg.lenfield is None:
+                    n = seg.count
+                else:
+                    n = lens[seg.lenfield]
+                end = off + n * seg.elemsize
+                if end > len(view):
+                    return None
+                if seg.kind == "bytes":
+                    fields[seg.name] = ByteView(view[off:end])
+                else:
+                    fields[seg.name] = [
+                        Sig(view[i : i + 64].tobytes()) for i in range(off, end, 64)
+                    ]
+                off = end
+                continue
+
+            assert st is not None
+            if off + st.size > len(view):
+                return None
+            for (name, kind, _), val in zip(seg.fields, st.unpack_from(view, off)):
+                if kind == "len":
+                    lens[name] = val
+                elif kind == "sig":
+                    fields[name] = Sig(val)
+                else:
+                    fields[name] = val
+            off += st.size
+
+        if self.tail:
+            name, tlvtype = self.tail[0]
+            if tlvtype is not None:
+                # Just like pyln, an empty TLV stream reads as {}.
+                fields[name] = tlvtype.read(io.BytesIO(view[off:]), fields)
+            elif off != len(view):
+                # An optional field is there: let the generic code do it.
+                return None
+
+        # Message() would re-check every field; these are already good.
+        msg = Message.__new__(Message)
+        msg.messagetype = self.msgtype
+        msg.fields = fields
+        return msg
+
+
+def register_codec(msgtypename: str) -> None:
+    """Use a precompiled codec for this message type (by name)"""
+    _fast_msgtypes.add(msgtypename)
+
+
+def codec_for(msgtype: MessageType) -> Optional[MessageCodec]:
+    """The compiled codec for this message type, if any"""
+    if msgtype.name not in _fast_msgtypes:
+        return None
+    try:
+        return _codecs[msgtype]
+    except KeyError:
+        codec = MessageCodec.compile(msgtype)
+        _codecs[msgtype] = codec
+        return codec
+
+
+def encode_msg(msg: Message) -> bytes:
+    """Same as Message.write(), only faster for registered types"""
+    codec = codec_for(msg.messagetype)
+    if codec is not None:
+        try:
+            binmsg = codec.encode(msg.fields)
+        except (KeyError, TypeError, ValueError, AttributeError, struct.error):
+            binmsg = None
+        if binmsg is not None:
+            return binmsg
+
+    buf = io.BytesIO()
+    msg.write(buf)
+    return buf.getvalue()
+
+
+def decode_msg(
+    binmsg: Union[bytes, memoryview], ns: Optional[MessageNamespace] = None
+) -> Message:
+    """Same as Message.read(), only faster for registered types.
+
+    binmsg must not change afterwards: byte array fields refer to it."""
+    if ns is None:
+        ns = namespace()
+    if len(binmsg) >= 2:
+        mtype = ns.get_msgtype_by_number(struct.unpack_from(">H", binmsg)[0])
+        if mtype is not None:
+            codec = codec_for(mtype)
+            if codec is not None:
+                msg = codec.decode(binmsg)
+                if msg is not None:
+                    return msg
+    return Message.read(ns, io.BytesIO(binmsg))
+
+
+def _generic(binmsg: bytes) -> Message:
+    return Message.read(namespace(), io.BytesIO(binmsg))
+
+
+def _roundtrip(msgtypename: str, **kwargs: Any) -> None:
+    msg = Message(namespace().get_msgtype(msgtypename), **kwargs)
+    buf = io.BytesIO()
+    msg.write(buf)
+    assert codec_for(msg.messagetype) is not None
+    assert encode_msg(msg) == buf.getvalue()
+
+    fast = decode_msg(buf.getvalue())
+    slow = _generic(buf.getvalue())
+    assert fast.to_str() == slow.to_str()
+    assert fast.to_py() == slow.to_py()
+    assert fast.fields.keys() == slow.fields.keys()
+
+
+def test_codec_roundtrip() -> None:
+    _roundtrip("ping", num_pong_bytes=65531, ignored="00" * 1000)
+    _roundtrip("pong", ignored="")
+    _roundtrip(
+        "update_add_htlc",
+        channel_id="01" * 32,
+        id=7,
+        amount_msat=1000000,
+        payment_hash="02" * 32,
+        cltv_expiry=144,
+        onion_routing_packet="03" * 1366,
+    )
+    sig = Sig("01", "00" * 32)
+    _roundtrip(
+        "commitment_signed",
+        channel_id="01" * 32,
+        signature=sig,
+        htlc_signature=[sig, Sig("02", "00" * 32)],
+    )
+    _roundtrip(
+        "revoke_and_ack",
+        channel_id="01" * 32,
+        per_commitment_secret="04" * 32,
+        next_per_commitment_point="038f1573b4238a986470d250ce87c7a91257b6ba3baf2a0b14380c4e1e532c209d",
+    )
+
+
+def test_codec_views() -> None:
+    # Large payloads aren't copied, but still look like pyln's lists.
+    binmsg = bytes.fromhex("0013" + "0400" + "00" * 1020 + "ffeeddcc")
+    msg = decode_msg(binmsg)
+    ignored = msg.fields["ignored"]
+    assert isinstance(ignored, ByteView)
+    assert ignored._view.obj is binmsg
+    assert len(ignored) == 1024 and ignored[-1] == 0xCC and ignored[-2:] == [0xDD, 0xCC]
+    assert ignored == [0] * 1020 + [0xFF, 0xEE, 0xDD, 0xCC]
+    assert msg.to_py()["ignored"] == "00" * 1020 + "ffeeddcc"
+    assert encode_msg(msg) == binmsg
+    # A memoryview works too.
+    assert decode_msg(memoryview(binmsg)).fields["ignored"] == ignored
+
+    # TLVs are decoded (and encoded) by pyln, the rest by us.
+    _roundtrip(
+        "reply_channel_range",
+        chain_hash="06" * 32,
+        first_blocknum=103,
+        number_of_blocks=2,
+        sync_complete=1,
+        encoded_short_ids="00" + "0000670000010000" * 100,
+        tlvs="{timestamps_tlv={encoding_type=0,encoded_timestamps=" + "01" * 800 + "}}",
+    )
+
+
+def test_codec_fallback() -> None:
+    ns = namespace()
+    # Truncated: the generic path gives the usual error.
+    binmsg = encode_msg(Message(ns.get_msgtype("ping"), num_pong_bytes=1, ignored="00"))
+    try:
+        decode_msg(binmsg[:-1])
+        assert False, "decoded truncated ping"
+    except ValueError:
+        pass
+
+    # Wrong-sized field: generic path complains.
+    msg = Message(ns.get_msgtype("revoke_and_ack"))
+    msg.fields = {
+        "channel_id": bytes(32),
+        "per_commitment_secret": [0] * 31,
+        "next_per_commitment_point": bytes(33),
+    }
+    try:
+        encode_msg(msg)
+        assert False, "encoded short per_commitment_secret"
+    except ValueError:
+        pass
+
+    # A message with a TLV stream: absent, empty and present.
+    def fake(ftype: FieldType) -> Any:
+        if isinstance(ftype, SigType):
+            return Sig("01", "00" * 32)
+        if isinstance(ftype, IntegerType):
+            return 1
+        if isinstance(ftype, FundamentalHexType):
+            return bytes([2] * ftype.bytelen)
+        if isinstance(ftype, SizedArrayType):
+            return [3] * ftype.arraysize
+        return [4]
+
+    register_codec("open_channel")
+    try:
+        mtype = ns.get_msgtype("open_channel")
+        codec = codec_for(mtype)
+        assert codec is not None and codec.tail[0][1] is not None
+        fields = {
+            f.name: fake(f.fieldtype)
+            for f in mtype.fields
+            if not isinstance(f.fieldtype, (LengthFieldType, TlvStreamType))
+        }
+        for tlvs in (
+            None,
+            {},
+            {"upfront_shutdown_script": {"shutdown_scriptpubkey": [1]}},
+        ):
+            if tlvs is not None:
+                fields[codec.tail[0][0]] = tlvs
+            msg = Message(mtype, **fields)
+            buf = io.BytesIO()
+            msg.write(buf)
+            assert encode_msg(msg) == buf.getvalue()
+            assert (
+                decode_msg(buf.getvalue()).to_py() == _generic(buf.getvalue()).to_py()
+            )
+    finally:
+        _fast_msgtypes.discard("open_channel")
@@ -14,16 +14,23 @@ import bitcoin.core.script as script
 from bitcoin.core.script import CScript
 import struct
 from hashlib import sha256
-from .keyset import KeySet
+from .keyset import KeySet, ShachainReceiver
 from .errors import SpecFileError, EventError
 from .signature import Sig
-from typing import List, Tuple, Callable, Union, Optional, Dict
-from .event import Event, ResolvableInt, ResolvableStr, negotiated, msat
+from .sighash import signature_hash
+from .trace import Tracer, hexstr
+from typing import Any, List, Tuple, Callable, Union, Optional, Dict
+from .event import Event, ExpectMsg, ResolvableInt, ResolvableStr, negotiated, msat
 from .runner import Runner
 from .utils import Side, check_hex
 from .funding import Funding
 import coincurve
+import copy
+import functools
 import json
+from pyln.proto.message import Message
+
+tracer = Tracer(__name__)
 
 
 class HTLC(object):
@@ -104,6 +111,8 @@ class Commitment(object):
         self.dust_limit = (local_dust_limit, remote_dust_limit)
         self.htlcs: Dict[int, HTLC] = {}
         self.commitnum = 0
+        # Per-commitment secrets the remote has revealed in revoke_and_ack.
+        self.remote_secrets = ShachainReceiver()
         self.option_static_remotekey = option_static_remotekey
         self.option_anchor_outputs = option_anchor_outputs
         if self.option_anchor_outputs:
@@ -183,22 +192,25 @@ class Commitment(object):
             privkey = self._basepoint_tweak(
                 self.keyset[not side].payment_base_secret, side
             )
-            print(
-                "to-remote for side {}: self->payment = {} (local would be {}), per_commit_point = {}, keyset->self_payment_key = {}".format(
-                    side,
-                    coincurve.PublicKey.from_secret(
-                        self.keyset[not side].payment_base_secret.secret
-                    )
-                    .format()
-                    .hex(),
-                    coincurve.PublicKey.from_secret(
-                        self.keyset[Side.local].payment_base_secret.secret
-                    )
-                    .format()
-                    .hex(),
-                    self.keyset[side].per_commit_point(self.commitnum),
-                    coincurve.PublicKey.from_secret(privkey.secret).format().hex(),
+            tracer.debug(
+                "to-remote",
+                side=side,
+                self_payment=lambda: coincurve.PublicKey.from_secret(
+                    self.keyset[not side].payment_base_secret.secret
+                )
+                .format()
+                .hex(),
+                local_payment=lambda: coincurve.PublicKey.from_secret(
+                    self.keyset[Side.local].payment_base_secret.secret
                 )
+                .format()
+                .hex(),
+                per_commit_point=lambda: self.keyset[side].per_commit_point(
+                    self.commitnum
+                ),
+                self_payment_key=lambda: coincurve.PublicKey.from_secret(privkey.secret)
+                .format()
+                .hex(),
             )
         return coincurve.PublicKey.from_secret(privkey.secret)
 
@@ -232,6 +244,27 @@ class Commitment(object):
     def inc_commitnum(self) -> None:
         self.commitnum += 1
 
+    def __copy__(self) -> "Commitment":
+        """A Commitment which can progress independently of this one (the
+        funding and keysets don't change, so are shared)"""
+        ret = Commitment.__new__(Commitment)
+        ret.__dict__.update(self.__dict__)
+        ret.keyset = list(self.keyset)
+        ret.amounts = list(self.amounts)
+        ret.htlcs = dict(self.htlcs)
+        ret.remote_secrets = copy.copy(self.remote_secrets)
+        return ret
+
+    def state(self) -> Tuple[Any, ...]:
+        """Everything which changes as the channel progresses: resolver
+        results computed from a different state are stale"""
+        return (
+            self.commitnum,
+            self.feerate,
+            tuple(self.amounts),
+            tuple((k, id(v)) for k, v in self.htlcs.items()),
+        )
+
     def channel_id_v2(self) -> str:
         # BOLT-0eebb43e32a513f3b4dd9ced72ad1e915aefdd25 #2:
         #
@@ -650,11 +683,7 @@ class Commitment(object):
                 redeemscript, sats = self._offered_htlc_output(htlc, side)
             else:
                 redeemscript, sats = self._received_htlc_output(htlc, side)
-            print(
-                "*** Got htlc redeemscript {} / {}".format(
-                    redeemscript, redeemscript.hex()
-                )
-            )
+            tracer.debug("htlc output", redeemscript=hexstr(redeemscript))
             txouts.append(
                 (
                     CTxOut(sats, CScript([script.OP_0, sha256(redeemscript).digest()])),
@@ -794,7 +823,7 @@ class Commitment(object):
                 script.OP_CHECKSIG,
             ]
         )
-        print("htlc redeemscript = {}".format(redeemscript.hex()))
+        tracer.debug("htlc tx", redeemscript=hexstr(redeemscript))
         txout = CTxOut(
             amount_sat, CScript([script.OP_0, sha256(redeemscript).digest()])
         )
@@ -815,13 +844,12 @@ class Commitment(object):
         return self._unsigned_tx(Side.remote)[0]
 
     def _sig(self, privkey: coincurve.PrivateKey, tx: CMutableTransaction) -> Sig:
-        sighash = script.SignatureHash(
+        sighash = signature_hash(
             self.funding.redeemscript(),
             tx,
             inIdx=0,
             hashtype=script.SIGHASH_ALL,
             amount=self.funding.amount,
-            sigversion=script.SIGVERSION_WITNESS_V0,
         )
         return Sig(privkey.secret.hex(), sighash.hex())
 
@@ -829,15 +857,14 @@ class Commitment(object):
         return self._sig(self.funding.bitcoin_privkeys[Side.local], tx)
 
     def remote_sig(self, tx: CMutableTransaction) -> Sig:
-        print(
-            "Signing {} redeemscript keys {} and {}: {} amount = {}\ntx: {}".format(
-                Side.remote,
-                self.funding.funding_pubkey(Side.local).format().hex(),
-                self.funding.funding_pubkey(Side.remote).format().hex(),
-                self.funding.redeemscript().hex(),
-                self.funding.amount,
-                tx.serialize().hex(),
-            )
+        tracer.debug(
+            "signing",
+            side=Side.remote,
+            local_key=lambda: self.funding.funding_pubkey(Side.local).format().hex(),
+            remote_key=lambda: self.funding.funding_pubkey(Side.remote).format().hex(),
+            redeemscript=hexstr(self.funding.redeemscript()),
+            amount=self.funding.amount,
+            tx=hexstr(tx),
         )
         return self._sig(self.funding.bitcoin_privkeys[Side.remote], tx)
 
@@ -901,13 +928,12 @@ class Commitment(object):
             else:
                 hashtype = script.SIGHASH_ALL
 
-            sighash = script.SignatureHash(
+            sighash = signature_hash(
                 redeemscript,
                 htlc_tx,
                 inIdx=0,
                 hashtype=hashtype,
                 amount=sats,
-                sigversion=script.SIGVERSION_WITNESS_V0,
             )
             privkey = self._basepoint_tweak(self.keyset[signer].htlc_base_secret, side)
             sigs.append(Sig(privkey.secret.hex(), sighash.hex()))
@@ -918,13 +944,12 @@ class Commitment(object):
         # BOLT #3:
         # * `txin[0]` witness: `0 <signature_for_pubkey1> <signature_for_pubkey2>`
         tx = unsigned_tx.copy()
-        sighash = script.SignatureHash(
+        sighash = signature_hash(
             self.funding.redeemscript(),
             tx,
             inIdx=0,
             hashtype=script.SIGHASH_ALL,
             amount=self.funding.amount,
-            sigversion=script.SIGVERSION_WITNESS_V0,
         )
         sigs = [
             key.sign(sighash, hasher=None)
@@ -1067,6 +1092,25 @@ class UpdateCommit(Event):
         return True
 
 
+def _check_revealed_secret(
+    n: int, event: ExpectMsg, msg: Message, runner: Runner
+) -> None:
+    commit: Commitment = runner.get_stash(event, "Commit")
+    try:
+        commit.remote_secrets.add_per_commit_secret(
+            n, bytes(msg.fields["per_commitment_secret"])
+        )
+    except ValueError as ve:
+        raise EventError(event, "Bad per_commitment_secret: {}".format(ve))
+
+
+def check_revealed_secret(n: int) -> Callable[[ExpectMsg, Message, Runner], None]:
+    """if_match for a revoke_and_ack revealing the remote's secret for
+    commitment n: it must be consistent with every secret they revealed
+    before (and is remembered, in constant space, for the next)"""
+    return functools.partial(_check_revealed_secret, n)
+
+
 def test_commitment_number() -> None:
     # BOLT #3:
     # In the following:
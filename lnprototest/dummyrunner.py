@@ -1,10 +1,11 @@
 #! /usr/bin/python3
 # #### Dummy runner which you should replace with real one. ####
-import io
 from .runner import Runner, Conn
 from .event import Event, ExpectMsg, MustNotMsg
 from typing import List, Optional
 from .keyset import KeySet
+from .codec import encode_msg
+from .snapshot import RunnerSnapshot
 from pyln.proto.message import (
     Message,
     FieldType,
@@ -58,6 +59,11 @@ class DummyRunner(Runner):
             print("[RESTART]")
         self.blockheight = 102
 
+    def restore(self, event: Event, snapshot: RunnerSnapshot) -> bool:
+        super().restore(event, snapshot)
+        self.blockheight = snapshot.blockheight
+        return True
+
     def connect(self, event: Event, connprivkey: str) -> None:
         if self.config.getoption("verbose"):
             print("[CONNECT {} {}]".format(event, connprivkey))
@@ -185,9 +191,7 @@ class DummyRunner(Runner):
             ftype = msg.messagetype.find_field(m.name)
             msg.set_field(m.name, self.fake_field(ftype.fieldtype))
 
-        binmsg = io.BytesIO()
-        msg.write(binmsg)
-        return binmsg.getvalue()
+        return encode_msg(msg)
 
     def expect_tx(self, event: Event, txid: str) -> None:
         if self.config.getoption("verbose"):
@@ -3,7 +3,6 @@ import logging
 import traceback
 import collections
 import os.path
-import io
 import struct
 import time
 import json
@@ -14,16 +13,20 @@ from pyln.proto.message import Message
 
 from .errors import SpecFileError, EventError
 from .namespace import namespace
+from .codec import encode_msg, decode_msg
+from .msgstash import MsgStash
 from .signature import Sig
-from .bitfield import has_bit
+from .trace import Tracer, hexstr
+from .bitfield import FeatureBits
 from .utils import check_hex
-
-from bitcoin.core import CTransaction
+from .utils.bitcoin_utils import raw_txid
 
 if TYPE_CHECKING:
     # Otherwise a circular dependency
     from .runner import Runner, Conn
 
+tracer = Tracer(__name__)
+
 
 # Type for arguments: either strings, or functions to call at runtime
 ResolvableStr = Union[str, Callable[["Runner", "Event", str], str]]
@@ -57,12 +60,19 @@ class Event(object):
         """action() returns the False if it needs to be called again"""
         if runner.config.getoption("verbose"):
             logging.info("# running {}:".format(self.to_json()))
+        # Runner-alikes (e.g. in tests) may not memoize at all.
+        resolution = getattr(runner, "resolution", None)
+        if resolution is not None:
+            resolution.new_step()
         return True
 
     def resolve_arg(self, fieldname: str, runner: "Runner", arg: Resolvable) -> Any:
         """If this is a string, return it, otherwise call it to get result"""
         if callable(arg):
-            return arg(runner, self, fieldname)
+            resolution = getattr(runner, "resolution", None)
+            if resolution is None:
+                return arg(runner, self, fieldname)
+            return resolution.resolve(runner, self, fieldname, arg)
         else:
             return arg
 
@@ -150,7 +160,7 @@ class MustNotMsg(PerConnEvent):
             name = msgtype.name
         else:
             name = str(msgnum)
-        logging.debug(f"msg {name} != from what we are looking for {self.must_not}?")
+        tracer.debug("must_not check", msg=name, must_not=self.must_not)
         return name == self.must_not
 
     def action(self, runner: "Runner") -> bool:
@@ -194,9 +204,9 @@ class Msg(PerConnEvent):
         missing = message.missing_fields()
         if missing:
             raise SpecFileError(self, "Missing fields {}".format(missing))
-        binmsg = io.BytesIO()
-        message.write(binmsg)
-        runner.recv(self, self.find_conn(runner), binmsg.getvalue())
+        conn = self.find_conn(runner)
+        runner.latency.sent(conn, message.messagetype.name, time.perf_counter())
+        runner.recv(self, conn, encode_msg(message))
         msg_to_stash(runner, self, message)
         return True
 
@@ -229,9 +239,7 @@ class RawMsg(PerConnEvent):
         super().action(runner)
         msg = self.resolve_arg("binmsg", runner, self.message)
         if isinstance(msg, Message):
-            buf = io.BytesIO()
-            msg.write(buf)
-            binmsg = buf.getvalue()
+            binmsg = encode_msg(msg)
         else:
             binmsg = msg
 
@@ -275,7 +283,7 @@ class ExpectMsg(PerConnEvent):
         #  - MUST NOT set `ignored` to sensitive data such as secrets or
         #    portions of initialized
         outmsg = Message(
-            namespace().get_msgtype("pong"), ignored="00" * msg.fields["num_pong_bytes"]
+            namespace().get_msgtype("pong"), ignored=bytes(msg.fields["num_pong_bytes"])
         )
         return [outmsg]
 
@@ -334,6 +342,7 @@ class ExpectMsg(PerConnEvent):
 
         ret = cmp_msg(msg, partmessage)
         if ret is None:
+            runner.latency.matched(self.find_conn(runner), msg.messagetype.name)
             self.if_match(self, msg, runner)
             msg_to_stash(runner, self, msg)
         return ret
@@ -347,31 +356,33 @@ class ExpectMsg(PerConnEvent):
                 raise EventError(
                     self, f"Did not receive a message {self.msgtype} from runner"
                 )
+            runner.latency.arrived(conn)
 
             for e in conn.must_not_events:
                 if e.matches(binmsg):
                     raise EventError(
                         self, "Got msg banned by {}: {}".format(e, binmsg.hex())
                     )
-            logging.debug(f"raw msg {''.join('%02x' % b for b in binmsg)}")
+            tracer.debug("raw msg", hex=hexstr(binmsg))
+            if conn.respond(runner, self, binmsg):
+                continue
             # Might be completely unknown to namespace.
             try:
-                msg = Message.read(namespace(), io.BytesIO(binmsg))
-                runner.add_stash(msg.messagetype.name, msg)
+                msg = decode_msg(binmsg)
             except ValueError as ve:
                 raise EventError(
                     self, "Runner gave bad msg {}: {}".format(binmsg.hex(), ve)
                 )
-            logging.debug(f"decoded msg {msg.to_str()}")
+            tracer.debug("decoded msg", msg=msg.to_str)
             # Ignore function may tell us to respond.
             response = self.ignore(msg)
             if response is not None:
                 for msg in response:
-                    binm = io.BytesIO()
-                    msg.write(binm)
-                    runner.recv(self, conn, binm.getvalue())
+                    runner.recv(self, conn, encode_msg(msg))
                 continue
 
+            # Matching may look at it (e.g. stash_field_from_event()).
+            runner.add_stash(msg.messagetype.name, msg)
             err = self.message_match(runner, msg)
             if err:
                 raise EventError(self, "{}: message was {}".format(err, msg.to_str()))
@@ -483,7 +494,7 @@ class InitRbf(PerConnEvent):
     def action(self, runner: "Runner") -> bool:
         super().action(runner)
         utxo_tx = self.resolve_arg("utxo_tx", runner, self.utxo_tx)
-        txid = CTransaction.deserialize(bytes.fromhex(utxo_tx)).GetTxid()[::-1].hex()
+        txid = raw_txid(utxo_tx)[::-1].hex()
 
         runner.init_rbf(
             self,
@@ -554,13 +565,13 @@ class ExpectError(PerConnEvent):
             raise EventError(self, "No error found")
         if runner._is_dummy():
             return True
-        error = bytes.fromhex(error)
-        msg = Message.read(namespace(), io.BytesIO(error))
-        logging.info(f"message received {msg.messagetype.name}, hex {error.hex()}")
+        # error is already hex, so we don't need to re-encode it below.
+        msg = decode_msg(bytes.fromhex(error))
+        logging.info(f"message received {msg.messagetype.name}, hex {error}")
         if msg.messagetype.name not in "error":
             raise EventError(
                 self,
-                f"not error found but received `{msg.messagetype.name}` with hex: `{error.hex()}`",
+                f"not error found but received `{msg.messagetype.name}` with hex: `{error}`",
             )
         return True
 
@@ -624,12 +635,14 @@ class CloseChannel(Event):
 
 
 def msg_to_stash(runner: "Runner", event: Event, msg: Message) -> None:
-    """ExpectMsg and Msg save every field to the stash, in order"""
-    fields = msg.to_py()
-
-    stash = runner.get_stash(event, type(event).__name__, [])
-    stash.append((msg.messagetype.name, fields))
-    runner.add_stash(type(event).__name__, stash)
+    """ExpectMsg and Msg save every message to the stash, in order"""
+    stashname = type(event).__name__
+    stash: Optional[MsgStash] = runner.stash.get(stashname)
+    if stash is None:
+        stash = MsgStash(runner.stash_limit)
+        runner.add_stash(stashname, stash)
+    stash.append(msg)
+    runner.resolution.invalidate()
 
 
 def cmp_obj(obj: Any, expected: Any, prefix: str) -> Optional[str]:
@@ -669,8 +682,13 @@ def cmp_msg(msg: Message, expected: Message) -> Optional[str]:
     if msg.messagetype != expected.messagetype:
         return "Expected {}, got {}".format(expected.messagetype, msg.messagetype)
 
-    obj = msg.to_py()
     expected_obj = expected.to_py()
+    # Only convert (e.g. hex-encode) the fields we're going to compare.
+    obj = {}
+    for k in expected_obj:
+        if k in msg.fields:
+            field = msg.messagetype.find_field(k)
+            obj[k] = field.fieldtype.val_to_py(msg.fields[k], msg.fields)
 
     return cmp_obj(obj, expected_obj, expected.messagetype.name)
 
@@ -706,21 +724,20 @@ def negotiated(
     included: List[int] = [],
     excluded: List[int] = [],
 ) -> ResolvableBool:
-    def has_feature(fbit: int, featurebits: str) -> bool:
-        # Feature bits go in optional/compulsory pairs.
-        altfbit = fbit ^ 1
-        return has_bit(featurebits, fbit) or has_bit(featurebits, altfbit)
+    # Tuples, so identical negotiated() resolvers are memoized together.
+    incl, excl = tuple(included), tuple(excluded)
 
     def _negotiated(runner: "Runner", event: Event, field: str) -> bool:
-        a = event.resolve_arg("features", runner, a_features)
-        b = event.resolve_arg("features", runner, b_features)
+        a = FeatureBits(event.resolve_arg("features", runner, a_features))
+        b = FeatureBits(event.resolve_arg("features", runner, b_features))
 
-        for i in included:
-            if not has_feature(i, a) or not has_feature(i, b):
+        both = FeatureBits.negotiate(a, b)
+        for i in incl:
+            if not both.has_feature(i):
                 return False
 
-        for e in excluded:
-            if has_feature(e, a) or has_feature(e, b):
+        for e in excl:
+            if a.has_feature(e) or b.has_feature(e):
                 return False
 
         return True
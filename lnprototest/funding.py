@@ -1,19 +1,21 @@
 # Support for funding txs.
 import coincurve
 import io
-import logging
 
 from typing import Tuple, Any, Optional, Union, Callable, Dict, List
 
 from hashlib import sha256
 from pyln.proto.message import Message
 
+from .utils import bitcoin_utils
 from .utils.bitcoin_utils import BitcoinUtils
 from .utils import Side, privkey_expand
 from .event import Event, ResolvableInt, ResolvableStr
 from .namespace import namespace
 from .runner import Runner
 from .signature import Sig
+from .sighash import signature_hash
+from .trace import Tracer, hexstr
 
 import bitcoin.core.script as script
 from bitcoin.core import (
@@ -26,19 +28,39 @@ from bitcoin.core import (
     CTxInWitness,
     CScriptWitness,
     Hash160,
-    CTransaction,
 )
 from bitcoin.wallet import P2WPKHBitcoinAddress
 
 ResolvableFunding = Union["Funding", Callable[["Runner", "Event", str], "Funding"]]
 
+tracer = Tracer(__name__)
+
 
 def txid_raw(tx: str) -> str:
     """Helper to get the txid of a tx: note this is in wire protocol order, not bitcoin order!"""
-    return CTransaction.deserialize(bytes.fromhex(tx)).GetTxid().hex()
+    return bitcoin_utils.txid_raw(tx)
 
 
 class Funding(object):
+    # Stress tests open thousands of these, so keep them small.
+    __slots__ = (
+        "chain_hash",
+        "txid",
+        "output_index",
+        "amount",
+        "bitcoin_privkeys",
+        "node_privkeys",
+        "tx",
+        "locktime",
+        "outputs",
+        "inputs",
+        "_funding_pubkeys",
+        "_node_ids",
+        "_redeemscript",
+        "_locking_script",
+        "_channel_id",
+    )
+
     def __init__(
         self,
         funding_txid: str,
@@ -67,6 +89,16 @@ class Funding(object):
         self.locktime = locktime
         self.outputs: List[Dict[str, Any]] = []
         self.inputs: List[Dict[str, Any]] = []
+        self._funding_pubkeys: Optional[List[coincurve.PublicKey]] = None
+        self._node_ids: Optional[List[coincurve.PublicKey]] = None
+        self.invalidate()
+
+    def invalidate(self) -> None:
+        """Forget derived scripts and channel_id (e.g. tx was rebuilt)"""
+        self._redeemscript: Optional[CScript] = None
+        self._locking_script: Optional[CScript] = None
+        # (txid, output_index, channel_id)
+        self._channel_id: Optional[Tuple[str, int, str]] = None
 
     def tx_hex(self) -> str:
         if not self.tx:
@@ -119,8 +151,10 @@ class Funding(object):
         )
 
     def redeemscript(self) -> CScript:
-        key_a, key_b = self.funding_pubkeys_for_tx()
-        return self.redeemscript_keys(key_a, key_b)
+        if self._redeemscript is None:
+            key_a, key_b = self.funding_pubkeys_for_tx()
+            self._redeemscript = self.redeemscript_keys(key_a, key_b)
+        return self._redeemscript
 
     @staticmethod
     def locking_script_keys(
@@ -131,8 +165,11 @@ class Funding(object):
         )
 
     def locking_script(self) -> CScript:
-        a, b = self.funding_pubkeys_for_tx()
-        return self.locking_script_keys(a, b)
+        if self._locking_script is None:
+            self._locking_script = CScript(
+                [script.OP_0, sha256(self.redeemscript()).digest()]
+            )
+        return self._locking_script
 
     @staticmethod
     def start(
@@ -171,8 +208,10 @@ class Funding(object):
             return
 
         # Find the txid of the transaction
-        prev_tx = CTransaction.deserialize(bytes.fromhex(prevtx))
-        txin = CTxIn(COutPoint(prev_tx.GetTxid(), prevtx_vout), nSequence=sequence)
+        prev_tx = bitcoin_utils.parse_tx(prevtx)
+        txin = CTxIn(
+            COutPoint(bitcoin_utils.raw_txid(prevtx), prevtx_vout), nSequence=sequence
+        )
 
         # Get the previous output for its outscript + value
         prev_vout = prev_tx.vout[prevtx_vout]
@@ -201,13 +240,13 @@ class Funding(object):
                 continue
 
             wit = _in["sig"]
-            print("witness is ... ", wit)
+            tracer.debug("witness", wit=wit)
             elems = []
             for e in wit.scriptWitness.stack:
                 elems.append("{{witness={0}}}".format(e.hex()))
             witnesses.append("{{witness_element=[{0}]}}".format(",".join(elems)))
         val = "[{}]".format(",".join(witnesses))
-        print("witnesses are", val)
+        tracer.debug("witnesses", val=val)
         return val
 
     def sign_our_inputs(self) -> None:
@@ -216,7 +255,7 @@ class Funding(object):
             privkey = _in["privkey"]
 
             if privkey and "sig" not in _in:
-                print("signing our input for tx", self.tx.serialize().hex())
+                tracer.debug("signing our input", tx=hexstr(self.tx))
                 inkey = privkey_expand(privkey)
                 inkey_pub = coincurve.PublicKey.from_secret(inkey.secret)
 
@@ -235,13 +274,12 @@ class Funding(object):
                     )
                     redeemscript = address.to_redeemScript()
 
-                sighash = script.SignatureHash(
+                sighash = signature_hash(
                     redeemscript,
                     self.tx,
                     idx,
                     script.SIGHASH_ALL,
                     amount=_in["sats"],
-                    sigversion=script.SIGVERSION_WITNESS_V0,
                 )
                 sig = inkey.sign(sighash, hasher=None) + bytes([script.SIGHASH_ALL])
 
@@ -277,6 +315,7 @@ class Funding(object):
         return self.tx.serialize().hex()
 
     def build_tx(self) -> str:
+        self.invalidate()
         # Sort inputs/outputs by serial number
         self.inputs = sorted(self.inputs, key=lambda k: k["serial_id"])
         self.outputs = sorted(self.outputs, key=lambda k: k["serial_id"])
@@ -350,13 +389,12 @@ class Funding(object):
             CScript([script.OP_0, Hash160(inkey_pub.format())])
         )
 
-        sighash = script.SignatureHash(
+        sighash = signature_hash(
             address.to_redeemScript(),
             tx,
             0,
             script.SIGHASH_ALL,
             amount=sats,
-            sigversion=script.SIGVERSION_WITNESS_V0,
         )
         sig = inkey.sign(sighash, hasher=None) + bytes([script.SIGHASH_ALL])
 
@@ -368,17 +406,30 @@ class Funding(object):
         # channel. It's derived from the funding transaction by combining the
         # `funding_txid` and the `funding_output_index`, using big-endian
         # exclusive-OR (i.e. `funding_output_index` alters the last 2 bytes).
+        # txid and output_index are public, so check they haven't changed.
+        cached = self._channel_id
+        if (
+            cached is not None
+            and cached[0] == self.txid
+            and cached[1] == self.output_index
+        ):
+            return cached[2]
         chanid = bytearray.fromhex(self.txid)
         chanid[-1] ^= self.output_index % 256
         chanid[-2] ^= self.output_index // 256
-        return chanid.hex()
+        self._channel_id = (self.txid, self.output_index, chanid.hex())
+        return self._channel_id[2]
 
     @staticmethod
     def funding_pubkey_key(privkey: coincurve.PrivateKey) -> coincurve.PublicKey:
         return coincurve.PublicKey.from_secret(privkey.secret)
 
     def funding_pubkey(self, side: Side) -> coincurve.PublicKey:
-        return self.funding_pubkey_key(self.bitcoin_privkeys[side])
+        if self._funding_pubkeys is None:
+            self._funding_pubkeys = [
+                self.funding_pubkey_key(k) for k in self.bitcoin_privkeys
+            ]
+        return self._funding_pubkeys[side]
 
     def funding_pubkeys_for_tx(self) -> Tuple[coincurve.PublicKey, coincurve.PublicKey]:
         """Returns funding pubkeys, in tx order"""
@@ -409,7 +460,11 @@ class Funding(object):
         )
 
     def node_id(self, side: Side) -> coincurve.PublicKey:
-        return coincurve.PublicKey.from_secret(self.node_privkeys[side].secret)
+        if self._node_ids is None:
+            self._node_ids = [
+                coincurve.PublicKey.from_secret(k.secret) for k in self.node_privkeys
+            ]
+        return self._node_ids[side]
 
     def node_ids(self) -> Tuple[coincurve.PublicKey, coincurve.PublicKey]:
         """Returns node pubkeys, in order"""
@@ -619,13 +674,12 @@ class Funding(object):
         )
 
         tx = CMutableTransaction(vin=[txin], vout=[txout])
-        sighash = script.SignatureHash(
+        sighash = signature_hash(
             self.redeemscript(),
             tx,
             inIdx=0,
             hashtype=script.SIGHASH_ALL,
             amount=self.amount,
-            sigversion=script.SIGVERSION_WITNESS_V0,
         )
 
         sigs = [
@@ -869,7 +923,7 @@ class FinalizeFunding(Event):
         tx = funding.build_tx()
         funding.sign_our_inputs()
         # FIXME: sanity checks?
-        logging.debug(f"finalized funding {tx}")
+        tracer.debug("finalized funding", tx=tx)
         return True
 
 
@@ -894,3 +948,28 @@ class AddWitnesses(Event):
         tx_hex = funding.add_witnesses(wit_stack)
         runner.add_stash("FundingTx", tx_hex)
         return True
+
+
+def test_funding_cache() -> None:
+    funding = Funding(
+        funding_txid="00" * 32,
+        funding_output_index=0,
+        funding_amount=10000,
+        local_node_privkey="02",
+        local_funding_privkey="10",
+        remote_node_privkey="03",
+        remote_funding_privkey="20",
+    )
+    assert funding.redeemscript() is funding.redeemscript()
+    assert funding.locking_script() == Funding.locking_script_keys(
+        *funding.funding_pubkeys_for_tx()
+    )
+
+    assert funding.channel_id() == "00" * 32
+    # Stale channel_id would be wrong after these change.
+    funding.txid = "11" * 32
+    funding.output_index = 1
+    assert funding.channel_id() == "11" * 31 + "10"
+
+    # No per-instance __dict__.
+    assert not hasattr(funding, "__dict__")
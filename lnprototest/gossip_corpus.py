@@ -0,0 +1,551 @@
+#! /usr/bin/python3
+# Lots of valid gossip, fast.
+#
+# Funding.channel_announcement() and friends build a Message, serialize it
+# to hash it, and sign when it's written: fine for one channel, hopeless for
+# a hundred thousand.  Here we pack the (fixed-layout) BOLT #7 messages
+# directly, sign them in a process pool, and cache the result on disk keyed
+# by the parameters, so a gossip-ingest test only pays once.
+#
+# Every channel has its own funding keys and a real funding output: tx k
+# funds channels k * MAX_OUTPUTS_PER_TX onwards, each tx spends the change of
+# the one before, and each is mined alone in its own block, so channel i's
+# short_channel_id is (blockheight + k)x1x(i % MAX_OUTPUTS_PER_TX).
+import coincurve
+import functools
+import json
+import logging
+import os
+import struct
+import tempfile
+import time
+from concurrent import futures
+from hashlib import sha256
+from multiprocessing import get_context
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import bitcoin.core.script as script
+from bitcoin.core import (
+    COutPoint,
+    CScript,
+    CTxIn,
+    CTxOut,
+    CMutableTransaction,
+    CTxWitness,
+    CTxInWitness,
+    CScriptWitness,
+    Hash160,
+)
+from bitcoin.wallet import P2WPKHBitcoinAddress
+
+from .event import Block, Event, PerConnEvent
+from .gossip_query import scid_to_str
+from .runner import Runner
+from .sighash import signature_hash
+from .utils import privkey_expand
+from .utils.bitcoin_utils import BitcoinUtils, utxo
+
+# Bump this if the generated messages change.
+CORPUS_VERSION = 1
+# Keeps each funding tx well under the 400k weight standardness limit.
+MAX_OUTPUTS_PER_TX = 2000
+# Channels per process pool task.
+CHUNK = 500
+# Plenty over minrelaytxfee.
+FEERATE_PER_VBYTE = 2
+
+MSG_CHANNEL_ANNOUNCEMENT = 256
+MSG_NODE_ANNOUNCEMENT = 257
+MSG_CHANNEL_UPDATE = 258
+
+
+def cache_dir() -> str:
+    return os.getenv(
+        "LNPROTOTEST_GOSSIP_CACHE",
+        os.path.join(tempfile.gettempdir(), "lnprototest-gossip"),
+    )
+
+
+def _params_key(params: Dict[str, Any]) -> str:
+    return sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def _privkey(seed: str, tag: str, index: int) -> coincurve.PrivateKey:
+    return coincurve.PrivateKey(
+        sha256("{}/{}/{}".format(seed, tag, index).encode()).digest()
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _node_key(seed: str, index: int) -> Tuple[coincurve.PrivateKey, bytes]:
+    key = _privkey(seed, "node", index)
+    return key, key.public_key.format()
+
+
+def _sign(privkey: coincurve.PrivateKey, signed_part: bytes) -> bytes:
+    """64-byte signature of the double-SHA256 of signed_part"""
+    h = sha256(sha256(signed_part).digest()).digest()
+    # Same (RFC6979) signature as sign(), without the DER round trip.
+    return privkey.sign_recoverable(h, hasher=None)[:64]
+
+
+def _scid(params: Dict[str, Any], channel: int) -> int:
+    block = params["blockheight"] + channel // MAX_OUTPUTS_PER_TX
+    return block << 40 | 1 << 16 | channel % MAX_OUTPUTS_PER_TX
+
+
+def _channel_nodes(params: Dict[str, Any], channel: int) -> Tuple[int, int]:
+    """Which two (distinct) nodes this channel joins"""
+    nodes = params["nodes"]
+    a = channel % nodes
+    b = (a + 1 + (channel // nodes) % (nodes - 1)) % nodes
+    return a, b
+
+
+def _funding_script(key_a: bytes, key_b: bytes) -> bytes:
+    """P2WSH of 2-of-2 multisig, keys in lexicographical order"""
+    k1, k2 = sorted((key_a, key_b))
+    redeemscript = b"\x52\x21" + k1 + b"\x21" + k2 + b"\x52\xae"
+    return b"\x00\x20" + sha256(redeemscript).digest()
+
+
+def _channel_update(
+    params: Dict[str, Any], scid: int, direction: int, key: coincurve.PrivateKey
+) -> bytes:
+    # BOLT #7:
+    # - MUST set `signature` to the signature of the double-SHA256 of the
+    #   entire remaining packet after `signature`, using its own `node_id`.
+    body = bytes.fromhex(params["chain_hash"]) + struct.pack(
+        ">QIBBHQIIQ",
+        scid,
+        params["timestamp"],
+        # must_be_one
+        1,
+        direction,
+        params["cltv_expiry_delta"],
+        0,
+        params["fee_base_msat"],
+        params["fee_proportional_millionths"],
+        params["capacity"] * 1000,
+    )
+    return struct.pack(">H", MSG_CHANNEL_UPDATE) + _sign(key, body) + body
+
+
+def _sign_channels(
+    params: Dict[str, Any], first: int, last: int
+) -> List[Tuple[bytes, bytes, bytes, bytes]]:
+    """funding script, channel_announcement and both channel_updates for
+    channels first to last-1 (runs in the pool)"""
+    ret = []
+    seed = params["seed"]
+    for channel in range(first, last):
+        scid = _scid(params, channel)
+        # (node privkey, node_id, funding privkey) for each end.
+        nodes = [
+            _node_key(seed, n) + (_privkey(seed, "funding-{}".format(n), channel),)
+            for n in _channel_nodes(params, channel)
+        ]
+        # BOLT #7:
+        # - MUST set `node_id_1` and `node_id_2` to the public keys of the two
+        #   nodes operating the channel, such that `node_id_1` is the
+        #   lexicographically-lesser of the two compressed keys sorted in
+        #   ascending lexicographic order.
+        (node1, nodeid1, fund1), (node2, nodeid2, fund2) = sorted(
+            nodes, key=lambda n: n[1]
+        )
+        fundkey1 = fund1.public_key.format()
+        fundkey2 = fund2.public_key.format()
+        # Empty features.
+        body = (
+            b"\x00\x00"
+            + bytes.fromhex(params["chain_hash"])
+            + struct.pack(">Q", scid)
+            + nodeid1
+            + nodeid2
+            + fundkey1
+            + fundkey2
+        )
+        # BOLT #7:
+        # - MUST compute the double-SHA256 hash `h` of the message, beginning
+        #   at offset 256, up to the end of the message.
+        sigs = b"".join(_sign(k, body) for k in (node1, node2, fund1, fund2))
+        ann = struct.pack(">H", MSG_CHANNEL_ANNOUNCEMENT) + sigs + body
+        ret.append(
+            (
+                _funding_script(fundkey1, fundkey2),
+                ann,
+                _channel_update(params, scid, 0, node1),
+                _channel_update(params, scid, 1, node2),
+            )
+        )
+    return ret
+
+
+def _sign_nodes(params: Dict[str, Any], first: int, last: int) -> List[bytes]:
+    ret = []
+    for n in range(first, last):
+        key, nodeid = _node_key(params["seed"], n)
+        alias = "lnprototest-{}".format(n).encode().ljust(32, b"\0")
+        # Empty features, and no addresses.
+        body = (
+            b"\x00\x00"
+            + struct.pack(">I", params["timestamp"])
+            + nodeid
+            + struct.pack(">I", n)[1:]
+            + alias
+            + b"\x00\x00"
+        )
+        ret.append(struct.pack(">H", MSG_NODE_ANNOUNCEMENT) + _sign(key, body) + body)
+    return ret
+
+
+def _funding_txs(params: Dict[str, Any], scripts: List[bytes]) -> List[str]:
+    """Chain of txs paying to scripts, each spending the last one's change"""
+    txid, txout, sats, privkey, _ = utxo(params["utxo"])
+    inkey = privkey_expand(privkey)
+    inkey_pub = coincurve.PublicKey.from_secret(inkey.secret).format()
+    p2wpkh = CScript([script.OP_0, Hash160(inkey_pub)])
+    prevout = COutPoint(bytes.fromhex(txid), txout)
+
+    txs = []
+    for first in range(0, len(scripts), MAX_OUTPUTS_PER_TX):
+        outs = [
+            CTxOut(params["capacity"], CScript(s))
+            for s in scripts[first : first + MAX_OUTPUTS_PER_TX]
+        ]
+        # Generous vsize estimate: one P2WPKH in, P2WSH outs and change.
+        fee = FEERATE_PER_VBYTE * (11 + 68 + 43 * len(outs) + 31)
+        change = sats - fee - params["capacity"] * len(outs)
+        if change < 1000:
+            raise ValueError(
+                "utxo {} can't fund {} channels of {} sats".format(
+                    params["utxo"], len(scripts), params["capacity"]
+                )
+            )
+        tx = CMutableTransaction(
+            [CTxIn(prevout)], outs + [CTxOut(change, p2wpkh)], nVersion=2
+        )
+        sighash = signature_hash(
+            P2WPKHBitcoinAddress.from_scriptPubKey(p2wpkh).to_redeemScript(),
+            tx,
+            0,
+            script.SIGHASH_ALL,
+            amount=sats,
+        )
+        sig = inkey.sign(sighash, hasher=None) + bytes([script.SIGHASH_ALL])
+        tx.wit = CTxWitness([CTxInWitness(CScriptWitness([sig, inkey_pub]))])
+        txs.append(tx.serialize().hex())
+        prevout = COutPoint(tx.GetTxid(), len(outs))
+        sats = change
+    return txs
+
+
+class GossipCorpus(object):
+    """channels synthetic channels between (up to) nodes nodes, with their
+    funding txs, channel_announcements, channel_updates and
+    node_announcements.
+
+    The funding txs spend utxo(utxo_index) from tx_spendable, which must already
+    be mined; mine them with block_events().
+    """
+
+    def __init__(
+        self,
+        channels: int,
+        nodes: int = 100,
+        blockheight: int = 103,
+        capacity: int = 20000,
+        timestamp: Optional[int] = None,
+        seed: str = "lnprototest",
+        utxo_index: int = 4,
+        chain_hash: str = BitcoinUtils.blockchain_hash(),
+        processes: Optional[int] = None,
+        cache: bool = True,
+    ):
+        if timestamp is None:
+            # Today, so the cache lasts a day but the node won't think
+            # the updates are stale.
+            timestamp = int(time.time()) // 86400 * 86400
+        self.params: Dict[str, Any] = {
+            "version": CORPUS_VERSION,
+            "channels": channels,
+            "nodes": max(2, min(nodes, channels + 1)),
+            "blockheight": blockheight,
+            "capacity": capacity,
+            "timestamp": timestamp,
+            "seed": seed,
+            "utxo": utxo_index,
+            "chain_hash": chain_hash,
+            "cltv_expiry_delta": 144,
+            "fee_base_msat": 1000,
+            "fee_proportional_millionths": 10,
+        }
+        self.txs: List[str] = []
+        self.channel_announcements: List[bytes] = []
+        # Two per channel, direction 0 then 1.
+        self.channel_updates: List[bytes] = []
+        self.node_announcements: List[bytes] = []
+
+        # Named <everything but timestamp>-<everything>, so a new day's
+        # corpus can replace the last one.
+        self.cachefile = os.path.join(
+            cache_dir(),
+            "{}-{}.gossip".format(
+                _params_key({**self.params, "timestamp": None})[:16],
+                _params_key(self.params),
+            ),
+        )
+        if cache and self._load():
+            return
+        start = time.perf_counter()
+        self._generate(processes)
+        logging.info(
+            "Generated {} channels in {:.1f}s".format(
+                channels, time.perf_counter() - start
+            )
+        )
+        if cache:
+            self._save()
+
+    def _generate(self, processes: Optional[int]) -> None:
+        channels = self.params["channels"]
+        nodes = self.params["nodes"]
+        chunks = [
+            (first, min(first + CHUNK, channels)) for first in range(0, channels, CHUNK)
+        ]
+        nodechunks = [
+            (first, min(first + CHUNK, nodes)) for first in range(0, nodes, CHUNK)
+        ]
+        if processes is None:
+            processes = os.cpu_count() or 1
+        processes = min(processes, len(chunks))
+
+        if processes <= 1:
+            results = [_sign_channels(self.params, *c) for c in chunks]
+            nodeanns = [_sign_nodes(self.params, *c) for c in nodechunks]
+        else:
+            # Not fork: the runner may have threads (and sockets) about.
+            with futures.ProcessPoolExecutor(
+                processes, mp_context=get_context("spawn")
+            ) as pool:
+                chanfuts = [
+                    pool.submit(_sign_channels, self.params, *c) for c in chunks
+                ]
+                nodefuts = [
+                    pool.submit(_sign_nodes, self.params, *c) for c in nodechunks
+                ]
+                results = [f.result() for f in chanfuts]
+                nodeanns = [f.result() for f in nodefuts]
+
+        scripts = []
+        for result in results:
+            for funding_script, ann, update1, update2 in result:
+                scripts.append(funding_script)
+                self.channel_announcements.append(ann)
+                self.channel_updates += [update1, update2]
+        self.node_announcements = [ann for chunk in nodeanns for ann in chunk]
+        self.txs = _funding_txs(self.params, scripts)
+
+    def _save(self) -> None:
+        """A JSON header line, then the messages, each with a u16 length"""
+        os.makedirs(cache_dir(), exist_ok=True)
+        tmpname = self.cachefile + ".{}".format(os.getpid())
+        with open(tmpname, "wb") as f:
+            f.write(json.dumps({"params": self.params, "txs": self.txs}).encode())
+            f.write(b"\n")
+            for msg in self._all_messages():
+                f.write(struct.pack(">H", len(msg)) + msg)
+        os.replace(tmpname, self.cachefile)
+
+        # Older timestamps of this corpus are never used again.
+        family = os.path.basename(self.cachefile).split("-")[0] + "-"
+        for name in os.listdir(cache_dir()):
+            path = os.path.join(cache_dir(), name)
+            if (
+                name.startswith(family)
+                and name.endswith(".gossip")
+                and path != self.cachefile
+            ):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def _load(self) -> bool:
+        try:
+            with open(self.cachefile, "rb") as f:
+                header = json.loads(f.readline())
+                buf = f.read()
+        except (OSError, ValueError):
+            return False
+        if header["params"] != self.params:
+            return False
+
+        msgs = []
+        off = 0
+        while off < len(buf):
+            (msglen,) = struct.unpack_from(">H", buf, off)
+            msgs.append(buf[off + 2 : off + 2 + msglen])
+            off += 2 + msglen
+        channels = self.params["channels"]
+        if len(msgs) != 3 * channels + self.params["nodes"]:
+            return False
+        self.txs = header["txs"]
+        self.channel_announcements = msgs[:channels]
+        self.channel_updates = msgs[channels : 3 * channels]
+        self.node_announcements = msgs[3 * channels :]
+        return True
+
+    def _all_messages(self) -> Iterator[bytes]:
+        yield from self.channel_announcements
+        yield from self.channel_updates
+        yield from self.node_announcements
+
+    def short_channel_ids(self) -> List[str]:
+        return [
+            scid_to_str(_scid(self.params, c)) for c in range(self.params["channels"])
+        ]
+
+    def messages(self) -> Iterator[bytes]:
+        """In an order the node will accept: each channel_announcement and
+        its updates, then node_announcements (once nodes have channels)"""
+        for i, ann in enumerate(self.channel_announcements):
+            yield ann
+            yield self.channel_updates[2 * i]
+            yield self.channel_updates[2 * i + 1]
+        yield from self.node_announcements
+
+    def block_events(self, confirmations: int = 6) -> List[Event]:
+        """Mine each funding tx in its own block, then bury the lot deep
+        enough to announce"""
+        events: List[Event] = [
+            Block(blockheight=self.params["blockheight"] + i, txs=[tx])
+            for i, tx in enumerate(self.txs)
+        ]
+        events.append(
+            Block(
+                blockheight=self.params["blockheight"] + len(self.txs),
+                number=confirmations - 1,
+            )
+        )
+        return events
+
+
+class GossipFlood(PerConnEvent):
+    """Send all of a GossipCorpus, as fast as the runner takes it.  Stashes
+    "GossipFlood" with the counts and time taken."""
+
+    def __init__(self, corpus: GossipCorpus, connprivkey: Optional[str] = None):
+        super().__init__(connprivkey)
+        self.corpus = corpus
+
+    def action(self, runner: Runner) -> bool:
+        super().action(runner)
+        conn = self.find_conn(runner)
+        count = 0
+        nbytes = 0
+        start = time.perf_counter()
+        for msg in self.corpus.messages():
+            runner.recv(self, conn, msg)
+            count += 1
+            nbytes += len(msg)
+        elapsed = time.perf_counter() - start
+        runner.add_stash(
+            "GossipFlood",
+            {
+                "messages": count,
+                "bytes": nbytes,
+                "seconds": elapsed,
+                "msgs_per_sec": count / elapsed if elapsed else 0.0,
+            },
+        )
+        return True
+
+
+def test_gossip_corpus() -> None:
+    import io
+    from pyln.proto.message import Message
+
+    from .codec import encode_msg
+    from .funding import Funding
+    from .namespace import namespace
+    from .utils import Side
+
+    old_dir = os.environ.get("LNPROTOTEST_GOSSIP_CACHE")
+    with tempfile.TemporaryDirectory() as d:
+        os.environ["LNPROTOTEST_GOSSIP_CACHE"] = d
+        try:
+            corpus = GossipCorpus(5, nodes=3, timestamp=1700000000, processes=1)
+            # Second time comes from the cache.
+            again = GossipCorpus(5, nodes=3, timestamp=1700000000)
+            assert os.listdir(d) == [os.path.basename(corpus.cachefile)]
+            # A new timestamp replaces the old file; other corpora stay.
+            other = GossipCorpus(6, nodes=3, timestamp=1700000000, processes=1)
+            newer = GossipCorpus(5, nodes=3, timestamp=1700086400, processes=1)
+            assert sorted(os.listdir(d)) == sorted(
+                [os.path.basename(other.cachefile), os.path.basename(newer.cachefile)]
+            )
+        finally:
+            if old_dir is None:
+                del os.environ["LNPROTOTEST_GOSSIP_CACHE"]
+            else:
+                os.environ["LNPROTOTEST_GOSSIP_CACHE"] = old_dir
+    assert list(again.messages()) == list(corpus.messages())
+    assert again.txs == corpus.txs and len(corpus.txs) == 1
+    assert corpus.short_channel_ids() == ["103x1x{}".format(i) for i in range(5)]
+    assert len(corpus.node_announcements) == 3
+
+    # Byte-identical to what Funding makes the slow way.
+    seed = corpus.params["seed"]
+    a, b = _channel_nodes(corpus.params, 1)
+    funding = Funding(
+        "",
+        0,
+        20000,
+        _node_key(seed, a)[0].secret.hex(),
+        _privkey(seed, "funding-{}".format(a), 1).secret.hex(),
+        _node_key(seed, b)[0].secret.hex(),
+        _privkey(seed, "funding-{}".format(b), 1).secret.hex(),
+    )
+    assert (
+        encode_msg(funding.channel_announcement("103x1x1", ""))
+        == corpus.channel_announcements[1]
+    )
+    # Direction 0 is from node_id_1.
+    side = Side.local
+    if funding.node_ids()[0] != funding.node_id(Side.local):
+        side = Side.remote
+    update = funding.channel_update(
+        "103x1x1",
+        side,
+        disable=False,
+        cltv_expiry_delta=144,
+        htlc_minimum_msat=0,
+        fee_base_msat=1000,
+        fee_proportional_millionths=10,
+        timestamp=1700000000,
+        htlc_maximum_msat=20000000,
+    )
+    assert encode_msg(update) == corpus.channel_updates[2]
+
+    # Funding outputs are where the scids say.
+    tx = CMutableTransaction.deserialize(bytes.fromhex(corpus.txs[0]))
+    assert tx.vout[1].scriptPubKey == funding.locking_script()
+    assert tx.vout[1].nValue == 20000 and len(tx.vout) == 6
+
+    nodeann = Message.read(namespace(), io.BytesIO(corpus.node_announcements[0]))
+    assert nodeann.fields["timestamp"] == 1700000000
+
+
+def test_gossip_corpus_pool() -> None:
+    # Several txs, signed in the pool.
+    corpus = GossipCorpus(
+        MAX_OUTPUTS_PER_TX + 1, nodes=50, timestamp=1700000000, processes=2, cache=False
+    )
+    assert len(corpus.txs) == 2
+    assert corpus.short_channel_ids()[-1] == "104x1x0"
+    tx2 = CMutableTransaction.deserialize(bytes.fromhex(corpus.txs[1]))
+    tx1 = CMutableTransaction.deserialize(bytes.fromhex(corpus.txs[0]))
+    assert tx2.vin[0].prevout == COutPoint(tx1.GetTxid(), MAX_OUTPUTS_PER_TX)
+    assert len(list(corpus.messages())) == 3 * (MAX_OUTPUTS_PER_TX + 1) + 50
+    assert [type(e) for e in corpus.block_events()] == [Block] * 3
@@ -0,0 +1,645 @@
+#! /usr/bin/python3
+# Encoders and decoders for gossip query payloads, a whole array at a time.
+#
+# reply_channel_range can carry thousands of short_channel_ids (plus a
+# timestamp pair and a checksum pair for each), and going through pyln's
+# per-field types one scid at a time is slow enough to dominate a
+# large-graph test.  These work on arrays instead.
+import itertools
+import struct
+import sys
+import time
+import zlib
+from array import array
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, TYPE_CHECKING
+
+import crc32c
+from pyln.proto.message import Message
+
+from .codec import decode_msg, encode_msg
+from .errors import EventError
+from .event import ExpectMsg, PerConnEvent
+from .namespace import namespace
+from .utils.bitcoin_utils import BitcoinUtils
+
+if TYPE_CHECKING:
+    # Otherwise a circular dependency
+    from .runner import Runner, Conn
+
+# BOLT #7:
+# Encoding types:
+# * `0`: uncompressed array of `short_channel_id` types, in ascending
+#   order.
+# * `1`: array of `short_channel_id` types, in ascending order, compressed
+#   with zlib deflate<sup>[1](#reference-1)</sup>
+ENCODING_UNCOMPRESSED = 0
+ENCODING_ZLIB = 1
+
+# Refuse to inflate more than this (a 64k message can deflate to a lot).
+MAX_INFLATE = 8 * 1024 * 1024
+
+MSG_REPLY_CHANNEL_RANGE = 264
+# Uncompressed scids which fit in a 65535-byte reply_channel_range.
+MAX_SCIDS_PER_REPLY = 8000
+
+
+def scid_from_str(scid: str) -> int:
+    block, tx, out = scid.split("x")
+    return int(block) << 40 | int(tx) << 16 | int(out)
+
+
+def scid_to_str(scid: int) -> str:
+    return "{}x{}x{}".format(scid >> 40, (scid >> 16) & 0xFFFFFF, scid & 0xFFFF)
+
+
+def _big_endian(arr: array) -> array:
+    if sys.byteorder == "little":
+        arr.byteswap()
+    return arr
+
+
+def _inflate(data: bytes, limit: int = MAX_INFLATE) -> bytes:
+    d = zlib.decompressobj()
+    try:
+        out = d.decompress(data, limit)
+        if d.unconsumed_tail:
+            raise ValueError("Inflates to more than {} bytes".format(limit))
+        return out + d.flush()
+    except zlib.error as e:
+        raise ValueError("Bad zlib data: {}".format(e)) from e
+
+
+def _payload(encoding_type: int, data: bytes) -> bytes:
+    if encoding_type == ENCODING_UNCOMPRESSED:
+        return data
+    if encoding_type == ENCODING_ZLIB:
+        return _inflate(data)
+    raise ValueError("Unknown encoding type {}".format(encoding_type))
+
+
+def _encode(encoding_type: int, payload: bytes) -> bytes:
+    if encoding_type == ENCODING_UNCOMPRESSED:
+        return payload
+    if encoding_type == ENCODING_ZLIB:
+        return zlib.compress(payload)
+    raise ValueError("Unknown encoding type {}".format(encoding_type))
+
+
+def encode_scids(scids: Iterable[int], encoding_type: int = 0) -> bytes:
+    """encoded_short_ids (including the encoding type byte)"""
+    payload = _big_endian(array("Q", scids)).tobytes()
+    return bytes([encoding_type]) + _encode(encoding_type, payload)
+
+
+def decode_scids(encoded: bytes) -> array:
+    """Array of short_channel_ids from encoded_short_ids"""
+    if len(encoded) == 0:
+        raise ValueError("Empty encoded_short_ids")
+    payload = _payload(encoded[0], encoded[1:])
+    if len(payload) % 8 != 0:
+        raise ValueError("{} bytes of short_channel_ids".format(len(payload)))
+    return _big_endian(array("Q", payload))
+
+
+def is_ascending(arr: Sequence[int]) -> bool:
+    return all(a < b for a, b in zip(arr, arr[1:]))
+
+
+def encode_u32_pairs(pairs: Iterable[Tuple[int, int]], encoding_type: int = 0) -> bytes:
+    """Raw (or deflated) array of pairs of u32: channel_update_timestamps
+    and channel_update_checksums are both this"""
+    arr = array("I")
+    for a, b in pairs:
+        arr.append(a)
+        arr.append(b)
+    return _encode(encoding_type, _big_endian(arr).tobytes())
+
+
+def decode_u32_pairs(data: bytes, encoding_type: int = 0) -> List[Tuple[int, int]]:
+    payload = _payload(encoding_type, data)
+    if len(payload) % 8 != 0:
+        raise ValueError("{} bytes of u32 pairs".format(len(payload)))
+    arr = _big_endian(array("I", payload))
+    return list(zip(arr[0::2], arr[1::2]))
+
+
+def update_checksum(update: bytes) -> int:
+    """Checksum of a channel_update (as sent, including type)"""
+    # BOLT #7: The checksum of a `channel_update` is the CRC32C checksum as
+    # specified in [RFC3720](https://tools.ietf.org/html/rfc3720#appendix-B.4)
+    # of this `channel_update` without its `signature` and `timestamp` fields.
+    #
+    # Note: 2 bytes for `type` field, then signature, chain_hash, scid, timestamp.
+    return crc32c.crc32c(
+        update[2 + 64 : 2 + 64 + 32 + 8] + update[2 + 64 + 32 + 8 + 4 :]
+    )
+
+
+def paginate(scids: Sequence[int], limit: int = MAX_SCIDS_PER_REPLY) -> List[List[int]]:
+    """Split ascending scids into pages of at most limit, keeping each
+    block's scids together (a block alone may exceed limit)"""
+    pages: List[List[int]] = [[]]
+    for _, group in itertools.groupby(scids, key=lambda scid: scid >> 40):
+        blockscids = list(group)
+        if pages[-1] and len(pages[-1]) + len(blockscids) > limit:
+            pages.append([])
+        pages[-1] += blockscids
+    return pages
+
+
+def _bigsize(buf: bytes, off: int) -> Tuple[int, int]:
+    first = buf[off]
+    if first < 0xFD:
+        return first, off + 1
+    width = {0xFD: 2, 0xFE: 4, 0xFF: 8}[first]
+    return int.from_bytes(buf[off + 1 : off + 1 + width], "big"), off + 1 + width
+
+
+def _to_bigsize(n: int) -> bytes:
+    if n < 0xFD:
+        return bytes([n])
+    for prefix, width in ((0xFD, 2), (0xFE, 4), (0xFF, 8)):
+        if n < 1 << (8 * width):
+            return bytes([prefix]) + n.to_bytes(width, "big")
+    raise ValueError("{} too large for bigsize".format(n))
+
+
+def decode_tlvs(buf: bytes, off: int) -> Dict[int, bytes]:
+    """The TLV stream from buf[off:], by type"""
+    tlvs: Dict[int, bytes] = {}
+    while off < len(buf):
+        tlvtype, off = _bigsize(buf, off)
+        tlvlen, off = _bigsize(buf, off)
+        if off + tlvlen > len(buf):
+            raise ValueError("Truncated tlv {}".format(tlvtype))
+        tlvs[tlvtype] = buf[off : off + tlvlen]
+        off += tlvlen
+    return tlvs
+
+
+def encode_tlv(tlvtype: int, value: bytes) -> bytes:
+    return _to_bigsize(tlvtype) + _to_bigsize(len(value)) + value
+
+
+def encode_query_flags(flags: Iterable[int], encoding_type: int = 0) -> bytes:
+    """encoded_query_flags (including the encoding type byte)"""
+    payload = b"".join(_to_bigsize(f) for f in flags)
+    return bytes([encoding_type]) + _encode(encoding_type, payload)
+
+
+def decode_query_flags(encoded: bytes) -> List[int]:
+    if len(encoded) == 0:
+        raise ValueError("Empty encoded_query_flags")
+    payload = _payload(encoded[0], encoded[1:])
+    flags = []
+    off = 0
+    try:
+        while off < len(payload):
+            flag, off = _bigsize(payload, off)
+            flags.append(flag)
+    except (IndexError, KeyError):
+        raise ValueError("Truncated encoded_query_flags")
+    return flags
+
+
+class ReplyChannelRange(object):
+    """The parts of a reply_channel_range we check, parsed straight from
+    the wire"""
+
+    __slots__ = (
+        "chain_hash",
+        "first_blocknum",
+        "number_of_blocks",
+        "sync_complete",
+        "encoded_short_ids",
+        "tlvs",
+    )
+
+    def __init__(self, binmsg: bytes):
+        (msgtype,) = struct.unpack_from(">H", binmsg)
+        if msgtype != MSG_REPLY_CHANNEL_RANGE:
+            raise ValueError("Not a reply_channel_range: {}".format(msgtype))
+        self.chain_hash = binmsg[2:34].hex()
+        (
+            self.first_blocknum,
+            self.number_of_blocks,
+            self.sync_complete,
+            idlen,
+        ) = struct.unpack_from(">IIBH", binmsg, 34)
+        off = 34 + 11
+        self.encoded_short_ids = binmsg[off : off + idlen]
+        if len(self.encoded_short_ids) != idlen:
+            raise ValueError("Truncated encoded_short_ids")
+        self.tlvs = decode_tlvs(binmsg, off + idlen)
+
+    def scids(self) -> array:
+        return decode_scids(self.encoded_short_ids)
+
+    def timestamps(self) -> Optional[List[Tuple[int, int]]]:
+        tlv = self.tlvs.get(1)
+        if tlv is None:
+            return None
+        return decode_u32_pairs(tlv[1:], tlv[0])
+
+    def checksums(self) -> Optional[List[Tuple[int, int]]]:
+        tlv = self.tlvs.get(3)
+        if tlv is None:
+            return None
+        return decode_u32_pairs(tlv)
+
+
+class QueryChannelRange(PerConnEvent):
+    """Send query_channel_range, and collect and check every
+    reply_channel_range until they cover the range.  If expect_scids is
+    given, the replies must contain exactly those: if some are missing,
+    query again for up to wait seconds.  Stashes "QueryChannelRange" with
+    counts and timings of the last query."""
+
+    def __init__(
+        self,
+        first_blocknum: int,
+        number_of_blocks: int,
+        expect_scids: Optional[Sequence[str]] = None,
+        query_option_flags: int = 0,
+        wait: int = 0,
+        connprivkey: Optional[str] = None,
+    ):
+        super().__init__(connprivkey)
+        self.wait = wait
+        self.first_blocknum = first_blocknum
+        self.number_of_blocks = number_of_blocks
+        self.expect_scids = expect_scids
+        self.query_option_flags = query_option_flags
+
+    def _dummy_replies(self, connprivkey: str) -> List[ExpectMsg]:
+        """What the DummyRunner should make up: the expected scids, in
+        whole blocks, as many as fit in each reply"""
+        pages = paginate(sorted(scid_from_str(s) for s in self.expect_scids or []))
+
+        replies = []
+        first = self.first_blocknum
+        for i, page in enumerate(pages):
+            if i + 1 < len(pages):
+                end = pages[i + 1][0] >> 40
+            else:
+                end = self.first_blocknum + self.number_of_blocks
+            encoded = encode_scids(page)
+            tlvs = []
+            if self.query_option_flags & 1:
+                tlvs.append(
+                    "timestamps_tlv={{encoding_type=0,encoded_timestamps={}}}".format(
+                        bytes(8 * len(page)).hex()
+                    )
+                )
+            if self.query_option_flags & 2:
+                tlvs.append(
+                    "checksums_tlv={{checksums=[{}]}}".format(
+                        ",".join(
+                            ["{checksum_node_id_1=0,checksum_node_id_2=0}"] * len(page)
+                        )
+                    )
+                )
+            replies.append(
+                ExpectMsg(
+                    "reply_channel_range",
+                    connprivkey=connprivkey,
+                    chain_hash=BitcoinUtils.blockchain_hash(),
+                    first_blocknum=first,
+                    number_of_blocks=end - first,
+                    sync_complete=1,
+                    encoded_short_ids=encoded.hex(),
+                    tlvs="{" + ",".join(tlvs) + "}",
+                )
+            )
+            first = end
+        return replies
+
+    def _check_reply(
+        self,
+        reply: ReplyChannelRange,
+        prev_end: Optional[int],
+        prev_scid: int,
+    ) -> array:
+        if reply.chain_hash != BitcoinUtils.blockchain_hash():
+            raise EventError(self, "Wrong chain_hash {}".format(reply.chain_hash))
+        # BOLT #7:
+        # - the first `reply_channel_range` message:
+        #   - MUST set `first_blocknum` less than or equal to the
+        #     `first_blocknum` in `query_channel_range`
+        #   - MUST set `first_blocknum` plus `number_of_blocks` greater than
+        #     `first_blocknum` in `query_channel_range`.
+        # - successive `reply_channel_range` message:
+        #   - MUST have `first_blocknum` equal or greater than the previous
+        #     `first_blocknum`.
+        if prev_end is None:
+            if not (
+                reply.first_blocknum
+                <= self.first_blocknum
+                < reply.first_blocknum + reply.number_of_blocks
+            ):
+                raise EventError(
+                    self,
+                    "First reply {}+{} doesn't cover {}".format(
+                        reply.first_blocknum,
+                        reply.number_of_blocks,
+                        self.first_blocknum,
+                    ),
+                )
+        elif reply.first_blocknum != prev_end:
+            raise EventError(
+                self,
+                "Reply starts at {}, previous ended at {}".format(
+                    reply.first_blocknum, prev_end
+                ),
+            )
+        try:
+            scids = reply.scids()
+        except ValueError as ve:
+            raise EventError(self, "Bad encoded_short_ids: {}".format(ve))
+        if len(scids):
+            lo, hi = scids[0] >> 40, scids[-1] >> 40
+            if (
+                lo < reply.first_blocknum
+                or hi >= reply.first_blocknum + reply.number_of_blocks
+            ):
+                raise EventError(
+                    self,
+                    "scids {} to {} outside reply {}+{}".format(
+                        scid_to_str(scids[0]),
+                        scid_to_str(scids[-1]),
+                        reply.first_blocknum,
+                        reply.number_of_blocks,
+                    ),
+                )
+            if scids[0] <= prev_scid or not is_ascending(scids):
+                raise EventError(self, "scids not in ascending order")
+
+        try:
+            for name, wanted, vals in (
+                ("timestamps", 1, reply.timestamps()),
+                ("checksums", 2, reply.checksums()),
+            ):
+                if self.query_option_flags & wanted and vals is None:
+                    raise EventError(self, "Reply missing {}".format(name))
+                if vals is not None and len(vals) != len(scids):
+                    raise EventError(
+                        self,
+                        "{} {} for {} scids".format(len(vals), name, len(scids)),
+                    )
+        except ValueError as ve:
+            raise EventError(self, "Bad tlvs: {}".format(ve))
+        return scids
+
+    def _query(
+        self, runner: "Runner", conn: "Conn", dummies: List[ExpectMsg]
+    ) -> Tuple[int, array, float, float]:
+        """One query: number of replies, all the scids, seconds until the
+        last reply, seconds spent checking"""
+        query: Dict[str, Any] = {
+            "chain_hash": BitcoinUtils.blockchain_hash(),
+            "first_blocknum": self.first_blocknum,
+            "number_of_blocks": self.number_of_blocks,
+        }
+        if self.query_option_flags:
+            query["tlvs"] = "{{query_option={{query_option_flags={}}}}}".format(
+                self.query_option_flags
+            )
+        start = time.perf_counter()
+        runner.recv(
+            self,
+            conn,
+            encode_msg(
+                Message(namespace().get_msgtype("query_channel_range"), **query)
+            ),
+        )
+        # BOLT #7:
+        # - the final `reply_channel_range` message:
+        #   - MUST have `first_blocknum` plus `number_of_blocks` equal or
+        #     greater than the `query_channel_range` `first_blocknum` plus
+        #     `number_of_blocks`.
+        # Though implementations have stopped at their tip, so allow that.
+        end = min(
+            self.first_blocknum + self.number_of_blocks, runner.getblockheight() + 1
+        )
+        replies = 0
+        validate = 0.0
+        prev_end: Optional[int] = None
+        allscids = array("Q")
+        while prev_end is None or prev_end < end:
+            expect = dummies[min(replies, len(dummies) - 1)]
+            binmsg = runner.get_output_message(conn, expect)
+            if binmsg is None:
+                raise EventError(
+                    self, "No reply_channel_range after {} replies".format(replies)
+                )
+            if struct.unpack_from(">H", binmsg) != (MSG_REPLY_CHANNEL_RANGE,):
+                self._not_reply(runner, conn, binmsg)
+                continue
+            t = time.perf_counter()
+            try:
+                reply = ReplyChannelRange(binmsg)
+            except (ValueError, KeyError, struct.error) as e:
+                raise EventError(self, "Bad reply_channel_range: {}".format(e))
+            allscids += self._check_reply(
+                reply, prev_end, allscids[-1] if allscids else -1
+            )
+            prev_end = reply.first_blocknum + reply.number_of_blocks
+            replies += 1
+            validate += time.perf_counter() - t
+        return replies, allscids, time.perf_counter() - start, validate
+
+    def action(self, runner: "Runner") -> bool:
+        super().action(runner)
+        conn = self.find_conn(runner)
+        dummies = self._dummy_replies(conn.name)
+        expected = None
+        if self.expect_scids is not None:
+            expected = array("Q", sorted(scid_from_str(s) for s in self.expect_scids))
+
+        deadline = time.monotonic() + self.wait
+        attempts = 0
+        while True:
+            attempts += 1
+            replies, allscids, elapsed, validate = self._query(runner, conn, dummies)
+            if expected is None or allscids == expected:
+                break
+            missing = set(expected) - set(allscids)
+            extra = set(allscids) - set(expected)
+            # Still digesting what we sent it?
+            if not extra and time.monotonic() < deadline:
+                time.sleep(1)
+                continue
+            raise EventError(
+                self,
+                "Got {} scids, expected {}: missing {} extra {}".format(
+                    len(allscids),
+                    len(expected),
+                    [scid_to_str(s) for s in sorted(missing)[:5]],
+                    [scid_to_str(s) for s in sorted(extra)[:5]],
+                ),
+            )
+
+        runner.add_stash(
+            "QueryChannelRange",
+            {
+                "attempts": attempts,
+                "replies": replies,
+                "scids": len(allscids),
+                "seconds": elapsed,
+                "validate_seconds": validate,
+            },
+        )
+        return True
+
+    def _not_reply(self, runner: "Runner", conn: "Conn", binmsg: bytes) -> None:
+        if conn.respond(runner, self, binmsg):
+            return
+        try:
+            msg = decode_msg(binmsg)
+        except ValueError as ve:
+            raise EventError(
+                self, "Runner gave bad msg {}: {}".format(binmsg.hex(), ve)
+            )
+        response = ExpectMsg.ignore_all_gossip(msg)
+        if response is None:
+            raise EventError(
+                self, "Expected reply_channel_range, got {}".format(msg.to_str())
+            )
+        for m in response:
+            runner.recv(self, conn, encode_msg(m))
+
+
+def test_codecs() -> None:
+    scids = [scid_from_str(s) for s in ("103x1x0", "103x1x1", "16777215x3x65535")]
+    assert scid_to_str(scids[2]) == "16777215x3x65535"
+    for enc in (ENCODING_UNCOMPRESSED, ENCODING_ZLIB):
+        encoded = encode_scids(scids, enc)
+        assert encoded[0] == enc
+        assert list(decode_scids(encoded)) == scids
+    assert encode_scids(scids)[1:9] == bytes.fromhex("0000670000010000")
+    assert list(decode_scids(b"\x00")) == []
+    assert is_ascending(scids) and not is_ascending(scids[::-1])
+
+    flags = [1, 0xFC, 0xFD, 1 << 32]
+    for enc in (ENCODING_UNCOMPRESSED, ENCODING_ZLIB):
+        assert decode_query_flags(encode_query_flags(flags, enc)) == flags
+    tlvs = encode_tlv(1, b"a") + encode_tlv(300, bytes(300))
+    assert decode_tlvs(tlvs, 0) == {1: b"a", 300: bytes(300)}
+
+    pairs = [(1, 2), (0xFFFFFFFF, 0)]
+    assert encode_u32_pairs(pairs) == bytes.fromhex("0000000100000002ffffffff00000000")
+    assert decode_u32_pairs(encode_u32_pairs(pairs, 1), 1) == pairs
+
+    for bad in (b"", b"\x02", b"\x00" + bytes(7), b"\x01notzlib"):
+        try:
+            decode_scids(bad)
+            assert False, "decoded {!r}".format(bad)
+        except ValueError:
+            pass
+    try:
+        decode_query_flags(b"\x01notzlib")
+        assert False, "decoded bad query_flags"
+    except ValueError:
+        pass
+    try:
+        decode_u32_pairs(b"notzlib", 1)
+        assert False, "decoded bad pairs"
+    except ValueError:
+        pass
+    # A deflate bomb.
+    try:
+        _inflate(zlib.compress(bytes(1000)), limit=100)
+        assert False, "inflated past limit"
+    except ValueError:
+        pass
+
+
+def test_reply_channel_range() -> None:
+    from .codec import encode_msg
+
+    ts = [(1700000000, 0), (5, 6)]
+    msg = Message(
+        namespace().get_msgtype("reply_channel_range"),
+        chain_hash=BitcoinUtils.blockchain_hash(),
+        first_blocknum=103,
+        number_of_blocks=7,
+        sync_complete=1,
+        encoded_short_ids=encode_scids(
+            [scid_from_str("103x1x0"), scid_from_str("109x1x0")]
+        ).hex(),
+        tlvs="{{timestamps_tlv={{encoding_type=1,encoded_timestamps={}}},"
+        "checksums_tlv={{checksums=[{{checksum_node_id_1=1,checksum_node_id_2=2}},"
+        "{{checksum_node_id_1=3,checksum_node_id_2=4}}]}}}}".format(
+            encode_u32_pairs(ts, 1).hex()
+        ),
+    )
+    reply = ReplyChannelRange(encode_msg(msg))
+    assert (reply.first_blocknum, reply.number_of_blocks, reply.sync_complete) == (
+        103,
+        7,
+        1,
+    )
+    assert [scid_to_str(s) for s in reply.scids()] == ["103x1x0", "109x1x0"]
+    assert reply.timestamps() == ts
+    assert reply.checksums() == [(1, 2), (3, 4)]
+
+
+def test_query_channel_range_dummy() -> None:
+    """Loopback through the DummyRunner: how fast we check replies"""
+    from .dummyrunner import DummyRunner
+    from .event import Block, Connect
+
+    class config(object):
+        def getoption(self, name: str) -> Any:
+            return False
+
+    # 20 blocks of 2000 channels, as GossipCorpus makes.
+    scids = [
+        scid_to_str(block << 40 | 1 << 16 | out)
+        for block in range(103, 123)
+        for out in range(2000)
+    ]
+    runner = DummyRunner(config())
+    runner.run(
+        [
+            Block(blockheight=103, number=97),
+            Connect(connprivkey="03"),
+            QueryChannelRange(
+                0, 200, expect_scids=scids, query_option_flags=1, connprivkey="03"
+            ),
+        ]
+    )
+    results = runner.stash["QueryChannelRange"]
+    # Whole blocks per reply: 3 of 4 blocks, then the rest.
+    assert results["replies"] == 5 and results["scids"] == 40000
+
+    # The checks themselves.
+    q = QueryChannelRange(103, 7)
+
+    def reply(first: int, num: int, scids: List[str]) -> ReplyChannelRange:
+        return ReplyChannelRange(
+            struct.pack(">H", MSG_REPLY_CHANNEL_RANGE)
+            + bytes.fromhex(BitcoinUtils.blockchain_hash())
+            + struct.pack(">IIB", first, num, 1)
+            + struct.pack(">H", 1 + 8 * len(scids))
+            + encode_scids(scid_from_str(s) for s in scids)
+        )
+
+    assert len(q._check_reply(reply(100, 5, ["103x1x0"]), None, -1)) == 1
+    for bad, prev_end, prev_scid in (
+        # Doesn't include first_blocknum.
+        (reply(104, 5, []), None, -1),
+        # Gap.
+        (reply(106, 5, []), 105, -1),
+        # scid outside the reply's range.
+        (reply(105, 2, ["107x1x0"]), 105, -1),
+        # Descending.
+        (reply(105, 2, ["106x1x0", "105x1x0"]), 105, -1),
+        # Repeats the last reply's.
+        (reply(105, 2, ["105x1x0"]), 105, scid_from_str("105x1x0")),
+    ):
+        try:
+            q._check_reply(bad, prev_end, prev_scid)
+            assert False, "accepted {}".format(bad.first_blocknum)
+        except EventError:
+            pass
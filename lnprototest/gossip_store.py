@@ -0,0 +1,669 @@
+#! /usr/bin/python3
+# A stand-in peer with a whole graph to sync from.
+#
+# ExpectMsg.ignore_gossip_queries drops the node's gossip queries on the
+# floor, so a node syncing from us learns nothing.  A GossipStore holds the
+# graph indexed by short_channel_id (hence block) and by timestamp; attach
+# one to a Conn with ServeGossip and the node's gossip_timestamp_filter,
+# query_channel_range and query_short_channel_ids get real answers (built
+# straight on the wire, zlib-encoded) whatever event happens to be reading.
+# ExpectGossipSync then times how long the node takes to fetch it all.
+import bisect
+import struct
+import time
+from array import array
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TYPE_CHECKING,
+)
+
+from pyln.proto.message import Message
+
+from .codec import decode_msg, encode_msg
+from .errors import EventError
+from .event import ExpectMsg, PerConnEvent
+from .gossip_corpus import (
+    GossipCorpus,
+    MSG_CHANNEL_ANNOUNCEMENT,
+    MSG_CHANNEL_UPDATE,
+    MSG_NODE_ANNOUNCEMENT,
+)
+from .gossip_query import (
+    ENCODING_ZLIB,
+    MAX_SCIDS_PER_REPLY,
+    MSG_REPLY_CHANNEL_RANGE,
+    _bigsize,
+    decode_query_flags,
+    decode_scids,
+    decode_tlvs,
+    encode_scids,
+    encode_tlv,
+    encode_u32_pairs,
+    paginate,
+    update_checksum,
+)
+from .namespace import namespace
+from .utils.bitcoin_utils import BitcoinUtils
+
+if TYPE_CHECKING:
+    # Otherwise a circular dependency
+    from .runner import Runner, Conn
+
+MSG_PONG = 19
+MSG_QUERY_SHORT_CHANNEL_IDS = 261
+MSG_REPLY_SHORT_CHANNEL_IDS_END = 262
+MSG_QUERY_CHANNEL_RANGE = 263
+MSG_GOSSIP_TIMESTAMP_FILTER = 265
+
+# BOLT #7 query_flags:
+# | 0 | `QUERY_FLAG_CHANNEL_ANNOUNCEMENT` |
+# | 1 | `QUERY_FLAG_CHANNEL_UPDATE_1` |
+# | 2 | `QUERY_FLAG_CHANNEL_UPDATE_2` |
+# | 3 | `QUERY_FLAG_NODE_ANNOUNCEMENT_1` |
+# | 4 | `QUERY_FLAG_NODE_ANNOUNCEMENT_2` |
+QUERY_FLAGS_ALL = 0x1F
+
+# Room for the fixed fields and tlv headers of a reply_channel_range.
+REPLY_SPACE = 65000
+
+
+def _announcement_scid(ann: bytes) -> int:
+    # type, 4 signatures, features, chain_hash, then short_channel_id.
+    (flen,) = struct.unpack_from(">H", ann, 2 + 4 * 64)
+    (scid,) = struct.unpack_from(">Q", ann, 2 + 4 * 64 + 2 + flen + 32)
+    return scid
+
+
+def _announcement_node_ids(ann: bytes) -> Tuple[bytes, bytes]:
+    (flen,) = struct.unpack_from(">H", ann, 2 + 4 * 64)
+    off = 2 + 4 * 64 + 2 + flen + 32 + 8
+    return ann[off : off + 33], ann[off + 33 : off + 66]
+
+
+def _update_timestamp(update: bytes) -> int:
+    # type, signature, chain_hash, short_channel_id, then timestamp.
+    (timestamp,) = struct.unpack_from(">I", update, 2 + 64 + 32 + 8)
+    return timestamp
+
+
+def _node_announcement_fields(ann: bytes) -> Tuple[int, bytes]:
+    """timestamp and node_id"""
+    (flen,) = struct.unpack_from(">H", ann, 2 + 64)
+    (timestamp,) = struct.unpack_from(">I", ann, 2 + 64 + 2 + flen)
+    off = 2 + 64 + 2 + flen + 4
+    return timestamp, ann[off : off + 33]
+
+
+class GossipStore(object):
+    """Channels and nodes, indexed by short_channel_id and by timestamp.
+    Only the latest channel_update (per direction) and node_announcement
+    are kept.  Messages are raw, as sent (including type)."""
+
+    def __init__(self, chain_hash: str = BitcoinUtils.blockchain_hash()):
+        self.chain_hash = bytes.fromhex(chain_hash)
+        # scid -> [channel_announcement, update for direction 0, direction 1]
+        self.channels: Dict[int, List[Optional[bytes]]] = {}
+        # node_id -> node_announcement
+        self.nodes: Dict[bytes, bytes] = {}
+        # Built on demand, after add().
+        self._dirty = False
+        self._scids = array("Q")
+        self._update_times: List[int] = []
+        self._updates: List[Tuple[int, bytes]] = []
+        self._node_times: List[int] = []
+        self._node_anns: List[bytes] = []
+
+    @classmethod
+    def from_corpus(cls, corpus: GossipCorpus) -> "GossipStore":
+        store = cls(corpus.params["chain_hash"])
+        store.add_all(corpus.messages())
+        return store
+
+    def add(self, msg: bytes) -> None:
+        """Add a channel_announcement, channel_update (after its
+        channel_announcement) or node_announcement"""
+        (msgtype,) = struct.unpack_from(">H", msg)
+        if msgtype == MSG_CHANNEL_ANNOUNCEMENT:
+            scid = _announcement_scid(msg)
+            self.channels.setdefault(scid, [None, None, None])[0] = msg
+        elif msgtype == MSG_CHANNEL_UPDATE:
+            (scid,) = struct.unpack_from(">Q", msg, 2 + 64 + 32)
+            chan = self.channels.get(scid)
+            if chan is None:
+                raise ValueError("channel_update for unknown channel {}".format(scid))
+            # channel_flags bit 0 is the direction.
+            direction = 1 + (msg[2 + 64 + 32 + 8 + 4 + 1] & 1)
+            old = chan[direction]
+            if old is None or _update_timestamp(old) < _update_timestamp(msg):
+                chan[direction] = msg
+        elif msgtype == MSG_NODE_ANNOUNCEMENT:
+            timestamp, node_id = _node_announcement_fields(msg)
+            old = self.nodes.get(node_id)
+            if old is None or _node_announcement_fields(old)[0] < timestamp:
+                self.nodes[node_id] = msg
+        else:
+            raise ValueError("Not gossip: type {}".format(msgtype))
+        self._dirty = True
+
+    def add_all(self, msgs: Iterable[bytes]) -> None:
+        for msg in msgs:
+            self.add(msg)
+
+    def _index(self) -> None:
+        if not self._dirty:
+            return
+        self._scids = array("Q", sorted(self.channels))
+        updates = sorted(
+            (_update_timestamp(u), scid, u)
+            for scid, chan in self.channels.items()
+            for u in chan[1:]
+            if u is not None
+        )
+        self._update_times = [u[0] for u in updates]
+        self._updates = [(u[1], u[2]) for u in updates]
+        nodes = sorted(
+            (_node_announcement_fields(ann)[0], node_id, ann)
+            for node_id, ann in self.nodes.items()
+        )
+        self._node_times = [n[0] for n in nodes]
+        self._node_anns = [n[2] for n in nodes]
+        self._dirty = False
+
+    def short_channel_ids(self) -> array:
+        """All of them, ascending"""
+        self._index()
+        return self._scids
+
+    def scids_in_blocks(self, first_blocknum: int, number_of_blocks: int) -> array:
+        self._index()
+        lo = bisect.bisect_left(self._scids, first_blocknum << 40)
+        hi = bisect.bisect_left(self._scids, (first_blocknum + number_of_blocks) << 40)
+        return self._scids[lo:hi]
+
+    def between(self, first_timestamp: int, timestamp_range: int) -> List[bytes]:
+        """Everything with a timestamp in [first_timestamp, first_timestamp
+        + timestamp_range), in an order the node will accept"""
+        self._index()
+        end = first_timestamp + timestamp_range
+        # BOLT #7:
+        # - MUST consider the `timestamp` of the `channel_announcement` to be
+        #   the `timestamp` of a corresponding `channel_update`.
+        # - MUST consider whether to send the `channel_announcement` after
+        #   receiving the first corresponding `channel_update`.
+        lo = bisect.bisect_left(self._update_times, first_timestamp)
+        hi = bisect.bisect_left(self._update_times, end)
+        msgs: List[bytes] = []
+        announced: Set[int] = set()
+        for scid, update in self._updates[lo:hi]:
+            if scid not in announced:
+                announced.add(scid)
+                ann = self.channels[scid][0]
+                assert ann is not None
+                msgs.append(ann)
+            msgs.append(update)
+        # node_announcements last, once the node knows their channels.
+        lo = bisect.bisect_left(self._node_times, first_timestamp)
+        hi = bisect.bisect_left(self._node_times, end)
+        return msgs + self._node_anns[lo:hi]
+
+    def _timestamps(self, scid: int) -> Tuple[int, int]:
+        chan = self.channels[scid]
+        return (
+            _update_timestamp(chan[1]) if chan[1] else 0,
+            _update_timestamp(chan[2]) if chan[2] else 0,
+        )
+
+    def _checksums(self, scid: int) -> Tuple[int, int]:
+        chan = self.channels[scid]
+        return (
+            update_checksum(chan[1]) if chan[1] else 0,
+            update_checksum(chan[2]) if chan[2] else 0,
+        )
+
+    def reply_channel_range(
+        self,
+        first_blocknum: int,
+        number_of_blocks: int,
+        query_option_flags: int = 0,
+        encoding_type: int = ENCODING_ZLIB,
+        sync_complete: bool = True,
+    ) -> List[bytes]:
+        """reply_channel_range messages covering the range contiguously,
+        whole blocks in each (empty, if not sync_complete)"""
+        end = first_blocknum + number_of_blocks
+        scids: Sequence[int] = []
+        if sync_complete:
+            scids = self.scids_in_blocks(first_blocknum, number_of_blocks)
+        per_scid = 8 * (1 + bool(query_option_flags & 1) + bool(query_option_flags & 2))
+        pages = paginate(scids, min(MAX_SCIDS_PER_REPLY, REPLY_SPACE // per_scid))
+
+        replies = []
+        first = first_blocknum
+        for i, page in enumerate(pages):
+            if i + 1 < len(pages):
+                pageend = pages[i + 1][0] >> 40
+            else:
+                pageend = end
+            encoded = encode_scids(page, encoding_type)
+            tlvs = b""
+            if query_option_flags & 1:
+                tlvs += encode_tlv(
+                    1,
+                    bytes([encoding_type])
+                    + encode_u32_pairs(
+                        (self._timestamps(s) for s in page), encoding_type
+                    ),
+                )
+            if query_option_flags & 2:
+                tlvs += encode_tlv(
+                    3, encode_u32_pairs(self._checksums(s) for s in page)
+                )
+            replies.append(
+                struct.pack(">H", MSG_REPLY_CHANNEL_RANGE)
+                + self.chain_hash
+                + struct.pack(
+                    ">IIBH", first, pageend - first, sync_complete, len(encoded)
+                )
+                + encoded
+                + tlvs
+            )
+            first = pageend
+        return replies
+
+    def reply_short_channel_ids(
+        self, scids: Iterable[int], query_flags: Optional[List[int]] = None
+    ) -> Tuple[List[int], List[bytes]]:
+        """The scids we know, and the messages for them (not including
+        reply_short_channel_ids_end)"""
+        served = []
+        msgs = []
+        sent_nodes: Set[bytes] = set()
+        for i, scid in enumerate(scids):
+            chan = self.channels.get(scid)
+            if chan is None:
+                continue
+            ann = chan[0]
+            assert ann is not None
+            flags = QUERY_FLAGS_ALL if query_flags is None else query_flags[i]
+            if flags & 1:
+                msgs.append(ann)
+            for bit, update in ((2, chan[1]), (4, chan[2])):
+                if flags & bit and update is not None:
+                    msgs.append(update)
+            # BOLT #7:
+            # - SHOULD avoid sending duplicate `node_announcements` in
+            #   response to a single `query_short_channel_ids`.
+            for bit, node_id in zip((8, 16), _announcement_node_ids(ann)):
+                nodeann = self.nodes.get(node_id)
+                if flags & bit and nodeann is not None and node_id not in sent_nodes:
+                    sent_nodes.add(node_id)
+                    msgs.append(nodeann)
+            served.append(scid)
+        return served, msgs
+
+
+class GossipResponder(object):
+    """Answers one conn's gossip queries from a GossipStore, and counts
+    what it served"""
+
+    def __init__(self, store: GossipStore, encoding_type: int = ENCODING_ZLIB):
+        self.store = store
+        self.encoding_type = encoding_type
+        self.attached = time.perf_counter()
+        self.first_query: Optional[float] = None
+        self.queries = {
+            "gossip_timestamp_filter": 0,
+            "query_channel_range": 0,
+            "query_short_channel_ids": 0,
+        }
+        self.replies = 0
+        self.reply_bytes = 0
+        # Channels whose channel_announcement we've sent.
+        self.served: Set[int] = set()
+
+    def __call__(self, binmsg: bytes) -> Optional[List[bytes]]:
+        (msgtype,) = struct.unpack_from(">H", binmsg)
+        if msgtype == MSG_GOSSIP_TIMESTAMP_FILTER:
+            name, handler = "gossip_timestamp_filter", self._timestamp_filter
+        elif msgtype == MSG_QUERY_CHANNEL_RANGE:
+            name, handler = "query_channel_range", self._channel_range
+        elif msgtype == MSG_QUERY_SHORT_CHANNEL_IDS:
+            name, handler = "query_short_channel_ids", self._short_channel_ids
+        else:
+            return None
+
+        if self.first_query is None:
+            self.first_query = time.perf_counter()
+        self.queries[name] += 1
+        try:
+            replies = handler(binmsg)
+        except (struct.error, IndexError, KeyError) as e:
+            raise ValueError("Bad {}: {}".format(name, e))
+        self.replies += len(replies)
+        self.reply_bytes += sum(len(r) for r in replies)
+        return replies
+
+    def _timestamp_filter(self, binmsg: bytes) -> List[bytes]:
+        first_timestamp, timestamp_range = struct.unpack_from(">II", binmsg, 34)
+        # BOLT #7:
+        # - if the `chain_hash` refers to a chain that it does not wish to
+        #   gossip about: MUST NOT forward any gossip messages
+        if binmsg[2:34] != self.store.chain_hash:
+            return []
+        msgs = self.store.between(first_timestamp, timestamp_range)
+        for msg in msgs:
+            if msg[:2] == struct.pack(">H", MSG_CHANNEL_ANNOUNCEMENT):
+                self.served.add(_announcement_scid(msg))
+        return msgs
+
+    def _channel_range(self, binmsg: bytes) -> List[bytes]:
+        first_blocknum, number_of_blocks = struct.unpack_from(">II", binmsg, 34)
+        tlvs = decode_tlvs(binmsg, 42)
+        query_option_flags = 0
+        if 1 in tlvs:
+            query_option_flags = _bigsize(tlvs[1], 0)[0]
+        # BOLT #7:
+        # - if does not maintain up-to-date channel information for
+        #   `chain_hash`: MUST set `sync_complete` to `false`.
+        return self.store.reply_channel_range(
+            first_blocknum,
+            number_of_blocks,
+            query_option_flags,
+            self.encoding_type,
+            sync_complete=binmsg[2:34] == self.store.chain_hash,
+        )
+
+    def _short_channel_ids(self, binmsg: bytes) -> List[bytes]:
+        (idlen,) = struct.unpack_from(">H", binmsg, 34)
+        if 36 + idlen > len(binmsg):
+            raise ValueError("Truncated encoded_short_ids")
+        scids = decode_scids(binmsg[36 : 36 + idlen])
+        tlvs = decode_tlvs(binmsg, 36 + idlen)
+        query_flags = None
+        if 1 in tlvs:
+            query_flags = decode_query_flags(tlvs[1])
+            if len(query_flags) != len(scids):
+                raise ValueError(
+                    "{} query_flags for {} scids".format(len(query_flags), len(scids))
+                )
+
+        full_information = binmsg[2:34] == self.store.chain_hash
+        msgs: List[bytes] = []
+        if full_information:
+            served, msgs = self.store.reply_short_channel_ids(scids, query_flags)
+            self.served.update(served)
+        # BOLT #7:
+        # - MUST follow these responses with `reply_short_channel_ids_end`.
+        # - if does not maintain up-to-date channel information for
+        #   `chain_hash`: MUST set `full_information` to 0.
+        msgs.append(
+            struct.pack(">H", MSG_REPLY_SHORT_CHANNEL_IDS_END)
+            + binmsg[2:34]
+            + bytes([full_information])
+        )
+        return msgs
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queries": dict(self.queries),
+            "replies": self.replies,
+            "reply_bytes": self.reply_bytes,
+            "served": len(self.served),
+        }
+
+
+class ServeGossip(PerConnEvent):
+    """From now on, answer the node's gossip queries on this conn from
+    store (None stops)"""
+
+    def __init__(
+        self,
+        store: Optional[GossipStore],
+        encoding_type: int = ENCODING_ZLIB,
+        connprivkey: Optional[str] = None,
+    ):
+        super().__init__(connprivkey)
+        self.store = store
+        self.encoding_type = encoding_type
+
+    def action(self, runner: "Runner") -> bool:
+        super().action(runner)
+        conn = self.find_conn(runner)
+        if self.store is None:
+            conn.responder = None
+        else:
+            conn.responder = GossipResponder(self.store, self.encoding_type)
+        return True
+
+
+class ExpectGossipSync(PerConnEvent):
+    """Wait until the node has fetched every channel from the store
+    ServeGossip attached, then ping it: once it answers, it has read them
+    all.  Stashes "GossipSync" with what it asked for and how long it took
+    (from ServeGossip)."""
+
+    def __init__(
+        self, timeout: int = 600, batch: int = 1000, connprivkey: Optional[str] = None
+    ):
+        super().__init__(connprivkey)
+        self.timeout = timeout
+        # How many scids the DummyRunner's made-up queries ask for.
+        self.batch = batch
+
+    def _dummy_expect(
+        self, conn: "Conn", responder: GossipResponder, pinged: bool, pos: int
+    ) -> Tuple[ExpectMsg, int]:
+        """What the DummyRunner should make up: a node which asks for the
+        range, then the scids it hasn't seen"""
+        chain_hash = responder.store.chain_hash.hex()
+        if pinged:
+            return ExpectMsg("pong", connprivkey=conn.name, ignored=""), pos
+        if responder.queries["query_channel_range"] == 0:
+            return (
+                ExpectMsg(
+                    "query_channel_range",
+                    connprivkey=conn.name,
+                    chain_hash=chain_hash,
+                    first_blocknum=0,
+                    number_of_blocks=0xFFFFFFFF,
+                ),
+                pos,
+            )
+        scids = responder.store.short_channel_ids()
+        while pos < len(scids) and scids[pos] in responder.served:
+            pos += 1
+        return (
+            ExpectMsg(
+                "query_short_channel_ids",
+                connprivkey=conn.name,
+                chain_hash=chain_hash,
+                encoded_short_ids=encode_scids(
+                    scids[pos : pos + self.batch], ENCODING_ZLIB
+                ).hex(),
+            ),
+            pos,
+        )
+
+    def action(self, runner: "Runner") -> bool:
+        super().action(runner)
+        conn = self.find_conn(runner)
+        responder = conn.responder
+        if not isinstance(responder, GossipResponder):
+            raise EventError(self, "No ServeGossip on {}".format(conn))
+        total = len(responder.store.channels)
+
+        deadline = time.monotonic() + self.timeout
+        served_at: Optional[float] = None
+        pos = 0
+        while True:
+            if served_at is None and len(responder.served) == total:
+                served_at = time.perf_counter()
+                runner.recv(
+                    self,
+                    conn,
+                    encode_msg(
+                        Message(
+                            namespace().get_msgtype("ping"),
+                            num_pong_bytes=0,
+                            ignored=b"",
+                        )
+                    ),
+                )
+            expect, pos = self._dummy_expect(
+                conn, responder, served_at is not None, pos
+            )
+            binmsg = runner.get_output_message(conn, expect)
+            if binmsg is None or time.monotonic() > deadline:
+                raise EventError(
+                    self,
+                    "Node fetched {} of {} channels: {}".format(
+                        len(responder.served), total, responder.stats()
+                    ),
+                )
+            if conn.respond(runner, self, binmsg):
+                continue
+            if served_at is not None and binmsg[:2] == struct.pack(">H", MSG_PONG):
+                break
+            try:
+                msg = decode_msg(binmsg)
+            except ValueError as ve:
+                raise EventError(
+                    self, "Runner gave bad msg {}: {}".format(binmsg.hex(), ve)
+                )
+            response = ExpectMsg.ignore_all_gossip(msg)
+            if response is None:
+                raise EventError(self, "Unexpected {} during sync".format(msg.to_str()))
+            for m in response:
+                runner.recv(self, conn, encode_msg(m))
+
+        done = time.perf_counter()
+        results = responder.stats()
+        results.update(
+            {
+                "channels": total,
+                "seconds": done - responder.attached,
+                "served_seconds": served_at - responder.attached,
+            }
+        )
+        if responder.first_query is not None:
+            results["first_query_seconds"] = responder.first_query - responder.attached
+        runner.add_stash("GossipSync", results)
+        return True
+
+
+def test_gossip_store() -> None:
+    from .gossip_query import (
+        QueryChannelRange,
+        ReplyChannelRange,
+        encode_query_flags,
+        scid_from_str,
+    )
+
+    corpus = GossipCorpus(
+        2500, nodes=10, timestamp=1700000000, processes=1, cache=False
+    )
+    store = GossipStore.from_corpus(corpus)
+    scids = store.short_channel_ids()
+    assert list(scids) == [scid_from_str(s) for s in corpus.short_channel_ids()]
+    assert len(store.scids_in_blocks(104, 1)) == 500
+    assert len(store.scids_in_blocks(0, 0xFFFFFFFF)) == 2500
+
+    # Everything, channels before nodes, each announcement before its updates.
+    msgs = store.between(0, 0xFFFFFFFF)
+    assert len(msgs) == 3 * 2500 + 10
+    assert msgs[0] == corpus.channel_announcements[0]
+    assert set(msgs[-10:]) == set(corpus.node_announcements)
+    assert store.between(1700000001, 100) == []
+    assert store.between(1700000000, 1) == msgs
+
+    # A newer update replaces the old one.
+    newer = bytearray(corpus.channel_updates[1])
+    newer[2 + 64 + 32 + 8 : 2 + 64 + 32 + 8 + 4] = struct.pack(">I", 1700000001)
+    store.add(bytes(newer))
+    store.add(corpus.channel_updates[1])
+    assert store.between(1700000001, 1) == [corpus.channel_announcements[0], newer]
+
+    # Replies pass QueryChannelRange's checks, timestamps and all.
+    q = QueryChannelRange(0, 0xFFFFFFFF, query_option_flags=3)
+    replies = [
+        ReplyChannelRange(r)
+        for r in store.reply_channel_range(0, 0xFFFFFFFF, query_option_flags=3)
+    ]
+    assert all(len(r) <= 65535 for r in store.reply_channel_range(0, 0xFFFFFFFF, 3))
+    got = array("Q")
+    prev_end = None
+    for reply in replies:
+        got += q._check_reply(reply, prev_end, got[-1] if got else -1)
+        prev_end = reply.first_blocknum + reply.number_of_blocks
+    assert got == scids and prev_end == 0xFFFFFFFF
+    assert replies[0].timestamps()[0] == (1700000000, 1700000001)  # type: ignore
+    (reply,) = [
+        ReplyChannelRange(r)
+        for r in store.reply_channel_range(104, 1, sync_complete=False)
+    ]
+    assert reply.sync_complete == 0 and len(reply.scids()) == 0
+
+    # Ask for channel 2 (all of it), and just channel 3's announcement.
+    responder = GossipResponder(store)
+    query = (
+        struct.pack(">H", MSG_QUERY_SHORT_CHANNEL_IDS)
+        + store.chain_hash
+        + struct.pack(">H", 17)
+        + encode_scids(scids[2:4])
+        + encode_tlv(1, encode_query_flags([QUERY_FLAGS_ALL, 1], ENCODING_ZLIB))
+    )
+    out = responder(query)
+    assert out is not None
+    assert out[:3] == [
+        corpus.channel_announcements[2],
+        corpus.channel_updates[4],
+        corpus.channel_updates[5],
+    ]
+    # Then its node_announcements, and no more for channel 3.
+    assert set(out[3:-2]) <= set(corpus.node_announcements)
+    assert out[-2:] == [
+        corpus.channel_announcements[3],
+        struct.pack(">H", MSG_REPLY_SHORT_CHANNEL_IDS_END) + store.chain_hash + b"\x01",
+    ]
+    assert responder.served == set(scids[2:4])
+    assert responder(corpus.channel_announcements[0]) is None
+
+
+def test_gossip_sync_dummy() -> None:
+    """Loopback through the DummyRunner: how fast we serve"""
+    from .dummyrunner import DummyRunner
+    from .event import Connect
+
+    class config(object):
+        def getoption(self, name: str) -> Any:
+            return False
+
+    corpus = GossipCorpus(
+        5000, nodes=20, timestamp=1700000000, processes=1, cache=False
+    )
+    store = GossipStore.from_corpus(corpus)
+    runner = DummyRunner(config())
+    runner.run(
+        [
+            Connect(connprivkey="03"),
+            ServeGossip(store),
+            ExpectGossipSync(batch=2000),
+        ]
+    )
+    results = runner.stash["GossipSync"]
+    assert results["channels"] == results["served"] == 5000
+    assert results["queries"] == {
+        "gossip_timestamp_filter": 0,
+        "query_channel_range": 1,
+        "query_short_channel_ids": 3,
+    }
+    # One range reply, the channels, each query's node_announcements, and
+    # each query's end.
+    assert results["replies"] == 1 + 3 * 5000 + 3 * 20 + 3
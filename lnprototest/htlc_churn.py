@@ -0,0 +1,384 @@
+#! /usr/bin/python3
+# HTLC churn on an open channel.
+#
+# Each round we add a batch of HTLCs and commit them (commitment_signed
+# with every htlc_signature, revoke_and_ack both ways), then the node
+# removes them all again and we commit that.  Everything is checked
+# against the stashed Commitment as usual; we also time how long our own
+# signing takes, so the HTLC update rate can be split between the node
+# and lnprototest.
+import functools
+import logging
+import time
+from hashlib import sha256
+from typing import Any, Callable, Dict, List, Optional, TYPE_CHECKING
+
+from .codec import decode_msg, encode_msg
+from .commit_tx import HTLC, Commitment, UpdateCommit, check_revealed_secret
+from .errors import EventError, SpecFileError
+from .event import Event, ExpectMsg, Msg, PerConnEvent
+from .runner import remote_per_commitment_point, remote_per_commitment_secret
+from .structure import Sequence
+from .utils import Side
+
+if TYPE_CHECKING:
+    # Otherwise a circular dependency
+    from .runner import Runner
+
+# BOLT #4: version 0, then an ephemeral key which isn't a point, so the
+# node must reject it with update_fail_malformed_htlc.
+UNPARSABLE_ONION = "00" * 1366
+
+
+class ChurnStats(object):
+    """Where the time went"""
+
+    def __init__(self) -> None:
+        self.sign_seconds = 0.0
+        self.signatures = 0
+
+
+def _timed(
+    stats: ChurnStats,
+    resolver: Callable[["Runner", Event, str], Any],
+    runner: "Runner",
+    event: Event,
+    field: str,
+) -> Any:
+    start = time.perf_counter()
+    ret = resolver(runner, event, field)
+    stats.sign_seconds += time.perf_counter() - start
+    stats.signatures += 1
+    return ret
+
+
+class ExpectHtlcRemovals(PerConnEvent):
+    """Wait for the node to remove every one of htlcs (by id), in any
+    order, and remove them from the Commit.  If fulfill, they must all
+    be fulfilled (with the right preimage), otherwise failed."""
+
+    def __init__(
+        self,
+        htlcs: Dict[int, HTLC],
+        fulfill: bool = False,
+        connprivkey: Optional[str] = None,
+    ):
+        super().__init__(connprivkey)
+        self.htlcs = htlcs
+        self.fulfill = fulfill
+
+    def _dummy_expect(self, htlc_id: int) -> ExpectMsg:
+        """What the DummyRunner should make up"""
+        from .stash import channel_id
+
+        if self.fulfill:
+            return ExpectMsg(
+                "update_fulfill_htlc",
+                connprivkey=self.connprivkey,
+                channel_id=channel_id(),
+                id=htlc_id,
+                payment_preimage=self.htlcs[htlc_id].payment_secret,
+            )
+        return ExpectMsg(
+            "update_fail_htlc",
+            connprivkey=self.connprivkey,
+            channel_id=channel_id(),
+            id=htlc_id,
+            reason="",
+        )
+
+    def action(self, runner: "Runner") -> bool:
+        super().action(runner)
+        conn = self.find_conn(runner)
+        commit: Commitment = runner.get_stash(self, "Commit")
+        chanid = commit.funding.channel_id()
+        pending = dict(self.htlcs)
+        while pending:
+            binmsg = runner.get_output_message(conn, self._dummy_expect(min(pending)))
+            if binmsg is None:
+                raise EventError(
+                    self, "{} htlcs still not removed".format(len(pending))
+                )
+            runner.latency.arrived(conn)
+            if conn.respond(runner, self, binmsg):
+                continue
+            try:
+                msg = decode_msg(binmsg)
+            except ValueError as ve:
+                raise EventError(
+                    self, "Runner gave bad msg {}: {}".format(binmsg.hex(), ve)
+                )
+            name = msg.messagetype.name
+            if name not in (
+                "update_fulfill_htlc",
+                "update_fail_htlc",
+                "update_fail_malformed_htlc",
+            ):
+                response = ExpectMsg.ignore_all_gossip(msg)
+                if response is None:
+                    raise EventError(
+                        self, "Expected htlc removal, got {}".format(msg.to_str())
+                    )
+                for m in response:
+                    runner.recv(self, conn, encode_msg(m))
+                continue
+
+            if msg.fields["channel_id"].hex() != chanid:
+                raise EventError(self, "Wrong channel_id: {}".format(msg.to_str()))
+            htlc = pending.pop(msg.fields["id"], None)
+            if htlc is None:
+                raise EventError(self, "Unknown htlc: {}".format(msg.to_str()))
+            fulfilled = name == "update_fulfill_htlc"
+            if fulfilled != self.fulfill:
+                raise EventError(
+                    self,
+                    "Expected {}: {}".format(
+                        "fulfill" if self.fulfill else "fail", msg.to_str()
+                    ),
+                )
+            if (
+                fulfilled
+                and sha256(msg.fields["payment_preimage"]).digest()
+                != htlc.raw_payment_hash()
+            ):
+                raise EventError(self, "Bad preimage: {}".format(msg.to_str()))
+            if not commit.del_htlc(htlc, xfer_funds=fulfilled):
+                raise SpecFileError(self, "Commit does not have {}".format(htlc))
+        return True
+
+
+class HtlcChurn(Sequence):
+    """rounds rounds of htlcs_per_round HTLCs, added by us and removed by
+    the node, on the stashed Commit's channel, starting at commitnum (the
+    commitment number both sides are at) and HTLC id first_id.  Stashes
+    "HtlcChurn" with updates per second overall, for the node (everything
+    but our signing) and for our signing."""
+
+    def __init__(
+        self,
+        rounds: int,
+        htlcs_per_round: int,
+        amount_msat: int = 1000000,
+        cltv_expiry: int = 200,
+        onion_routing_packet: str = UNPARSABLE_ONION,
+        fulfill: bool = False,
+        commitnum: int = 0,
+        first_id: int = 0,
+        connprivkey: Optional[str] = None,
+    ):
+        super().__init__([])
+        if rounds < 1 or htlcs_per_round < 1:
+            raise SpecFileError(self, "Need at least one round of one htlc")
+        self.rounds = rounds
+        self.htlcs_per_round = htlcs_per_round
+        self.stats = ChurnStats()
+        events: List[Event] = []
+        for r in range(rounds):
+            htlcs: Dict[int, HTLC] = {}
+            for i in range(htlcs_per_round):
+                htlc_id = first_id + r * htlcs_per_round + i
+                htlcs[htlc_id] = HTLC(
+                    owner=Side.local,
+                    amount_msat=amount_msat,
+                    payment_secret=sha256(
+                        "churn/{}".format(htlc_id).encode()
+                    ).hexdigest(),
+                    cltv_expiry=cltv_expiry,
+                    onion_routing_packet=onion_routing_packet,
+                )
+            events += self._round(
+                htlcs, fulfill, commitnum + 2 * r, connprivkey=connprivkey
+            )
+        self.events = events
+
+    def _round(
+        self,
+        htlcs: Dict[int, HTLC],
+        fulfill: bool,
+        n: int,
+        connprivkey: Optional[str],
+    ) -> List[Event]:
+        from .stash import (
+            channel_id,
+            commitsig_to_recv,
+            commitsig_to_send,
+            htlc_sigs_to_recv,
+            htlc_sigs_to_send,
+            local_per_commitment_point,
+            local_per_commitment_secret,
+        )
+
+        def timed(resolver: Callable[["Runner", Event, str], Any]) -> Any:
+            return functools.partial(_timed, self.stats, resolver)
+
+        def we_commit(n: int) -> List[Event]:
+            return [
+                Msg(
+                    "commitment_signed",
+                    connprivkey=connprivkey,
+                    channel_id=channel_id(),
+                    signature=timed(commitsig_to_send()),
+                    htlc_signature=timed(htlc_sigs_to_send()),
+                ),
+                ExpectMsg(
+                    "revoke_and_ack",
+                    connprivkey=connprivkey,
+                    channel_id=channel_id(),
+                    per_commitment_secret=remote_per_commitment_secret(n),
+                    next_per_commitment_point=remote_per_commitment_point(n + 2),
+                    if_match=check_revealed_secret(n),
+                    ignore=ExpectMsg.ignore_all_gossip,
+                ),
+            ]
+
+        def they_commit(n: int) -> List[Event]:
+            return [
+                ExpectMsg(
+                    "commitment_signed",
+                    connprivkey=connprivkey,
+                    channel_id=channel_id(),
+                    signature=timed(commitsig_to_recv()),
+                    htlc_signature=timed(htlc_sigs_to_recv()),
+                    ignore=ExpectMsg.ignore_all_gossip,
+                ),
+                Msg(
+                    "revoke_and_ack",
+                    connprivkey=connprivkey,
+                    channel_id=channel_id(),
+                    per_commitment_secret=local_per_commitment_secret(n),
+                    next_per_commitment_point=local_per_commitment_point(n + 2),
+                ),
+            ]
+
+        events: List[Event] = [
+            Msg(
+                "update_add_htlc",
+                connprivkey=connprivkey,
+                channel_id=channel_id(),
+                id=htlc_id,
+                amount_msat=htlc.amount_msat,
+                payment_hash=htlc.payment_hash(),
+                cltv_expiry=htlc.cltv_expiry,
+                onion_routing_packet=htlc.onion_routing_packet,
+            )
+            for htlc_id, htlc in htlcs.items()
+        ]
+        events.append(UpdateCommit(new_htlcs=[(h, i) for i, h in htlcs.items()]))
+        # BOLT #2: once the HTLCs are irrevocably committed on both sides,
+        # the node can remove them; then it commits first.
+        events += we_commit(n) + they_commit(n)
+        events += [ExpectHtlcRemovals(htlcs, fulfill, connprivkey), UpdateCommit()]
+        events += they_commit(n + 1) + we_commit(n + 1)
+        return events
+
+    def action(self, runner: "Runner", skip_first: bool = False) -> bool:
+        self.stats.sign_seconds = 0.0
+        self.stats.signatures = 0
+        start = time.perf_counter()
+        ret = super().action(runner, skip_first)
+        elapsed = time.perf_counter() - start
+
+        # One add and one removal for each.
+        updates = 2 * self.rounds * self.htlcs_per_round
+        sign = self.stats.sign_seconds
+        node = max(elapsed - sign, 1e-9)
+        logging.info(
+            "{}: {} updates in {:.3f}s ({:.3f}s signing): {:.0f} updates/sec,"
+            " node {:.0f}/sec, signing {:.0f}/sec".format(
+                self,
+                updates,
+                elapsed,
+                sign,
+                updates / elapsed,
+                updates / node,
+                updates / sign if sign else 0.0,
+            )
+        )
+        runner.add_stash(
+            "HtlcChurn",
+            {
+                "rounds": self.rounds,
+                "htlcs": self.rounds * self.htlcs_per_round,
+                "updates": updates,
+                "seconds": elapsed,
+                "sign_seconds": sign,
+                "signatures": self.stats.signatures,
+                "node_seconds": node,
+                "updates_per_sec": updates / elapsed,
+                "node_updates_per_sec": updates / node,
+                "sign_updates_per_sec": updates / sign if sign else 0.0,
+            },
+        )
+        return ret
+
+
+def test_htlc_churn_dummy() -> None:
+    """Loopback through the DummyRunner: our side of the churn"""
+    from .commit_tx import Commit
+    from .dummyrunner import DummyRunner
+    from .event import Block, Connect
+    from .funding import CreateFunding
+    from .keyset import KeySet
+    from .runner import remote_funding_privkey
+    from .stash import funding
+    from .utils.bitcoin_utils import utxo
+
+    class config(object):
+        def getoption(self, name: str) -> Any:
+            return False
+
+    local_keyset = KeySet(
+        revocation_base_secret="21",
+        payment_base_secret="22",
+        htlc_base_secret="24",
+        delayed_payment_base_secret="23",
+        shachain_seed="00" * 32,
+    )
+    runner = DummyRunner(config())
+    churn = HtlcChurn(rounds=3, htlcs_per_round=4, commitnum=0)
+    runner.run(
+        [
+            Block(blockheight=102),
+            Connect(connprivkey="02"),
+            CreateFunding(
+                *utxo(0),
+                local_node_privkey="02",
+                local_funding_privkey="20",
+                remote_node_privkey=runner.get_node_privkey(),
+                remote_funding_privkey=remote_funding_privkey()
+            ),
+            Commit(
+                funding=funding(),
+                opener=Side.local,
+                local_keyset=local_keyset,
+                local_to_self_delay=6,
+                remote_to_self_delay=5,
+                local_amount=999800000,
+                remote_amount=0,
+                local_dust_limit=546,
+                remote_dust_limit=546,
+                feerate=253,
+                local_features="",
+                remote_features="",
+            ),
+            churn,
+        ]
+    )
+    commit = runner.get_stash(churn, "Commit")
+    # All gone again, and the money is back where it started.
+    assert commit.commitnum == 6 and commit.htlcs == {}
+    assert commit.amounts == [999800000, 0]
+    # Every secret they revealed, kept compactly.
+    assert commit.remote_secrets.per_commit_secret(0) is not None
+    assert commit.remote_secrets.per_commit_secret(5) == bytes.fromhex(
+        runner.get_keyset().per_commit_secret(5)
+    )
+    results = runner.stash["HtlcChurn"]
+    assert results["htlcs"] == 12 and results["updates"] == 24
+    # Two sigs sent and two checked per commitment exchange, two of each
+    # per round.
+    assert results["signatures"] >= 3 * 2 * 4
+    assert results["sign_seconds"] > 0 and results["updates_per_sec"] > 0
+    assert [e.msgtype.name for e in churn.events[:4] if isinstance(e, Msg)] == [
+        "update_add_htlc"
+    ] * 4
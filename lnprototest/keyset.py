@@ -2,6 +2,37 @@
 # FIXME: clean this up for use as pyln.proto.tx
 import coincurve
 import hashlib
+from typing import List, Optional, Tuple
+
+# BOLT #3:
+# The first secret used:
+#  - MUST be index 281474976710655,
+#    - and from there, the index is decremented.
+SHACHAIN_FIRST_INDEX = 281474976710655
+
+
+def shachain_derive(base: bytes, bits: int, index: int) -> bytes:
+    """BOLT #3 derive_secret: generate_from_seed is bits = 48"""
+    # BOLT #3:
+    # generate_from_seed(seed, I):
+    #     P = seed
+    #     for B in 47 down to 0:
+    #         if B set in I:
+    #             flip(B) in P
+    #             P = SHA256(P)
+    #     return P
+    # ```
+
+    # FIXME: This is the updated wording from PR #779
+    # Where "flip(B)" alternates the (B mod 8)'th bit of the (B div 8)'th
+    # byte of the value.  So, "flip(0) in e3b0..." is "e2b0...", and
+    # "flip(10) in "e3b0..." is "e3b4".
+    P = bytearray(base)
+    for B in range(bits - 1, -1, -1):
+        if ((1 << B) & index) != 0:
+            P[B // 8] ^= 1 << (B % 8)
+            P = bytearray(hashlib.sha256(P).digest())
+    return bytes(P)
 
 
 class KeySet(object):
@@ -46,35 +77,11 @@ class KeySet(object):
         return self.raw_htlc_basepoint().format().hex()
 
     def raw_per_commit_secret(self, n: int) -> coincurve.PrivateKey:
-        # BOLT #3:
-        # The first secret used:
-        #  - MUST be index 281474976710655,
-        #    - and from there, the index is decremented.
-        if n > 281474976710655:
+        if n > SHACHAIN_FIRST_INDEX:
             raise ValueError("48 bits is all you get!")
-        index = 281474976710655 - n
-
-        # BOLT #3:
-        # generate_from_seed(seed, I):
-        #     P = seed
-        #     for B in 47 down to 0:
-        #         if B set in I:
-        #             flip(B) in P
-        #             P = SHA256(P)
-        #     return P
-        # ```
-
-        # FIXME: This is the updated wording from PR #779
-        # Where "flip(B)" alternates the (B mod 8)'th bit of the (B div 8)'th
-        # byte of the value.  So, "flip(0) in e3b0..." is "e2b0...", and
-        # "flip(10) in "e3b0..." is "e3b4".
-        P = bytearray(self.shachain_seed)
-        for B in range(47, -1, -1):
-            if ((1 << B) & index) != 0:
-                P[B // 8] ^= 1 << (B % 8)
-                P = bytearray(hashlib.sha256(P).digest())
-
-        return coincurve.PrivateKey(P)
+        return coincurve.PrivateKey(
+            shachain_derive(self.shachain_seed, 48, SHACHAIN_FIRST_INDEX - n)
+        )
 
     def per_commit_secret(self, n: int) -> str:
         return self.raw_per_commit_secret(n).secret.hex()
@@ -86,6 +93,86 @@ class KeySet(object):
         return self.raw_per_commit_point(n).format().hex()
 
 
+class ShachainReceiver(object):
+    """The per-commitment secrets revealed to us, in the BOLT #3 compact
+    form: at most 49 secrets however many we're given, from which any
+    earlier one can be derived.  Each new secret is checked against
+    everything we've been given so far."""
+
+    def __init__(self) -> None:
+        # (index, secret) for each bucket.
+        self.known: List[Optional[Tuple[int, bytes]]] = [None] * 49
+        # Last index inserted.
+        self.index: Optional[int] = None
+
+    @staticmethod
+    def where_to_put_secret(index: int) -> int:
+        # BOLT #3:
+        # The receiver can store the secret in the bucket corresponding to
+        # the number of trailing zeros in the index.
+        for b in range(48):
+            if index & (1 << b):
+                return b
+        # All zero: the seed itself.
+        return 48
+
+    def insert_secret(self, secret: bytes, index: int) -> None:
+        """Raises ValueError if secret (for shachain index) is out of
+        order, or inconsistent with those we already have"""
+        if self.index is not None:
+            # Retransmission (e.g. on reconnect) is fine.
+            if index == self.index and self.get_secret(index) == secret:
+                return
+            if index != self.index - 1:
+                raise ValueError(
+                    "Secret for index {} after index {}".format(index, self.index)
+                )
+        bucket = self.where_to_put_secret(index)
+        # BOLT #3:
+        #     for b in 0 to B:
+        #         if derive_secret(secret, B, known[b].index) != known[b].secret:
+        #             error The secret for I is incorrect
+        #             return
+        for known in self.known[:bucket]:
+            if (
+                known is not None
+                and shachain_derive(secret, bucket, known[0]) != known[1]
+            ):
+                raise ValueError(
+                    "Secret for index {} does not derive index {}".format(
+                        index, known[0]
+                    )
+                )
+        self.known[bucket] = (index, secret)
+        self.index = index
+
+    def get_secret(self, index: int) -> Optional[bytes]:
+        """The secret for index, if we can derive it"""
+        # BOLT #3:
+        #     for b in 0 to len(secrets):
+        #         # Mask off the non-zero prefix of the index.
+        #         MASK = ~((1 << b) - 1)
+        #         if (I & MASK) == secrets[b].index:
+        #             return derive(known, i, I)
+        for b, known in enumerate(self.known):
+            if known is not None and index & ~((1 << b) - 1) == known[0]:
+                return shachain_derive(known[1], b, index)
+        return None
+
+    def add_per_commit_secret(self, n: int, secret: bytes) -> None:
+        """Secret for commitment number n, as in revoke_and_ack"""
+        self.insert_secret(secret, SHACHAIN_FIRST_INDEX - n)
+
+    def per_commit_secret(self, n: int) -> Optional[bytes]:
+        return self.get_secret(SHACHAIN_FIRST_INDEX - n)
+
+    def __copy__(self) -> "ShachainReceiver":
+        ret = ShachainReceiver()
+        ret.known = list(self.known)
+        ret.index = self.index
+        return ret
+
+
 def test_shachain() -> None:
     # BOLT #3:
     # ## Generation Tests
@@ -172,3 +259,65 @@ def test_shachain() -> None:
         keyset.per_commit_secret(0xFFFFFFFFFFFF - 1)
         == "915c75942a26bb3a433a8ce2cb0427c29ec6c1775cfc78328b57f6ba7bfeaa9c"
     )
+
+
+def test_shachain_receiver() -> None:
+    # BOLT #3:
+    # ## Storage Tests
+    # name: insert_secret correct sequence
+    keyset = KeySet("01", "01", "01", "01", "FF" * 32)
+    receiver = ShachainReceiver()
+    for n in range(8):
+        receiver.add_per_commit_secret(n, keyset.raw_per_commit_secret(n).secret)
+    # 281474976710648 has 3 trailing zeroes.
+    assert receiver.known[3] == (
+        281474976710648,
+        bytes.fromhex(
+            "05cde6323d949933f7f7b78776bcc1ea6d9b31447732e3802e1f7ac44b650e17"
+        ),
+    )
+    assert len([k for k in receiver.known if k is not None]) == 4
+    for n in range(8):
+        assert receiver.per_commit_secret(n) == keyset.raw_per_commit_secret(n).secret
+    assert receiver.per_commit_secret(8) is None
+    # Retransmitted: fine.
+    receiver.add_per_commit_secret(7, keyset.raw_per_commit_secret(7).secret)
+
+    # name: insert_secret #1 incorrect
+    # I: 281474976710655 secret: 0x02a40c85b6f28da08dfdbe0926c53fab2de6d28c10301f8f7c4073d5e42e3148
+    # I: 281474976710654 secret: 0xc7518c8ae4660ed02894df8976fa1a3659c1a8b4b5bec0c4b872abeba4cb8964
+    # output: ERROR
+    receiver = ShachainReceiver()
+    receiver.insert_secret(
+        bytes.fromhex(
+            "02a40c85b6f28da08dfdbe0926c53fab2de6d28c10301f8f7c4073d5e42e3148"
+        ),
+        281474976710655,
+    )
+    try:
+        receiver.insert_secret(keyset.raw_per_commit_secret(1).secret, 281474976710654)
+        assert False, "accepted inconsistent secret"
+    except ValueError:
+        pass
+
+    # A wrong one in an odd index can't be checked until the next arrives.
+    receiver = ShachainReceiver()
+    other = KeySet("01", "01", "01", "01", "00" * 32)
+    for n in range(4):
+        receiver.add_per_commit_secret(n, keyset.raw_per_commit_secret(n).secret)
+    receiver.add_per_commit_secret(4, other.raw_per_commit_secret(4).secret)
+    for bad in (5, 6):
+        try:
+            receiver.add_per_commit_secret(
+                bad, keyset.raw_per_commit_secret(bad).secret
+            )
+            assert False, "accepted secret {}".format(bad)
+        except ValueError:
+            pass
+
+    # Constant space, however long it runs.
+    receiver = ShachainReceiver()
+    for n in range(5000):
+        receiver.add_per_commit_secret(n, keyset.raw_per_commit_secret(n).secret)
+    assert len(receiver.known) == 49
+    assert receiver.per_commit_secret(1234) == keyset.raw_per_commit_secret(1234).secret
@@ -0,0 +1,211 @@
+#! /usr/bin/python3
+# How long the node under test takes to answer us.
+#
+# For each connection we remember when we last sent a Msg, and when the
+# message which satisfied the next ExpectMsg arrived: that difference goes
+# into a histogram for that pair of message types (e.g.
+# "open_channel->accept_channel").  Histograms are HDR-style (log-linear
+# buckets, ~2 significant figures) so they are small, mergeable, and can be
+# compared across versions of the implementation.
+import json
+import os
+import time
+from typing import Any, Dict, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .runner import Conn
+
+# Values below 2 * SUB_BUCKETS are exact; above, each power of 2 is split
+# into SUB_BUCKETS buckets, for a relative error below 1 / SUB_BUCKETS.
+SUB_BUCKET_BITS = 7
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+
+def _bucket(value: int) -> int:
+    shift = max(0, value.bit_length() - SUB_BUCKET_BITS - 1)
+    return shift * SUB_BUCKETS + (value >> shift)
+
+
+def _bucket_range(idx: int) -> Tuple[int, int]:
+    """Lowest and highest value which land in this bucket"""
+    shift = max(0, idx // SUB_BUCKETS - 1)
+    lowest = (idx - shift * SUB_BUCKETS) << shift
+    return lowest, lowest + (1 << shift) - 1
+
+
+class LatencyHistogram(object):
+    """Histogram of latencies, in microseconds"""
+
+    def __init__(self) -> None:
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        self.total = 0
+        self.min: Optional[int] = None
+        self.max: Optional[int] = None
+
+    def record(self, usec: int) -> None:
+        idx = _bucket(usec)
+        self.counts[idx] = self.counts.get(idx, 0) + 1
+        self.count += 1
+        self.total += usec
+        if self.min is None or usec < self.min:
+            self.min = usec
+        if self.max is None or usec > self.max:
+            self.max = usec
+
+    def record_seconds(self, secs: float) -> None:
+        self.record(max(0, round(secs * 1_000_000)))
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        for idx, n in other.counts.items():
+            self.counts[idx] = self.counts.get(idx, 0) + n
+        self.count += other.count
+        self.total += other.total
+        for v in (other.min, other.max):
+            if v is not None:
+                self.min = v if self.min is None else min(self.min, v)
+                self.max = v if self.max is None else max(self.max, v)
+
+    def percentile(self, pct: float) -> int:
+        """Value at or below which pct percent of samples lie (rounded up
+        to the top of its bucket, as HdrHistogram does)"""
+        if self.count == 0:
+            return 0
+        want = max(1, -(-self.count * pct // 100))
+        seen = 0
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            if seen >= want:
+                return min(_bucket_range(idx)[1], self.max or 0)
+        assert False, "percentiles add up"
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "unit": "us",
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.mean(),
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "p99.9": self.percentile(99.9),
+            "total": self.total,
+            "sub_bucket_bits": SUB_BUCKET_BITS,
+            # Keyed by the lowest value of each bucket, so it's self-describing.
+            "buckets": {
+                str(_bucket_range(idx)[0]): n for idx, n in sorted(self.counts.items())
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "LatencyHistogram":
+        if d["sub_bucket_bits"] != SUB_BUCKET_BITS:
+            raise ValueError(
+                "Histogram has {} sub bucket bits".format(d["sub_bucket_bits"])
+            )
+        hist = cls()
+        hist.counts = {_bucket(int(low)): n for low, n in d["buckets"].items()}
+        hist.count = d["count"]
+        hist.total = d["total"]
+        hist.min = d["min"]
+        hist.max = d["max"]
+        return hist
+
+
+class LatencyRecorder(object):
+    """Per-connection, per-message-pair latency histograms for a runner"""
+
+    def __init__(self) -> None:
+        self.histograms: Dict[Tuple[str, str], LatencyHistogram] = {}
+        # conn name -> (msgname, time) of the last Msg we sent.
+        self._sent: Dict[str, Tuple[str, float]] = {}
+        # conn name -> time the last message arrived.
+        self._arrived: Dict[str, float] = {}
+
+    def sent(self, conn: "Conn", msgname: str, when: float) -> None:
+        self._sent[conn.name] = (msgname, when)
+
+    def arrived(self, conn: "Conn") -> None:
+        self._arrived[conn.name] = time.perf_counter()
+
+    def matched(self, conn: "Conn", msgname: str) -> None:
+        """The message which arrived last satisfied an ExpectMsg"""
+        sent = self._sent.pop(conn.name, None)
+        arrived = self._arrived.get(conn.name)
+        if sent is None or arrived is None or arrived < sent[1]:
+            return
+        key = (conn.name, "{}->{}".format(sent[0], msgname))
+        if key not in self.histograms:
+            self.histograms[key] = LatencyHistogram()
+        self.histograms[key].record_seconds(arrived - sent[1])
+
+    def forget_pending(self) -> None:
+        """Connections are going away (e.g. restart)"""
+        self._sent = {}
+        self._arrived = {}
+
+    def to_dict(self) -> Dict[str, Dict[str, Any]]:
+        ret: Dict[str, Dict[str, Any]] = {}
+        for (conn, pair), hist in sorted(self.histograms.items()):
+            ret.setdefault(conn, {})[pair] = hist.to_dict()
+        return ret
+
+    def export(self, path: str) -> None:
+        """Write the histograms to path as JSON (if we have any)"""
+        if not self.histograms:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmpname = path + ".tmp"
+        with open(tmpname, "w") as f:
+            json.dump(self.to_dict(), f, indent=1)
+        os.replace(tmpname, path)
+
+
+def test_histogram() -> None:
+    # Buckets are contiguous, and each covers the values mapped to it.
+    prev_high = -1
+    for idx in range(_bucket(1 << 40) + 1):
+        low, high = _bucket_range(idx)
+        assert low == prev_high + 1
+        assert _bucket(low) == idx and _bucket(high) == idx
+        assert high - low <= max(1, low >> SUB_BUCKET_BITS)
+        prev_high = high
+
+    hist = LatencyHistogram()
+    for v in range(1, 1001):
+        hist.record(v * 100)
+    assert hist.count == 1000 and hist.min == 100 and hist.max == 100000
+    assert abs(hist.percentile(50) - 50000) / 50000 < 0.01
+    assert abs(hist.percentile(99) - 99000) / 99000 < 0.01
+    assert hist.percentile(100) == 100000
+    assert hist.mean() == 50050
+
+    again = LatencyHistogram.from_dict(json.loads(json.dumps(hist.to_dict())))
+    again.merge(hist)
+    assert again.count == 2000 and again.percentile(50) == hist.percentile(50)
+
+
+def test_recorder() -> None:
+    class FakeConn(object):
+        name = "1"
+
+    conn: Any = FakeConn()
+    rec = LatencyRecorder()
+    # Arrived before we sent anything: not a response.
+    rec.arrived(conn)
+    rec.sent(conn, "open_channel", time.perf_counter())
+    rec.matched(conn, "accept_channel")
+    assert rec.histograms == {}
+
+    rec.sent(conn, "open_channel", time.perf_counter() - 0.002)
+    rec.arrived(conn)
+    rec.matched(conn, "accept_channel")
+    # Only the first message after a Msg counts.
+    rec.matched(conn, "channel_ready")
+    hist = rec.histograms[("1", "open_channel->accept_channel")]
+    assert hist.count == 1 and hist.min is not None and hist.min >= 2000
+    assert list(rec.to_dict()["1"]) == ["open_channel->accept_channel"]
@@ -0,0 +1,162 @@
+#! /usr/bin/python3
+# The "ExpectMsg" and "Msg" stashes: every message received or sent, in order.
+import collections
+from pyln.proto.message import Message
+from typing import Any, Deque, Dict, Iterator, List, Optional, Union, overload
+
+
+class StashedMsg(object):
+    """A (msgname, fields) pair, where fields is msg.to_py() computed on
+    first use.  It unpacks and indexes just like the tuple it replaces."""
+
+    __slots__ = ("msg", "name", "_py")
+
+    def __init__(self, msg: Message):
+        self.msg = msg
+        self.name: str = msg.messagetype.name
+        self._py: Optional[Dict[str, Any]] = None
+
+    @property
+    def fields(self) -> Dict[str, Any]:
+        if self._py is None:
+            self._py = self.msg.to_py()
+        return self._py
+
+    def __getitem__(self, idx: int) -> Any:
+        if idx in (0, -2):
+            return self.name
+        if idx in (1, -1):
+            return self.fields
+        raise IndexError("stashed message index out of range")
+
+    def __iter__(self) -> Iterator[Any]:
+        yield self.name
+        yield self.fields
+
+    def __len__(self) -> int:
+        return 2
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, StashedMsg):
+            other = tuple(other)
+        return tuple(self) == other
+
+    def __repr__(self) -> str:
+        return repr((self.name, self.fields))
+
+
+class MsgStash(object):
+    """The messages of one stash ("ExpectMsg" or "Msg"), oldest first.
+
+    This looks like the list of (msgname, fields) tuples it replaces, but
+    we index by message name so the first or last of a given type is
+    O(1).  If maxlen is set, only the most recent maxlen messages are kept.
+    """
+
+    def __init__(self, maxlen: Optional[int] = None):
+        self.maxlen = maxlen
+        self._all: Deque[StashedMsg] = collections.deque()
+        self._by_name: Dict[str, Deque[StashedMsg]] = {}
+        # How many messages we have forgotten.
+        self.dropped = 0
+
+    def append(self, msg: Message) -> None:
+        entry = StashedMsg(msg)
+        self._all.append(entry)
+        self._by_name.setdefault(entry.name, collections.deque()).append(entry)
+        if self.maxlen is not None and len(self._all) > self.maxlen:
+            old = self._all.popleft()
+            # It's necessarily the oldest of its name, too.
+            byname = self._by_name[old.name]
+            byname.popleft()
+            if not byname:
+                del self._by_name[old.name]
+            self.dropped += 1
+
+    def first(self, msgname: Optional[str] = None) -> Optional[StashedMsg]:
+        """Oldest (retained) message, or oldest called msgname"""
+        seq = self._all if msgname is None else self._by_name.get(msgname)
+        return seq[0] if seq else None
+
+    def last(self, msgname: Optional[str] = None) -> Optional[StashedMsg]:
+        """Most recent message, or most recent called msgname"""
+        seq = self._all if msgname is None else self._by_name.get(msgname)
+        return seq[-1] if seq else None
+
+    def count(self, msgname: str) -> int:
+        """Number of (retained) messages called msgname"""
+        return len(self._by_name.get(msgname, ()))
+
+    def __len__(self) -> int:
+        return len(self._all)
+
+    @overload
+    def __getitem__(self, idx: int) -> StashedMsg: ...
+
+    @overload
+    def __getitem__(self, idx: slice) -> List[StashedMsg]: ...
+
+    def __getitem__(
+        self, idx: Union[int, slice]
+    ) -> Union[StashedMsg, List[StashedMsg]]:
+        if isinstance(idx, slice):
+            return list(self._all)[idx]
+        return self._all[idx]
+
+    def __iter__(self) -> Iterator[StashedMsg]:
+        return iter(self._all)
+
+    def __reversed__(self) -> Iterator[StashedMsg]:
+        return reversed(self._all)
+
+    def __copy__(self) -> "MsgStash":
+        ret = MsgStash(self.maxlen)
+        ret._all = collections.deque(self._all)
+        ret._by_name = {k: collections.deque(v) for k, v in self._by_name.items()}
+        ret.dropped = self.dropped
+        return ret
+
+    def __repr__(self) -> str:
+        return "MsgStash({!r})".format(list(self._all))
+
+
+def test_msgstash() -> None:
+    from .namespace import namespace
+
+    def ping(n: int) -> Message:
+        return Message(namespace().get_msgtype("ping"), num_pong_bytes=n, ignored="")
+
+    def pong(n: int) -> Message:
+        return Message(namespace().get_msgtype("pong"), ignored="00" * n)
+
+    stash = MsgStash()
+    for i in range(3):
+        stash.append(ping(i))
+        stash.append(pong(i))
+
+    # Nothing converted until asked.
+    last, first = stash.last("ping"), stash.first("pong")
+    assert last is not None and first is not None
+    assert last._py is None
+    assert last.fields["num_pong_bytes"] == 2
+    assert first.fields["ignored"] == ""
+    assert stash.last("init") is None and stash.count("pong") == 3
+
+    # Just like the old list of tuples.
+    assert len(stash) == 6
+    assert stash[-1][1] == {"ignored": "0000"}
+    assert stash[0] == ("ping", {"num_pong_bytes": 0, "ignored": ""})
+    name, fields = stash[2]
+    assert name == "ping" and fields["num_pong_bytes"] == 1
+    assert [n for n, _ in reversed(stash)][:2] == ["pong", "ping"]
+
+    bounded = MsgStash(maxlen=3)
+    for i in range(3):
+        bounded.append(ping(i))
+        bounded.append(pong(i))
+    assert len(bounded) == 3 and bounded.dropped == 3
+    oldest, ping2, pong1 = bounded.first(), bounded.first("ping"), bounded.first("pong")
+    assert oldest is not None and ping2 is not None and pong1 is not None
+    assert oldest.name == "pong"
+    assert ping2.fields["num_pong_bytes"] == 2
+    assert pong1.fields["ignored"] == "00"
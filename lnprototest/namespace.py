@@ -1,14 +1,100 @@
 #! /usr/bin/python3
-import pyln.spec.bolt1
-import pyln.spec.bolt2
-import pyln.spec.bolt7
-from pyln.proto.message import MessageNamespace
-from .signature import SigType
-from typing import List
+import functools
+import hashlib
+import os
+import pickle
+import sys
+import tempfile
+from typing import Dict, List, Optional, TYPE_CHECKING
 
+# This module is imported eagerly by the package, so the heavy pyln
+# imports are deferred until we actually build a namespace.
+if TYPE_CHECKING:
+    from pyln.proto.message import MessageNamespace
+
+# Namespaces we've already built, keyed by csv_digest().
+_namespaces: Dict[str, "MessageNamespace"] = {}
+
+
+@functools.lru_cache(maxsize=None)
+def _code_digest() -> str:
+    """The lnprototest version, and the source of the modules whose
+    classes end up in the pickle (unpickling doesn't call __init__)"""
+    from importlib import metadata
+
+    try:
+        version = metadata.version("lnprototest")
+    except metadata.PackageNotFoundError:
+        version = "?"
+    h = hashlib.sha256(version.encode())
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in ("namespace.py", "signature.py"):
+        with open(os.path.join(here, name), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def csv_digest(csv: List[str]) -> str:
+    """Content address of a csv: a pickled namespace is only valid for
+    the exact csv lines and lnprototest/pyln/python which produced it"""
+    import pyln.proto
+
+    h = hashlib.sha256(
+        "{}/{}/{}/{}\n".format(
+            _code_digest(),
+            getattr(pyln.proto, "__version__", "?"),
+            sys.version_info[:2],
+            pickle.HIGHEST_PROTOCOL,
+        ).encode()
+    )
+    for line in csv:
+        h.update(line.encode())
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+def cache_dir() -> Optional[str]:
+    """Where we keep pickled namespaces, if anywhere: $LNPROTOTEST_CACHE_DIR.
+    Otherwise they're only cached in memory."""
+    return os.environ.get("LNPROTOTEST_CACHE_DIR") or None
+
+
+def _load_cached(digest: str) -> Optional["MessageNamespace"]:
+    from pyln.proto.message import MessageNamespace
+
+    d = cache_dir()
+    if d is None:
+        return None
+    try:
+        with open(os.path.join(d, "ns-{}.pickle".format(digest)), "rb") as f:
+            ns = pickle.load(f)
+    except Exception:
+        # Missing, truncated or stale: we simply rebuild it.
+        return None
+    if not isinstance(ns, MessageNamespace):
+        return None
+    return ns
+
+
+def _save_cached(digest: str, ns: "MessageNamespace") -> None:
+    d = cache_dir()
+    if d is None:
+        return
+    try:
+        os.makedirs(d, exist_ok=True)
+        # Write then rename, so parallel test workers never see half a file.
+        fd, tmpname = tempfile.mkstemp(dir=d, prefix=".ns-")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(ns, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpname, os.path.join(d, "ns-{}.pickle".format(digest)))
+    except OSError:
+        pass
+
+
+def _build_namespace(csv: List[str]) -> "MessageNamespace":
+    from pyln.proto.message import MessageNamespace
+    from .signature import SigType
 
-def make_namespace(csv: List[str]) -> MessageNamespace:
-    """Load a namespace, replacing signature type"""
     ns = MessageNamespace()
     # We replace the fundamental signature type with our custom type,
     # then we load in all the csv files so they use it.
@@ -17,21 +103,89 @@ def make_namespace(csv: List[str]) -> MessageNamespace:
     return ns
 
 
-def peer_message_namespace() -> MessageNamespace:
+def make_namespace(csv: List[str]) -> "MessageNamespace":
+    """Load a namespace, replacing signature type.
+
+    The result is cached (in memory, and on disk if cache_dir()) and
+    shared by everyone asking for the same csv, so don't modify it!"""
+    digest = csv_digest(csv)
+    ns = _namespaces.get(digest)
+    if ns is None:
+        ns = _load_cached(digest)
+        if ns is None:
+            ns = _build_namespace(csv)
+            _save_cached(digest, ns)
+        _namespaces[digest] = ns
+    return ns
+
+
+def peer_message_csv() -> List[str]:
+    """The csv lines for all the peer messages"""
+    import pyln.spec.bolt1
+    import pyln.spec.bolt2
+    import pyln.spec.bolt7
+
+    return pyln.spec.bolt1.csv + pyln.spec.bolt2.csv + pyln.spec.bolt7.csv
+
+
+def peer_message_namespace() -> "MessageNamespace":
     """Namespace containing all the peer messages"""
-    return make_namespace(
-        pyln.spec.bolt1.csv + pyln.spec.bolt2.csv + pyln.spec.bolt7.csv
-    )
+    return make_namespace(peer_message_csv())
 
 
-def namespace() -> MessageNamespace:
+def namespace() -> "MessageNamespace":
+    global event_namespace
+    # By default, include all peer message bolts
+    if event_namespace is None:
+        event_namespace = peer_message_namespace()
     return event_namespace
 
 
-def assign_namespace(ns: MessageNamespace) -> None:
+def assign_namespace(ns: Optional["MessageNamespace"]) -> None:
+    """Set the namespace used by events: None means the default one"""
     global event_namespace
     event_namespace = ns
 
 
-# By default, include all peer message bolts
-event_namespace = peer_message_namespace()
+# Built on first use by namespace().
+event_namespace: Optional["MessageNamespace"] = None
+
+
+def test_namespace_cache() -> None:
+    from .signature import SigType
+
+    csv = peer_message_csv()
+    old_dir = os.environ.get("LNPROTOTEST_CACHE_DIR")
+    with tempfile.TemporaryDirectory() as d:
+        os.environ["LNPROTOTEST_CACHE_DIR"] = d
+        try:
+            _namespaces.pop(csv_digest(csv), None)
+            ns = make_namespace(csv)
+            assert make_namespace(list(csv)) is ns
+            assert os.listdir(d) == ["ns-{}.pickle".format(csv_digest(csv))]
+
+            # A fresh process would load it back from disk.
+            _namespaces.clear()
+            ns2 = make_namespace(csv)
+            assert ns2 is not ns
+            assert isinstance(ns2.fundamentaltypes["signature"], SigType)
+            assert ns2.get_msgtype("ping").number == ns.get_msgtype("ping").number
+
+            # Extra lines are a different namespace.
+            extra = make_namespace(csv + ["msgtype,lnprototest_test,65001"])
+            assert extra is not ns2
+            assert extra.get_msgtype("lnprototest_test") is not None
+            assert ns2.get_msgtype("lnprototest_test") is None
+
+            # Without LNPROTOTEST_CACHE_DIR, we don't touch the disk.
+            del os.environ["LNPROTOTEST_CACHE_DIR"]
+            assert cache_dir() is None
+            _namespaces.clear()
+            make_namespace(csv + ["msgtype,lnprototest_test,65002"])
+            assert len(os.listdir(d)) == 2
+        finally:
+            if old_dir is None:
+                os.environ.pop("LNPROTOTEST_CACHE_DIR", None)
+            else:
+                os.environ["LNPROTOTEST_CACHE_DIR"] = old_dir
+            _namespaces.clear()
@@ -0,0 +1,207 @@
+#! /usr/bin/python3
+# Sustained ping/pong load against the node.
+#
+# Every other event does one thing and waits for the answer; this one keeps
+# `depth` pings in flight on each of several conns, so we measure how fast
+# the node (or, with the DummyRunner, lnprototest itself) can turn them
+# around.  Every pong is still checked against BOLT #1.
+import collections
+import logging
+import struct
+import time
+from typing import Any, Deque, Dict, List, TYPE_CHECKING
+
+from pyln.proto.message import Message
+
+from .codec import decode_msg, encode_msg
+from .errors import EventError, SpecFileError
+from .event import Event, ExpectMsg
+from .latency import LatencyHistogram
+from .namespace import namespace
+
+if TYPE_CHECKING:
+    # Otherwise a circular dependency
+    from .runner import Runner, Conn
+
+PONG_TYPE = struct.pack(">H", 19)
+
+
+class PingBench(Event):
+    """Send `pings` pings on each conn, `depth` at a time, asking for
+    num_pong_bytes in each pong.  Results go into the "PingBench" stash."""
+
+    def __init__(
+        self,
+        connprivkeys: List[str],
+        pings: int,
+        num_pong_bytes: int = 0,
+        byteslen: int = 0,
+        depth: int = 8,
+    ):
+        super().__init__()
+        # BOLT #1:
+        #  - if `num_pong_bytes` is less than 65532:
+        #    - MUST respond by sending a `pong` message, with `byteslen` equal
+        #     to `num_pong_bytes`.
+        #  - otherwise (`num_pong_bytes` is **not** less than 65532):
+        #    - MUST ignore the `ping`.
+        if not 0 <= num_pong_bytes < 65532:
+            raise SpecFileError(
+                self, "num_pong_bytes {} gets no pong".format(num_pong_bytes)
+            )
+        if depth < 1 or pings < 1:
+            raise SpecFileError(self, "Need at least one ping, and depth >= 1")
+        self.connprivkeys = connprivkeys
+        self.pings = pings
+        self.num_pong_bytes = num_pong_bytes
+        self.byteslen = byteslen
+        self.depth = depth
+
+    def _check_pong(self, binmsg: bytes) -> None:
+        # Cheaper than decoding: we only care that byteslen is right.
+        if len(binmsg) != 4 + self.num_pong_bytes or struct.unpack(
+            ">H", binmsg[2:4]
+        ) != (self.num_pong_bytes,):
+            raise EventError(
+                self,
+                "pong should have {} bytes: {}".format(
+                    self.num_pong_bytes, binmsg[:64].hex()
+                ),
+            )
+
+    def _not_pong(self, runner: "Runner", conn: "Conn", binmsg: bytes) -> None:
+        """Answer (or ignore) anything else, as ExpectMsg would"""
+        if conn.respond(runner, self, binmsg):
+            return
+        try:
+            msg = decode_msg(binmsg)
+        except ValueError as ve:
+            raise EventError(
+                self, "Runner gave bad msg {}: {}".format(binmsg.hex(), ve)
+            )
+        response = ExpectMsg.ignore_gossip_queries(msg)
+        if response is None:
+            raise EventError(self, "Expected pong, got {}".format(msg.to_str()))
+        for m in response:
+            runner.recv(self, conn, encode_msg(m))
+
+    def action(self, runner: "Runner") -> bool:
+        super().action(runner)
+        conns = []
+        for key in self.connprivkeys:
+            conn = runner.find_conn(key)
+            if conn is None:
+                raise SpecFileError(self, "Unknown conn {}".format(key))
+            conns.append(conn)
+
+        ping = encode_msg(
+            Message(
+                namespace().get_msgtype("ping"),
+                num_pong_bytes=self.num_pong_bytes,
+                ignored=bytes(self.byteslen),
+            )
+        )
+        # The DummyRunner makes up whatever it's asked for: this pong.
+        expect = {
+            conn.name: ExpectMsg(
+                "pong", connprivkey=conn.name, ignored="00" * self.num_pong_bytes
+            )
+            for conn in conns
+        }
+        inflight: Dict[str, Deque[float]] = {c.name: collections.deque() for c in conns}
+        sent = {c.name: 0 for c in conns}
+        latencies = {c.name: LatencyHistogram() for c in conns}
+
+        def send(conn: "Conn") -> None:
+            inflight[conn.name].append(time.perf_counter())
+            runner.recv(self, conn, ping)
+            sent[conn.name] += 1
+
+        start = time.perf_counter()
+        for conn in conns:
+            while sent[conn.name] < min(self.depth, self.pings):
+                send(conn)
+
+        busy = list(conns)
+        while busy:
+            for conn in list(busy):
+                binmsg = runner.get_output_message(conn, expect[conn.name])
+                arrived = time.perf_counter()
+                if binmsg is None:
+                    raise EventError(
+                        self,
+                        "No pong from runner ({} outstanding)".format(
+                            len(inflight[conn.name])
+                        ),
+                    )
+                if not binmsg.startswith(PONG_TYPE):
+                    self._not_pong(runner, conn, binmsg)
+                    continue
+                self._check_pong(binmsg)
+                latencies[conn.name].record_seconds(
+                    arrived - inflight[conn.name].popleft()
+                )
+                if sent[conn.name] < self.pings:
+                    send(conn)
+                elif not inflight[conn.name]:
+                    busy.remove(conn)
+        elapsed = time.perf_counter() - start
+
+        overall = LatencyHistogram()
+        for hist in latencies.values():
+            overall.merge(hist)
+        pongs = overall.count
+        # Message bytes, both directions (without BOLT #8 overhead).
+        msgbytes = pongs * (len(ping) + 4 + self.num_pong_bytes)
+        results: Dict[str, Any] = {
+            "conns": len(conns),
+            "pongs": pongs,
+            "seconds": elapsed,
+            "msgs_per_sec": 2 * pongs / elapsed,
+            "bytes_per_sec": msgbytes / elapsed,
+            "latency": overall.to_dict(),
+            "conn_latency": {name: h.to_dict() for name, h in latencies.items()},
+        }
+        logging.info(
+            "{}: {} pongs in {:.3f}s, {:.0f} msgs/sec, {:.0f} bytes/sec,"
+            " p50 {}us p99 {}us".format(
+                self,
+                pongs,
+                elapsed,
+                results["msgs_per_sec"],
+                results["bytes_per_sec"],
+                overall.percentile(50),
+                overall.percentile(99),
+            )
+        )
+        runner.add_stash("PingBench", results)
+        return True
+
+
+def test_pingbench() -> None:
+    from .dummyrunner import DummyRunner
+    from .event import Connect
+
+    class config(object):
+        def getoption(self, name: str) -> Any:
+            return False
+
+    runner = DummyRunner(config())
+    runner.run(
+        [
+            Connect(connprivkey="02"),
+            Connect(connprivkey="03"),
+            PingBench(["02", "03"], pings=20, num_pong_bytes=65531, depth=3),
+        ]
+    )
+    results = runner.stash["PingBench"]
+    assert results["conns"] == 2 and results["pongs"] == 40
+    assert results["latency"]["count"] == 40
+    assert set(results["conn_latency"]) == {"02", "03"}
+    assert results["bytes_per_sec"] > 65531 * results["msgs_per_sec"] / 2
+
+    try:
+        PingBench(["02"], pings=1, num_pong_bytes=65532)
+        assert False, "should not accept a ping which gets no pong"
+    except SpecFileError:
+        pass
@@ -0,0 +1,182 @@
+#! /usr/bin/python3
+# Memoization of callable event arguments ("resolvers").
+#
+# OneOf and AnyOrder try every candidate sequence against every message
+# they receive, and DummyRunner resolves each ExpectMsg twice, so the same
+# rcvd() or commitsig_to_send() gets called over and over with nothing
+# having changed in between.  Signature resolvers rebuild the whole
+# commitment transaction each time.  We remember each result until the
+# step ends, the stash changes, or the Commit is modified.
+import functools
+import types
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .event import Event
+    from .runner import Runner
+
+
+def _freeze(vals: Tuple[Any, ...], depth: int) -> Optional[Tuple[Hashable, ...]]:
+    """A hashable key for captured values, or None if we can't make one"""
+    ret = []
+    for v in vals:
+        if callable(v) and not isinstance(v, type):
+            k = resolver_key(v, depth + 1)
+        else:
+            try:
+                hash(v)
+            except TypeError:
+                return None
+            # Don't let 1 and True (say) be the same resolver.
+            k = (type(v), v)
+        if k is None:
+            return None
+        ret.append(k)
+    return tuple(ret)
+
+
+def resolver_key(fn: Callable[..., Any], depth: int = 0) -> Optional[Hashable]:
+    """Two resolvers with the same key compute the same thing.
+
+    Each call to rcvd("foo") or commitsig_to_send() returns a new
+    function object, so we key on the code and the captured values
+    instead.  Returns None if fn can't be cached (a bound method, say, or
+    something which captured a list)."""
+    # A function which captures itself would recurse forever.
+    if depth > 8:
+        return None
+    if isinstance(fn, functools.partial):
+        func = resolver_key(fn.func, depth + 1)
+        args = _freeze(fn.args, depth)
+        kwargs = _freeze(tuple(sorted(fn.keywords.items())), depth)
+        if func is None or args is None or kwargs is None:
+            return None
+        return ("partial", func, args, kwargs)
+
+    if isinstance(fn, types.FunctionType):
+        try:
+            cells = tuple(c.cell_contents for c in fn.__closure__ or ())
+        except ValueError:
+            # Closure variable not assigned yet.
+            return None
+        captured = _freeze(cells + (fn.__defaults__ or ()), depth)
+        if captured is None:
+            return None
+        return (fn.__code__, captured)
+
+    return None
+
+
+class ResolutionContext(object):
+    """Resolver results for the current step of a path.
+
+    Each runner has one; Event.action() starts a new step, and the runner
+    invalidates it whenever the stash changes.  Results which used the
+    Commit are also tagged with its state, so modifying it in place
+    (adding HTLCs, bumping the commitment number) is noticed too.
+    """
+
+    def __init__(self) -> None:
+        self._cache: Dict[Hashable, Tuple[Any, Any]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def new_step(self) -> None:
+        self._cache.clear()
+
+    def invalidate(self) -> None:
+        self._cache.clear()
+
+    def resolve(
+        self,
+        runner: "Runner",
+        event: "Event",
+        field: str,
+        fn: Callable[["Runner", "Event", str], Any],
+    ) -> Any:
+        fnkey = resolver_key(fn)
+        if fnkey is None:
+            return fn(runner, event, field)
+
+        key = (fnkey, field)
+        commit: Any = runner.stash.get("Commit")
+        state = commit.state() if hasattr(commit, "state") else None
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] == state:
+            self.hits += 1
+            return cached[1]
+
+        self.misses += 1
+        val = fn(runner, event, field)
+        self._cache[key] = (state, val)
+        return val
+
+
+def test_resolver_key() -> None:
+    def rcvd(name: str) -> Callable[[Any, Any, str], str]:
+        def _rcvd(runner: Any, event: Any, field: str) -> str:
+            return name
+
+        return _rcvd
+
+    def _member(stashname: Any, runner: Any, event: Any, field: str) -> str:
+        return stashname
+
+    assert resolver_key(rcvd("a")) == resolver_key(rcvd("a"))
+    assert resolver_key(rcvd("a")) != resolver_key(rcvd("b"))
+    assert resolver_key(functools.partial(_member, "Msg")) == resolver_key(
+        functools.partial(_member, "Msg")
+    )
+    assert resolver_key(functools.partial(_member, "Msg")) != resolver_key(
+        functools.partial(_member, "ExpectMsg")
+    )
+    assert resolver_key(functools.partial(_member, 1)) != resolver_key(
+        functools.partial(_member, True)
+    )
+    # Captured a list: it could change under us.
+    assert resolver_key(functools.partial(_member, [])) is None
+    assert resolver_key(ResolutionContext().new_step) is None
+
+
+def test_resolution_context() -> None:
+    class FakeCommit(object):
+        def __init__(self) -> None:
+            self.commitnum = 0
+
+        def state(self) -> int:
+            return self.commitnum
+
+    class FakeRunner(object):
+        def __init__(self) -> None:
+            self.stash: Dict[str, Any] = {"Commit": FakeCommit()}
+            self.calls: List[str] = []
+
+    # (If this captured a list of calls, it wouldn't be cached!)
+    def sig_to_send() -> Callable[[Any, Any, str], int]:
+        def _sig_to_send(runner: Any, event: Any, field: str) -> int:
+            runner.calls.append(field)
+            return runner.stash["Commit"].commitnum
+
+        return _sig_to_send
+
+    ctx = ResolutionContext()
+    runner: Any = FakeRunner()
+    calls = runner.calls
+    event: Any = None
+    # Every candidate in a OneOf makes its own resolver: we only call one.
+    assert ctx.resolve(runner, event, "signature", sig_to_send()) == 0
+    assert ctx.resolve(runner, event, "signature", sig_to_send()) == 0
+    assert calls == ["signature"] and ctx.hits == 1
+
+    # Different field, different answer (potentially).
+    ctx.resolve(runner, event, "other", sig_to_send())
+    assert calls == ["signature", "other"]
+
+    # Commit modified in place.
+    runner.stash["Commit"].commitnum += 1
+    assert ctx.resolve(runner, event, "signature", sig_to_send()) == 1
+    assert len(calls) == 3
+
+    ctx.invalidate()
+    ctx.resolve(runner, event, "signature", sig_to_send())
+    assert len(calls) == 4
@@ -6,12 +6,15 @@ import tempfile
 import coincurve
 import functools
 
-from .bitfield import bitfield
-from .errors import SpecFileError
+from .bitfield import bitfield, FeatureBits
+from .errors import EventError, SpecFileError
 from .structure import Sequence
 from .event import Event, MustNotMsg, ExpectMsg
 from .utils import privkey_expand
 from .keyset import KeySet
+from .resolution import ResolutionContext
+from .latency import LatencyRecorder
+from .snapshot import RunnerSnapshot, SnapshotStore, copy_stash
 from abc import ABC, abstractmethod
 from typing import Dict, Optional, List, Union, Any, Callable
 
@@ -27,6 +30,23 @@ class Conn(object):
         self.pubkey = coincurve.PublicKey.from_secret(self.connprivkey.secret)
         self.expected_error = False
         self.must_not_events: List[MustNotMsg] = []
+        # Answers some messages from the node itself (e.g. a GossipStore):
+        # returns the raw replies, or None if it's not interested.
+        self.responder: Optional[Callable[[bytes], Optional[List[bytes]]]] = None
+
+    def respond(self, runner: "Runner", event: Event, binmsg: bytes) -> bool:
+        """If our responder answers binmsg, send its replies and return True"""
+        if self.responder is None:
+            return False
+        try:
+            replies = self.responder(binmsg)
+        except ValueError as ve:
+            raise EventError(event, "Bad msg {}: {}".format(binmsg[:64].hex(), ve))
+        if replies is None:
+            return False
+        for reply in replies:
+            runner.recv(event, self, reply)
+        return True
 
     def __str__(self) -> str:
         return self.name
@@ -45,7 +65,15 @@ class Runner(ABC):
         # key == connprivkey, value == Conn
         self.conns: Dict[str, Conn] = {}
         self.last_conn: Optional[Conn] = None
-        self.stash: Dict[str, Dict[str, Any]] = {}
+        self.stash: Dict[str, Any] = {}
+        # If set, the ExpectMsg/Msg stashes only keep this many messages.
+        self.stash_limit: Optional[int] = None
+        # Memoized results of callable event arguments.
+        self.resolution = ResolutionContext()
+        # Response times of the node, per conn and message pair.
+        self.latency = LatencyRecorder()
+        # If set, Snapshot events save and restore state here.
+        self.snapshots: Optional[SnapshotStore] = None
         self.logger = logging.getLogger(__name__)
         if self.config.getoption("verbose"):
             self.logger.setLevel(logging.DEBUG)
@@ -91,6 +119,8 @@ class Runner(ABC):
         self.conns = {}
         self.last_conn = None
         self.stash = {}
+        self.resolution.invalidate()
+        self.latency.forget_pending()
 
     # FIXME: Why can't we use SequenceUnion here?
     def run(self, events: Union[Sequence, List[Event], Event]) -> None:
@@ -104,9 +134,29 @@ class Runner(ABC):
                 return
             self.restart()
 
+    def snapshot(self, event: Event, directory: str) -> Optional[RunnerSnapshot]:
+        """Save where we are (node state in directory) so restore() can
+        bring us back here, or return None if we can't.  Connections
+        are closed (and checked, as at the end of a run)."""
+        for conn in list(self.conns.values()):
+            self.disconnect(event, conn)
+        self.last_conn = None
+        return RunnerSnapshot(self.stash, self.getblockheight(), directory)
+
+    def restore(self, event: Event, snapshot: RunnerSnapshot) -> bool:
+        """Go back to snapshot, with no connections: False if we can't"""
+        for conn in list(self.conns.values()):
+            self.disconnect(event, conn)
+        self.last_conn = None
+        self.stash = copy_stash(snapshot.stash)
+        self.resolution.invalidate()
+        self.latency.forget_pending()
+        return True
+
     def add_stash(self, stashname: str, vals: Any) -> None:
         """Add a dict to the stash."""
         self.stash[stashname] = vals
+        self.resolution.invalidate()
 
     def get_stash(self, event: Event, stashname: str, default: Any = None) -> Any:
         """Get an entry from the stash."""
@@ -125,12 +175,12 @@ class Runner(ABC):
         self,
         additional_features: Optional[List[int]] = None,
         globals: bool = False,
-    ) -> str:
+    ) -> FeatureBits:
         """
         Provide the features required by the node.
         """
         if additional_features is None:
-            return ""
+            return FeatureBits()
         else:
             return bitfield(*additional_features)
 
@@ -0,0 +1,184 @@
+#! /usr/bin/python3
+# BIP143 (segwit v0) signature hashes, with cached per-transaction midstates.
+import struct
+import collections
+import bitcoin.core
+import bitcoin.core.script as script
+from bitcoin.core.serialize import BytesSerializer
+from typing import Any, Dict, Optional, Tuple
+
+# (nVersion, nLockTime, ((prevout_hash, prevout_n, nSequence), ...),
+#  ((nValue, scriptPubKey), ...))
+MidstateKey = Tuple[int, int, Tuple[Tuple[bytes, int, int], ...], Tuple[Any, ...]]
+
+
+class SighashMidstate(object):
+    """The parts of a BIP143 signature hash which only depend on the
+    transaction: hashPrevouts, hashSequence and hashOutputs.
+
+    These are computed once, on demand, and reused for every input and
+    sighash type.  We only keep a copy of the transaction fields, so later
+    changes to the transaction object don't corrupt us.
+    """
+
+    def __init__(self, key: MidstateKey):
+        self.version, self.locktime, self.inputs, self.outputs = key
+        self._hash_prevouts: Optional[bytes] = None
+        self._hash_sequence: Optional[bytes] = None
+        self._hash_outputs: Optional[bytes] = None
+        self._hash_single: Dict[int, bytes] = {}
+
+    @staticmethod
+    def key(tx: bitcoin.core.CTransaction) -> MidstateKey:
+        """Content address for tx: everything BIP143 commits to, bar the input"""
+        return (
+            tx.nVersion,
+            tx.nLockTime,
+            tuple((i.prevout.hash, i.prevout.n, i.nSequence) for i in tx.vin),
+            tuple((o.nValue, bytes(o.scriptPubKey)) for o in tx.vout),
+        )
+
+    @staticmethod
+    def _outpoint(inp: Tuple[bytes, int, int]) -> bytes:
+        return inp[0] + struct.pack("<I", inp[1])
+
+    @staticmethod
+    def _output(out: Tuple[int, bytes]) -> bytes:
+        return struct.pack("<q", out[0]) + BytesSerializer.serialize(out[1])
+
+    def hash_prevouts(self) -> bytes:
+        if self._hash_prevouts is None:
+            self._hash_prevouts = bitcoin.core.Hash(
+                b"".join(self._outpoint(i) for i in self.inputs)
+            )
+        return self._hash_prevouts
+
+    def hash_sequence(self) -> bytes:
+        if self._hash_sequence is None:
+            self._hash_sequence = bitcoin.core.Hash(
+                b"".join(struct.pack("<I", i[2]) for i in self.inputs)
+            )
+        return self._hash_sequence
+
+    def hash_outputs(self) -> bytes:
+        if self._hash_outputs is None:
+            self._hash_outputs = bitcoin.core.Hash(
+                b"".join(self._output(o) for o in self.outputs)
+            )
+        return self._hash_outputs
+
+    def hash_single_output(self, idx: int) -> bytes:
+        if idx not in self._hash_single:
+            self._hash_single[idx] = bitcoin.core.Hash(self._output(self.outputs[idx]))
+        return self._hash_single[idx]
+
+    def signature_hash(
+        self, redeemscript: bytes, inIdx: int, hashtype: int, amount: int
+    ) -> bytes:
+        """Same result as script.SignatureHash(..., sigversion=SIGVERSION_WITNESS_V0)"""
+        zero = bytes(32)
+        basetype = hashtype & 0x1F
+        anyonecanpay = hashtype & script.SIGHASH_ANYONECANPAY
+
+        hash_prevouts = zero if anyonecanpay else self.hash_prevouts()
+        if anyonecanpay or basetype in (script.SIGHASH_SINGLE, script.SIGHASH_NONE):
+            hash_sequence = zero
+        else:
+            hash_sequence = self.hash_sequence()
+
+        if basetype not in (script.SIGHASH_SINGLE, script.SIGHASH_NONE):
+            hash_outputs = self.hash_outputs()
+        elif basetype == script.SIGHASH_SINGLE and inIdx < len(self.outputs):
+            hash_outputs = self.hash_single_output(inIdx)
+        else:
+            hash_outputs = zero
+
+        inp = self.inputs[inIdx]
+        return bitcoin.core.Hash(
+            struct.pack("<i", self.version)
+            + hash_prevouts
+            + hash_sequence
+            + self._outpoint(inp)
+            + BytesSerializer.serialize(bytes(redeemscript))
+            + struct.pack("<q", amount)
+            + struct.pack("<I", inp[2])
+            + hash_outputs
+            + struct.pack("<i", self.locktime)
+            + struct.pack("<i", hashtype)
+        )
+
+
+# We sign the same commitment, HTLC and funding txs again and again (often
+# rebuilt from scratch), so keep the most recent midstates around.
+MIDSTATE_CACHE_SIZE = 256
+_midstates: "collections.OrderedDict[MidstateKey, SighashMidstate]" = (
+    collections.OrderedDict()
+)
+
+
+def midstate(tx: bitcoin.core.CTransaction) -> SighashMidstate:
+    """Get the (cached) BIP143 midstate for this transaction"""
+    key = SighashMidstate.key(tx)
+    ms = _midstates.get(key)
+    if ms is None:
+        ms = SighashMidstate(key)
+        _midstates[key] = ms
+        if len(_midstates) > MIDSTATE_CACHE_SIZE:
+            _midstates.popitem(last=False)
+    else:
+        _midstates.move_to_end(key)
+    return ms
+
+
+def signature_hash(
+    redeemscript: bytes,
+    txTo: bitcoin.core.CTransaction,
+    inIdx: int,
+    hashtype: int,
+    amount: int,
+) -> bytes:
+    """Drop-in for script.SignatureHash(..., sigversion=SIGVERSION_WITNESS_V0)"""
+    return midstate(txTo).signature_hash(redeemscript, inIdx, hashtype, amount)
+
+
+def test_signature_hash() -> None:
+    from bitcoin.core import COutPoint, CTxIn, CTxOut, CMutableTransaction
+
+    tx = CMutableTransaction(
+        [
+            CTxIn(COutPoint(bytes([i]) * 32, i), nSequence=0xFFFFFFFD - i)
+            for i in range(3)
+        ],
+        [
+            CTxOut(1000 * (i + 1), script.CScript([script.OP_0, bytes(20)]))
+            for i in range(2)
+        ],
+        nVersion=2,
+        nLockTime=101,
+    )
+    redeemscript = script.CScript([script.OP_1, script.OP_CHECKSIG])
+
+    for hashtype in (
+        script.SIGHASH_ALL,
+        script.SIGHASH_NONE,
+        script.SIGHASH_SINGLE,
+        script.SIGHASH_ALL | script.SIGHASH_ANYONECANPAY,
+        script.SIGHASH_NONE | script.SIGHASH_ANYONECANPAY,
+        script.SIGHASH_SINGLE | script.SIGHASH_ANYONECANPAY,
+    ):
+        for idx in range(len(tx.vin)):
+            assert signature_hash(
+                redeemscript, tx, idx, hashtype, 5000
+            ) == script.SignatureHash(
+                redeemscript,
+                tx,
+                idx,
+                hashtype,
+                amount=5000,
+                sigversion=script.SIGVERSION_WITNESS_V0,
+            )
+
+    # Mutating the tx must not give us a stale midstate.
+    before = signature_hash(redeemscript, tx, 0, script.SIGHASH_ALL, 5000)
+    tx.vout[0] = CTxOut(1001, tx.vout[0].scriptPubKey)
+    assert signature_hash(redeemscript, tx, 0, script.SIGHASH_ALL, 5000) != before
@@ -1,10 +1,21 @@
 #! /usr/bin/python3
 import coincurve
+import functools
 from io import BufferedIOBase
 from pyln.proto.message import FieldType, split_field
 from .utils import check_hex, privkey_expand
 from typing import Union, Tuple, Dict, Any, Optional, cast
 
+# We compare the same signatures again and again (e.g. every TryAll path
+# re-checks the same commitment_signed), so remember the answers.
+VERIFY_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=VERIFY_CACHE_SIZE)
+def verify_sig(pubkey: bytes, hashval: bytes, sigval: bytes) -> bool:
+    """Is the 64-byte sigval a valid signature of hashval by pubkey?"""
+    return coincurve.verify_signature(Sig.to_der(sigval), hashval, pubkey, hasher=None)
+
 
 class Sig(object):
     """The value of a signature, either as a privkey/hash pair or a raw
@@ -30,6 +41,9 @@ class Sig(object):
             self.sigval = None
             self.privkey = privkey_expand(args[0])
             self.hashval = bytes.fromhex(check_hex(args[1], 64))
+            # We only sign (and derive the pubkey) when someone asks.
+            self._signed: Optional[bytes] = None
+            self._pubkey: Optional[bytes] = None
         else:
             raise TypeError("Expected hexsig or Privkey, hash")
 
@@ -87,13 +101,17 @@ class Sig(object):
             a = othersig
             b = self
         # A has a privkey/hash, B has a sigval.
-        pubkey = coincurve.PublicKey.from_secret(a.privkey.secret)
         assert b.sigval is not None
-        if coincurve.verify_signature(
-            self.to_der(b.sigval), a.hashval, pubkey.format(), hasher=None
-        ):
+        # We sign deterministically, so we usually produced this exact one.
+        if a._signed == b.sigval:
             return True
-        return False
+        return verify_sig(a.pubkey(), a.hashval, b.sigval)
+
+    def pubkey(self) -> bytes:
+        """The (compressed) pubkey for a privkey/hash Sig"""
+        if self._pubkey is None:
+            self._pubkey = coincurve.PublicKey.from_secret(self.privkey.secret).format()
+        return self._pubkey
 
     def to_str(self) -> str:
         if self.sigval:
@@ -102,6 +120,7 @@ class Sig(object):
             return "Sig({},{})".format(self.privkey.secret.hex(), self.hashval.hex())
 
     @staticmethod
+    @functools.lru_cache(maxsize=VERIFY_CACHE_SIZE)
     def from_str(s: str) -> Tuple["Sig", str]:
         a, b = split_field(s)
         if a.startswith("Sig("):
@@ -113,7 +132,11 @@ class Sig(object):
 
     def to_bin(self) -> bytes:
         if not self.sigval:
-            return self.from_der(self.privkey.sign(self.hashval, hasher=None))
+            if self._signed is None:
+                self._signed = self.from_der(
+                    self.privkey.sign(self.hashval, hasher=None)
+                )
+            return self._signed
         else:
             return self.sigval
 
@@ -160,3 +183,13 @@ def test_signature() -> None:
 
     assert s == s2
     assert s2 == s
+
+    # A signature of another hash isn't equal; a privkey/hash Sig equals
+    # a sigval which verifies over that hash, and comparing them again
+    # is a verify_sig cache hit.
+    s3 = Sig(Sig.from_der(s.privkey.sign(bytes(31) + bytes([1]), hasher=None)))
+    assert s3 != s
+    before = verify_sig.cache_info().hits
+    assert Sig("01", "00" * 31 + "01") == s3
+    assert Sig("01", "00" * 31 + "01") == s3
+    assert verify_sig.cache_info().hits == before + 1
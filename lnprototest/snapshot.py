@@ -0,0 +1,171 @@
+#! /usr/bin/python3
+# Run a common prefix (e.g. connect and open a channel) once per session,
+# and start every later test from a snapshot of where it left us.
+#
+# The runner saves the node (and its chain) as it sees fit, we save the
+# stash.  Connections can't be saved: they are closed when we snapshot,
+# and each user of the snapshot reconnects.
+import copy
+import logging
+import os
+import shutil
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, TYPE_CHECKING
+
+from .event import Event
+from .structure import Sequence
+
+if TYPE_CHECKING:
+    # Otherwise a circular dependency
+    from .runner import Runner
+
+
+def copy_stash(stash: Dict[str, Any]) -> Dict[str, Any]:
+    """A copy of stash which later events can change without affecting
+    the original.  Entries are copied shallowly: those which events
+    change in place (Commit, the message stashes) copy what they must."""
+    return {name: copy.copy(vals) for name, vals in stash.items()}
+
+
+class RunnerSnapshot(object):
+    """What Runner.snapshot() saved.  node holds whatever the runner
+    needs to restore the node, and directory is where it keeps files."""
+
+    def __init__(self, stash: Dict[str, Any], blockheight: int, directory: str):
+        self.stash = copy_stash(stash)
+        self.blockheight = blockheight
+        self.directory = directory
+        self.node: Dict[str, Any] = {}
+
+
+class SnapshotStore(object):
+    """Snapshots by name: one of these is shared by every test in a
+    session, whichever runner they use."""
+
+    def __init__(self) -> None:
+        self.snapshots: Dict[str, RunnerSnapshot] = {}
+        self.basedir: Optional[str] = None
+        self.stats: Dict[str, float] = {
+            "taken": 0,
+            "restored": 0,
+            # How long the prefixes took, and restoring took.
+            "prefix_seconds": 0.0,
+            "restore_seconds": 0.0,
+        }
+
+    def directory(self) -> str:
+        """A fresh directory for a runner to save a snapshot in"""
+        if self.basedir is None:
+            self.basedir = tempfile.mkdtemp(prefix="lnpt-snap-")
+        return tempfile.mkdtemp(dir=self.basedir)
+
+    def get(self, name: str) -> Optional[RunnerSnapshot]:
+        return self.snapshots.get(name)
+
+    def add(self, name: str, snapshot: RunnerSnapshot) -> None:
+        self.snapshots[name] = snapshot
+
+    def cleanup(self) -> None:
+        logging.debug("snapshots: {}".format(self.stats))
+        self.snapshots = {}
+        if self.basedir is not None:
+            shutil.rmtree(self.basedir, ignore_errors=True)
+            self.basedir = None
+
+
+class Snapshot(Sequence):
+    """Run events, unless the runner's snapshots already has one called
+    name, in which case restore that instead.  Then run reconnect, since
+    connections don't survive a snapshot.
+
+    Without runner.snapshots (or if the runner can't snapshot) this is
+    just a Sequence of events.  name must identify everything the events
+    do, since any test using the same name gets the same snapshot."""
+
+    def __init__(self, name: str, events: List[Event], reconnect: List[Event] = []):
+        super().__init__(events)
+        self.snapshot_name = name
+        self.reconnect = Sequence(reconnect)
+
+    def action(self, runner: "Runner", skip_first: bool = False) -> bool:
+        store = runner.snapshots
+        if store is None:
+            return super().action(runner, skip_first)
+
+        start = time.perf_counter()
+        snapshot = store.get(self.snapshot_name)
+        if snapshot is not None and runner.restore(self, snapshot):
+            store.stats["restored"] += 1
+            store.stats["restore_seconds"] += time.perf_counter() - start
+            logging.debug("{}: restored {}".format(self, self.snapshot_name))
+        else:
+            if not super().action(runner, skip_first):
+                # Not every path was taken: that's not a state to save.
+                return False
+            store.stats["prefix_seconds"] += time.perf_counter() - start
+            snapshot = runner.snapshot(self, store.directory())
+            if snapshot is None:
+                # Runner couldn't, and we're still connected.
+                return True
+            store.add(self.snapshot_name, snapshot)
+            store.stats["taken"] += 1
+            logging.debug("{}: took {}".format(self, self.snapshot_name))
+        return self.reconnect.action(runner)
+
+
+def test_snapshot() -> None:
+    from .dummyrunner import DummyRunner
+    from .event import Block, Connect, Msg
+    from .stash import sent
+
+    class config(object):
+        def getoption(self, name: str) -> Any:
+            return False
+
+    def test(store: Optional[SnapshotStore]) -> DummyRunner:
+        runner = DummyRunner(config())
+        runner.snapshots = store
+        runner.run(
+            [
+                Snapshot(
+                    "ping",
+                    [
+                        Block(blockheight=102, number=5),
+                        Connect(connprivkey="02"),
+                        Msg("ping", num_pong_bytes=1, ignored="00"),
+                    ],
+                    reconnect=[Connect(connprivkey="02")],
+                ),
+                Msg(
+                    "ping", num_pong_bytes=sent("ping.num_pong_bytes", int), ignored=""
+                ),
+            ]
+        )
+        return runner
+
+    # Without a store, it's just a Sequence.
+    runner = test(None)
+    assert runner.getblockheight() == 106
+    assert len(runner.stash["Msg"]) == 2
+
+    store = SnapshotStore()
+    first = test(store)
+    assert store.stats["taken"] == 1 and store.stats["restored"] == 0
+    saved = store.get("ping")
+    assert saved is not None and len(saved.stash["Msg"]) == 1
+
+    # Second time, we restore: the prefix isn't run, but its stash is there.
+    second = test(store)
+    assert store.stats["taken"] == 1 and store.stats["restored"] == 1
+    assert second.getblockheight() == 106
+    msgs: Any = second.stash["Msg"]
+    assert [m.name for m in msgs] == ["ping", "ping"]
+    assert msgs[1].fields["num_pong_bytes"] == 1
+    assert msgs is not first.stash["Msg"]
+    # Neither run touched the snapshot itself.
+    assert len(saved.stash["Msg"]) == 1
+
+    assert store.basedir is not None and os.path.isdir(store.basedir)
+    store.cleanup()
+    assert store.basedir is None and store.get("ping") is None
@@ -27,6 +27,8 @@ from .stash import (
     funding_close_tx,
     htlc_sigs_to_send,
     htlc_sigs_to_recv,
+    local_per_commitment_point,
+    local_per_commitment_secret,
     locking_script,
     witnesses,
     stash_field_from_event,
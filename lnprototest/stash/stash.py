@@ -6,6 +6,7 @@ from typing import Callable, Optional, Any
 from pyln.proto.message import Message
 
 from lnprototest import Runner, Event, Side, SpecFileError, Funding
+from lnprototest.msgstash import MsgStash
 
 
 def commitsig_to_send() -> Callable[[Runner, Event, str], str]:
@@ -52,6 +53,24 @@ def channel_id() -> Callable[[Runner, Event, str], str]:
     return _channel_id
 
 
+def local_per_commitment_secret(n: int) -> Callable[[Runner, Event, str], str]:
+    """Get our per-commitment secret n for the current Commit"""
+
+    def _local_per_commitment_secret(runner: Runner, event: Event, field: str) -> str:
+        return runner.get_stash(event, "Commit").keyset[Side.local].per_commit_secret(n)
+
+    return _local_per_commitment_secret
+
+
+def local_per_commitment_point(n: int) -> Callable[[Runner, Event, str], str]:
+    """Get our per-commitment point n for the current Commit"""
+
+    def _local_per_commitment_point(runner: Runner, event: Event, field: str) -> str:
+        return runner.get_stash(event, "Commit").keyset[Side.local].per_commit_point(n)
+
+    return _local_per_commitment_point
+
+
 def channel_id_v2() -> Callable[[Runner, Event, str], str]:
     """Get the channel_id for the current Commit for a v2 channel open"""
 
@@ -144,12 +163,16 @@ def get_member(
         prevname, _, var = var.partition(".")
     else:
         prevname = ""
-    if last:
-        seq = reversed(stash)
+
+    if isinstance(stash, MsgStash):
+        entry = (stash.last if last else stash.first)(prevname or None)
+        found = [] if entry is None else [entry]
+    elif last:
+        found = reversed(stash)
     else:
-        seq = stash
+        found = stash
 
-    for name, d in seq:
+    for name, d in found:
         if prevname == "" or name == prevname:
             if var not in d:
                 raise SpecFileError(
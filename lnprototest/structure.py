@@ -1,10 +1,9 @@
 #! /usr/bin/python3
-import io
 import logging
 
 from .event import Event, ExpectMsg, ResolvableBool
 from .errors import SpecFileError, EventError
-from .namespace import namespace
+from .codec import encode_msg, decode_msg
 from pyln.proto.message import Message
 from typing import Union, List, Optional, TYPE_CHECKING, cast
 
@@ -113,9 +112,12 @@ class OneOf(Event):
             binmsg = runner.get_output_message(conn, event)
             if binmsg is None:
                 raise EventError(self, f"Did not receive a message {event} from runner")
+            runner.latency.arrived(conn)
+            if conn.respond(runner, self, binmsg):
+                continue
 
             try:
-                msg = Message.read(namespace(), io.BytesIO(binmsg))
+                msg = decode_msg(binmsg)
             except ValueError as ve:
                 raise EventError(self, "Invalid msg {}: {}".format(binmsg.hex(), ve))
 
@@ -123,9 +125,7 @@ class OneOf(Event):
             # If they gave us responses, send those now.
             if ignored is not None:
                 for msg in ignored:
-                    binm = io.BytesIO()
-                    msg.write(binm)
-                    runner.recv(self, conn, binm.getvalue())
+                    runner.recv(self, conn, encode_msg(msg))
                 continue
 
             seq = Sequence.match_which_sequence(
@@ -184,9 +184,12 @@ class AnyOrder(Event):
                         [s.events[0] for s in sequences]
                     ),
                 )
+            runner.latency.arrived(conn)
+            if conn.respond(runner, self, binmsg):
+                continue
 
             try:
-                msg = Message.read(namespace(), io.BytesIO(binmsg))
+                msg = decode_msg(binmsg)
             except ValueError as ve:
                 raise EventError(self, "Invalid msg {}: {}".format(binmsg.hex(), ve))
 
@@ -194,9 +197,7 @@ class AnyOrder(Event):
             # If they gave us responses, send those now.
             if ignored is not None:
                 for msg in ignored:
-                    binm = io.BytesIO()
-                    msg.write(binm)
-                    runner.recv(self, conn, binm.getvalue())
+                    runner.recv(self, conn, encode_msg(msg))
                 continue
 
             seq = Sequence.match_which_sequence(runner, msg, sequences)
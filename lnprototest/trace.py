@@ -0,0 +1,87 @@
+#! /usr/bin/python3
+# Lazily evaluated debug tracing.
+#
+# We want to be able to see every raw message, transaction and RPC result
+# when debugging, but formatting them (hex-dumping a 65k pong, serializing
+# a commitment tx) is far from free, and almost always nobody is listening.
+# So trace points pass their fields as values or callables, and nothing is
+# formatted unless the logger is enabled for that level.
+import logging
+from typing import Any, Callable, Dict
+
+
+class Tracer(object):
+    """Structured trace points for one logger.
+
+    tracer.debug("raw msg", hex=lambda: binmsg.hex()) logs "raw msg
+    hex=...", and also attaches the evaluated fields to the record as
+    `trace_event` and `trace_fields` for handlers which want them.
+    """
+
+    def __init__(self, name: str):
+        self.logger = logging.getLogger(name)
+
+    def enabled(self, level: int = logging.DEBUG) -> bool:
+        return self.logger.isEnabledFor(level)
+
+    def log(self, level: int, event: str, **fields: Any) -> None:
+        if not self.logger.isEnabledFor(level):
+            return
+        vals: Dict[str, Any] = {k: v() if callable(v) else v for k, v in fields.items()}
+        msg = " ".join([event] + ["{}={}".format(k, v) for k, v in vals.items()])
+        self.logger.log(
+            level,
+            msg,
+            extra={"trace_event": event, "trace_fields": vals},
+            stacklevel=3,
+        )
+
+    def debug(self, event: str, **fields: Any) -> None:
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event: str, **fields: Any) -> None:
+        self.log(logging.INFO, event, **fields)
+
+
+def hexstr(val: Any) -> Callable[[], str]:
+    """Deferred hex encoding of val (anything with .hex() or .serialize())"""
+    if hasattr(val, "hex"):
+        return lambda: val.hex()
+    return lambda: val.serialize().hex()
+
+
+def test_tracer() -> None:
+    class Recorder(logging.Handler):
+        def __init__(self) -> None:
+            super().__init__()
+            self.records: list = []
+
+        def emit(self, record: logging.LogRecord) -> None:
+            self.records.append(record)
+
+    calls = []
+
+    def expensive() -> str:
+        calls.append(1)
+        return "deadbeef"
+
+    t = Tracer("lnprototest.test_tracer")
+    rec = Recorder()
+    t.logger.addHandler(rec)
+    t.logger.propagate = False
+    try:
+        t.logger.setLevel(logging.INFO)
+        t.debug("raw msg", hex=expensive)
+        assert calls == [] and rec.records == []
+        assert not t.enabled()
+
+        t.logger.setLevel(logging.DEBUG)
+        t.debug("raw msg", hex=expensive, num=7)
+        assert calls == [1]
+        assert rec.records[0].getMessage() == "raw msg hex=deadbeef num=7"
+        assert rec.records[0].trace_fields == {"hex": "deadbeef", "num": 7}
+        assert hexstr(b"\x01\x02")() == "0102"
+    finally:
+        t.logger.removeHandler(rec)
+        t.logger.propagate = True
+        t.logger.setLevel(logging.NOTSET)
@@ -23,4 +23,6 @@ from .bitcoin_utils import (
     funding_amount_for_utxo,
     tx_spendable,
     tx_out_for_index,
+    parse_tx,
+    txid_raw,
 )
@@ -4,15 +4,15 @@ work with bitcoin primitive.
 """
 
 import hashlib
+import functools
 
 from enum import Enum
-from typing import Tuple
+from typing import Dict, Tuple
 
 import bitcoin.core
 
 from bitcoin.core import Hash160, x
 from bitcoin.core.script import OP_0, OP_CHECKSIG, CScript
-from bitcoin.wallet import CBitcoinSecret
 
 
 class ScriptType(Enum):
@@ -48,6 +48,9 @@ class BitcoinUtils:
         word: str = "lnprototest",
     ) -> str:
         """Build a valid bitcoin script and hide the primitive of the library"""
+        # bitcoin.wallet drags in libssl via ctypes: only load it if needed.
+        from bitcoin.wallet import CBitcoinSecret
+
         secret_str = f"correct horse battery staple {word}"
         h = hashlib.sha256(secret_str.encode("ascii")).digest()
         seckey = CBitcoinSecret.from_secret_bytes(h)
@@ -123,40 +126,52 @@ class BitcoinUtils:
 tx_spendable = "0200000000010184591a56720aabc8023cecf71801c5e0f9d049d0c550ab42412ad12a67d89f3a0000000000feffffff0780841e0000000000160014fd9658fbd476d318f3b825b152b152aafa49bc9240420f000000000016001483440596268132e6c99d44dae2d151dabd9a2b232c180a2901000000160014d295f76da2319791f36df5759e45b15d5e105221c0c62d000000000016001454d14ae910793e930d8e33d3de0b0cbf05aa533300093d00000000001600141b42e1fc7b1cd93a469fa67ed5eabf36ce354dd620a107000000000016001406afd46bcdfd22ef94ac122aa11f241244a37ecc808d5b000000000022002000b068df6e0e0542e776cea5ebe8f5f1a9b40b531ddd8e94b1a7ff9829b5bbaa024730440220367b9bfed0565bad2137124f736373626fa3135e59b20a7b5c1d8f2b8f1b26bb02202f664de39787082a376d222487f02ef19e45696c041044a6d579eecabb68e94501210356609a904a7026c7391d3fbf71ad92a00e04b4cd2fb6a8d1e69cbc0998f6690a65000000"
 
 
-def utxo(index: int = 0) -> Tuple[str, int, int, str, int]:
-    """Helper to get a P2WPKH UTXO, amount, privkey and fee from the tx_spendable transaction"""
+# Parsed transactions are immutable, and the same hex (tx_spendable, the
+# prevtx of every tx_add_input...) gets parsed over and over, so we cache
+# them by content.
+TX_CACHE_SIZE = 256
 
-    amount = (index + 1) * 1000000
-    if index == 0:
-        txout = 1
-        key = "76edf0c303b9e692da9cb491abedef46ca5b81d32f102eb4648461b239cb0f99"
-    elif index == 1:
-        txout = 0
-        key = "bc2f48a76a6b8815940accaf01981d3b6347a68fbe844f81c50ecbadf27cd179"
-    elif index == 2:
-        txout = 3
-        key = "16c5027616e940d1e72b4c172557b3b799a93c0582f924441174ea556aadd01c"
-    elif index == 3:
-        txout = 4
-        key = "53ac43309b75d9b86bef32c5bbc99c500910b64f9ae089667c870c2cc69e17a4"
-    elif index == 4:
-        txout = 2
-        key = "16be98a5d4156f6f3af99205e9bc1395397bca53db967e50427583c94271d27f"
-        amount = 4983494700
-    elif index == 5:
-        txout = 5
-        key = "0000000000000000000000000000000000000000000000000000000000000002"
-        amount = 500000
-    elif index == 6:
-        txout = 6
-        key = "38204720bc4f9647fd58c6d0a4bd3a6dd2be16d8e4273c4d1bdd5774e8c51eaf"
-        amount = 6000000
-    else:
-        raise ValueError("index must be 0-6 inclusive")
 
-    # Reasonable funding fee in sats
-    reasonable_funding_fee = 200
+@functools.lru_cache(maxsize=TX_CACHE_SIZE)
+def parse_tx(tx: str) -> bitcoin.core.CTransaction:
+    """Deserialize a hex transaction (cached: don't try to modify it!)"""
+    return bitcoin.core.CTransaction.deserialize(bytes.fromhex(tx))
+
+
+@functools.lru_cache(maxsize=TX_CACHE_SIZE)
+def raw_txid(tx: str) -> bytes:
+    """The txid of a hex transaction, in wire protocol order"""
+    return parse_tx(tx).GetTxid()
+
 
+# index: (txout, amount, privkey)
+_utxos: Dict[int, Tuple[int, int, str]] = {
+    0: (1, 1000000, "76edf0c303b9e692da9cb491abedef46ca5b81d32f102eb4648461b239cb0f99"),
+    1: (0, 2000000, "bc2f48a76a6b8815940accaf01981d3b6347a68fbe844f81c50ecbadf27cd179"),
+    2: (3, 3000000, "16c5027616e940d1e72b4c172557b3b799a93c0582f924441174ea556aadd01c"),
+    3: (4, 4000000, "53ac43309b75d9b86bef32c5bbc99c500910b64f9ae089667c870c2cc69e17a4"),
+    4: (
+        2,
+        4983494700,
+        "16be98a5d4156f6f3af99205e9bc1395397bca53db967e50427583c94271d27f",
+    ),
+    5: (5, 500000, "0000000000000000000000000000000000000000000000000000000000000002"),
+    6: (
+        6,
+        6000000,
+        "38204720bc4f9647fd58c6d0a4bd3a6dd2be16d8e4273c4d1bdd5774e8c51eaf",
+    ),
+}
+
+# Reasonable funding fee in sats
+reasonable_funding_fee = 200
+
+
+def utxo(index: int = 0) -> Tuple[str, int, int, str, int]:
+    """Helper to get a P2WPKH UTXO, amount, privkey and fee from the tx_spendable transaction"""
+    if index not in _utxos:
+        raise ValueError("index must be 0-6 inclusive")
+    txout, amount, key = _utxos[index]
     return txid_raw(tx_spendable), txout, amount, key, reasonable_funding_fee
 
 
@@ -179,4 +194,22 @@ def funding_amount_for_utxo(index: int = 0) -> int:
 
 def txid_raw(tx: str) -> str:
     """Helper to get the txid of a tx: note this is in wire protocol order, not bitcoin order!"""
-    return bitcoin.core.CTransaction.deserialize(bytes.fromhex(tx)).GetTxid().hex()
+    return raw_txid(tx).hex()
+
+
+def test_utxo() -> None:
+    # This used to be a long if/elif chain: check we didn't break it.
+    assert utxo(0) == (
+        bitcoin.core.CTransaction.deserialize(bytes.fromhex(tx_spendable))
+        .GetTxid()
+        .hex(),
+        1,
+        1000000,
+        "76edf0c303b9e692da9cb491abedef46ca5b81d32f102eb4648461b239cb0f99",
+        200,
+    )
+    assert [utxo_amount(i) for i in range(4)] == [(i + 1) * 1000000 for i in range(4)]
+    for i in range(7):
+        txout, amount = tx_out_for_index(i), utxo_amount(i)
+        assert parse_tx(tx_spendable).vout[txout].nValue == amount
+    assert parse_tx(tx_spendable) is parse_tx(tx_spendable)
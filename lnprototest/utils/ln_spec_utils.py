@@ -9,6 +9,8 @@ be used after this sequence of steps.
 author: Vincenzo PAlazzo https://github.com/vincenzopalazzo
 """
 
+import hashlib
+import json
 from typing import List, Optional
 
 
@@ -230,3 +232,93 @@ def open_and_announce_channel_helper(
             number=6,
         ),
     ]
+
+
+def reestablish_channel_helper(
+    runner: "Runner", conn_privkey: str = "02"
+) -> List["Event"]:
+    """Helper function to reconnect to the node, and reestablish the channel
+    open_and_announce_channel_helper() opened (nothing since)"""
+    from lnprototest import (
+        Connect,
+        ExpectMsg,
+        Msg,
+        remote_per_commitment_point,
+    )
+    from lnprototest.stash import channel_id, local_per_commitment_point
+
+    return [
+        Connect(connprivkey=conn_privkey),
+        ExpectMsg("init"),
+        Msg(
+            "init",
+            globalfeatures=runner.runner_features(globals=True),
+            features=runner.runner_features(),
+        ),
+        ExpectMsg(
+            "channel_reestablish",
+            ignore=ExpectMsg.ignore_all_gossip,
+            channel_id=channel_id(),
+            next_commitment_number=1,
+            next_revocation_number=0,
+            your_last_per_commitment_secret="00" * 32,
+        ),
+        Msg(
+            "channel_reestablish",
+            channel_id=channel_id(),
+            next_commitment_number=1,
+            next_revocation_number=0,
+            your_last_per_commitment_secret="00" * 32,
+            my_current_per_commitment_point=local_per_commitment_point(0),
+        ),
+        # BOLT #2:
+        #   - if `next_commitment_number` is 1 in both the `channel_reestablish` it
+        #     sent and received:
+        #     - MUST retransmit `channel_ready`.
+        ExpectMsg(
+            "channel_ready",
+            ignore=ExpectMsg.ignore_all_gossip,
+            channel_id=channel_id(),
+            second_per_commitment_point=remote_per_commitment_point(1),
+        ),
+        Msg(
+            "channel_ready",
+            channel_id=channel_id(),
+            second_per_commitment_point=local_per_commitment_point(1),
+        ),
+    ]
+
+
+def open_channel_snapshot_helper(
+    runner: "Runner",
+    tx_spendable: str,
+    conn_privkey: str = "02",
+    opts: Optional[dict] = None,
+) -> List["Event"]:
+    """connect_to_node_helper() then open_and_announce_channel_helper(), but
+    only once per session (if the runner has snapshots): later tests start
+    from a snapshot of the open channel, and reestablish it.
+
+    Only for tests which start from that channel: the reestablish is done
+    here, and whatever was sent on the original connection is gone."""
+    from lnprototest import Snapshot
+
+    if opts is None:
+        opts = {}
+    # Everything the events depend on, since tests with the same name
+    # share a snapshot.
+    inputs = {"conn_privkey": conn_privkey, "tx_spendable": tx_spendable, "opts": opts}
+    digest = hashlib.sha256(
+        json.dumps(inputs, sort_keys=True, default=repr).encode()
+    ).hexdigest()
+    name = "open_channel/{}/{}".format(conn_privkey, digest[:16])
+    events = connect_to_node_helper(
+        runner, tx_spendable=tx_spendable, conn_privkey=conn_privkey
+    ) + open_and_announce_channel_helper(runner, conn_privkey=conn_privkey, opts=opts)
+    return [
+        Snapshot(
+            name,
+            events,
+            reconnect=reestablish_channel_helper(runner, conn_privkey=conn_privkey),
+        )
+    ]
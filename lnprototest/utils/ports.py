@@ -0,0 +1,172 @@
+"""
+Port allocation shared by every runner, backend and pytest-xdist worker.
+
+Binding port 0, noting the number and closing the socket is racy: another
+worker can be handed the same port before our daemon binds it.  Instead
+each worker allocates from its own range (by PYTEST_XDIST_WORKER), and
+records its leases in a file under a lock, so even unrelated test runs on
+the same machine don't collide.  Leases of dead processes are reclaimed.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import socket
+import tempfile
+
+from contextlib import closing
+from typing import Dict, List, Optional
+
+# Each worker gets PORT_RANGE ports, starting at PORT_BASE for gw0.
+PORT_BASE = int(os.getenv("LNPROTOTEST_PORT_BASE", "20000"))
+PORT_RANGE = int(os.getenv("LNPROTOTEST_PORT_RANGE", "500"))
+
+
+def worker_index() -> int:
+    """Which pytest-xdist worker we are (0 if not under xdist)"""
+    worker = os.getenv("PYTEST_XDIST_WORKER", "gw0")
+    try:
+        return int(worker.lstrip("gw"))
+    except ValueError:
+        return 0
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _bindable(port: int) -> bool:
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
+        try:
+            s.bind(("127.0.0.1", port))
+        except OSError as ex:
+            if ex.errno == errno.EADDRINUSE:
+                return False
+            raise
+    return True
+
+
+class PortBroker(object):
+    """Hands out ports from this worker's range, recording leases in
+    directory/leases.json (under directory/leases.lock)"""
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        first: Optional[int] = None,
+        count: int = PORT_RANGE,
+    ):
+        if directory is None:
+            directory = os.getenv(
+                "LNPROTOTEST_PORT_DIR",
+                os.path.join(tempfile.gettempdir(), "lnprototest-ports"),
+            )
+        os.makedirs(directory, exist_ok=True)
+        self.leasefile = os.path.join(directory, "leases.json")
+        self.lockfile = os.path.join(directory, "leases.lock")
+        if first is None:
+            first = PORT_BASE + worker_index() * count
+        self.ports = range(first, first + count)
+
+    def _read(self) -> Dict[str, int]:
+        try:
+            with open(self.leasefile) as f:
+                leases = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return {port: pid for port, pid in leases.items() if _pid_alive(pid)}
+
+    def _write(self, leases: Dict[str, int]) -> None:
+        tmpname = self.leasefile + ".{}".format(os.getpid())
+        with open(tmpname, "w") as f:
+            json.dump(leases, f)
+        os.replace(tmpname, self.leasefile)
+
+    def lease(self) -> int:
+        """Lease a free port: it's ours until release()"""
+        with open(self.lockfile, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            leases = self._read()
+            for port in self.ports:
+                if str(port) in leases or not _bindable(port):
+                    continue
+                leases[str(port)] = os.getpid()
+                self._write(leases)
+                return port
+        raise RuntimeError(
+            "No free ports in {}-{}".format(self.ports[0], self.ports[-1])
+        )
+
+    def release(self, ports: List[int]) -> None:
+        with open(self.lockfile, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            leases = self._read()
+            for port in ports:
+                leases.pop(str(port), None)
+            self._write(leases)
+
+
+_broker: Optional[PortBroker] = None
+
+
+def port_broker() -> PortBroker:
+    global _broker
+    if _broker is None:
+        _broker = PortBroker()
+    return _broker
+
+
+class PortLeases(object):
+    """The ports one runner (and its backend) holds, released together"""
+
+    def __init__(self, broker: Optional[PortBroker] = None):
+        self.broker = broker if broker is not None else port_broker()
+        self.ports: List[int] = []
+
+    def lease(self) -> int:
+        port = self.broker.lease()
+        self.ports.append(port)
+        return port
+
+    def release(self) -> None:
+        if self.ports:
+            self.broker.release(self.ports)
+            self.ports = []
+
+
+def test_port_broker() -> None:
+    with tempfile.TemporaryDirectory() as d:
+        broker = PortBroker(d, first=PORT_BASE + 7 * PORT_RANGE, count=50)
+        a = PortLeases(broker)
+        b = PortLeases(broker)
+        p1, p2 = a.lease(), b.lease()
+        assert p1 != p2 and p1 in broker.ports and p2 in broker.ports
+
+        # Something else is listening on the next one.
+        with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
+            s.bind(("127.0.0.1", max(p1, p2) + 1))
+            s.listen()
+            p3 = a.lease()
+        assert p3 not in (p1, p2, max(p1, p2) + 1)
+
+        # Another process (same directory) sees our leases.
+        other = PortBroker(d, first=broker.ports[0], count=50)
+        assert other.lease() not in (p1, p2, p3)
+
+        a.release()
+        assert a.ports == []
+        assert other.lease() == p1
+
+        # Leases of dead processes don't count.
+        with open(broker.leasefile) as f:
+            leases = json.load(f)
+        leases = {port: 2**22 + 1 for port in leases}
+        broker._write(leases)
+        assert broker.lease() == broker.ports[0]
@@ -1,12 +1,10 @@
 #! /usr/bin/python3
+import os
 import pytest
 import importlib
 import lnprototest
-import pyln.spec.bolt1
-import pyln.spec.bolt2
-import pyln.spec.bolt7
 from pyln.proto.message import MessageNamespace
-from typing import Any, Callable, Generator, List
+from typing import Any, Callable, Generator, List, Optional
 
 
 def pytest_addoption(parser: Any) -> None:
@@ -24,12 +22,31 @@ def pytest_addoption(parser: Any) -> None:
     )
 
 
+@pytest.fixture(scope="session")
+def snapshots() -> Generator[Optional[lnprototest.SnapshotStore], None, None]:
+    """Lets tests start from a state (e.g. an open channel) another test
+    already got to.  LNPROTOTEST_SNAPSHOTS=0 turns this off."""
+    if os.getenv("LNPROTOTEST_SNAPSHOTS", "1") == "0":
+        yield None
+        return
+    store = lnprototest.SnapshotStore()
+    yield store
+    store.cleanup()
+
+
 @pytest.fixture()  # type: ignore
-def runner(pytestconfig: Any) -> Any:
+def runner(pytestconfig: Any, request: Any, snapshots: Any) -> Any:
     parts = pytestconfig.getoption("runner").rpartition(".")
-    runner = importlib.import_module(parts[0]).__dict__[parts[2]](pytestconfig)
+    runner = getattr(importlib.import_module(parts[0]), parts[2])(pytestconfig)
+    runner.snapshots = snapshots
     yield runner
     runner.teardown()
+    # One file of latency histograms per test, if asked.
+    latency_dir = os.getenv("LNPROTOTEST_LATENCY_DIR")
+    if latency_dir is not None:
+        runner.latency.export(
+            os.path.join(latency_dir, "{}.json".format(request.node.name))
+        )
 
 
 @pytest.fixture()
@@ -42,8 +59,8 @@ def namespaceoverride(
         lnprototest.assign_namespace(newns)
 
     yield _setter
-    # Restore it
-    lnprototest.assign_namespace(lnprototest.peer_message_namespace())
+    # Restore the (cached) default
+    lnprototest.assign_namespace(None)
 
 
 @pytest.fixture()
@@ -56,21 +73,16 @@ def with_proposal(
 
     def _setter(proposal_csv: List[str]) -> None:
         # Testing first line is cheap, pretty effective.
-        if proposal_csv[0] not in (
-            pyln.spec.bolt1.csv + pyln.spec.bolt2.csv + pyln.spec.bolt7.csv
-        ):
+        peer_csv = lnprototest.peer_message_csv()
+        if proposal_csv[0] not in peer_csv:
             # We merge *csv*, because then you can add tlv entries; merging
             # namespaces with duplicate TLVs complains of a clash.
+            # make_namespace() caches, so this is cheap after the first time.
             lnprototest.assign_namespace(
-                lnprototest.make_namespace(
-                    pyln.spec.bolt1.csv
-                    + pyln.spec.bolt2.csv
-                    + pyln.spec.bolt7.csv
-                    + proposal_csv
-                )
+                lnprototest.make_namespace(peer_csv + proposal_csv)
             )
 
     yield _setter
 
-    # Restore it
-    lnprototest.assign_namespace(lnprototest.peer_message_namespace())
+    # Restore the (cached) default
+    lnprototest.assign_namespace(None)
@@ -0,0 +1,37 @@
+#! /usr/bin/env python3
+# Pipelined pings on several connections: every one gets its pong.
+#
+import pytest
+import pyln.spec.bolt1
+
+from typing import Any
+
+from lnprototest import Connect, ExpectMsg, Msg, PingBench, Runner
+from lnprototest.utils import run_runner
+
+
+@pytest.mark.parametrize("num_pong_bytes", [0, 65531])
+def test_pings_pipelined(
+    runner: Runner, namespaceoverride: Any, num_pong_bytes: int
+) -> None:
+    # We override default namespace since we only need BOLT1
+    namespaceoverride(pyln.spec.bolt1.namespace)
+    test = []
+    for key in ("02", "03"):
+        test += [
+            Connect(connprivkey=key),
+            ExpectMsg("init"),
+            Msg(
+                "init",
+                globalfeatures=runner.runner_features(globals=True),
+                features=runner.runner_features(),
+            ),
+        ]
+    # BOLT #1:
+    # A node receiving a `ping` message:
+    #   - if `num_pong_bytes` is less than 65532:
+    #     - MUST respond by sending a `pong` message, with `byteslen` equal
+    #     to `num_pong_bytes`.
+    test.append(PingBench(["02", "03"], pings=20, num_pong_bytes=num_pong_bytes))
+    run_runner(runner, test)
+    assert runner.stash["PingBench"]["pongs"] == 40
@@ -35,10 +35,7 @@ from lnprototest import (
 )
 from lnprototest.utils import run_runner, merge_events_sequences, tx_spendable
 from lnprototest.stash import channel_id
-from lnprototest.utils.ln_spec_utils import (
-    open_and_announce_channel_helper,
-    connect_to_node_helper,
-)
+from lnprototest.utils.ln_spec_utils import open_channel_snapshot_helper
 from lnprototest.utils import BitcoinUtils, ScriptType
 from lnprototest.event import CloseChannel
 
@@ -56,16 +53,9 @@ def test_close_channel_shutdown_msg_normal_case_receiver_side(runner: Runner) ->
     """
     # the option that the helper method feels for us
     test_opts = {}
-    pre_events_conn = connect_to_node_helper(
-        runner=runner,
-        tx_spendable=tx_spendable,
-        conn_privkey="03",
-    )
-    pre_events = open_and_announce_channel_helper(
-        runner, conn_privkey="03", opts=test_opts
+    pre_events = open_channel_snapshot_helper(
+        runner, tx_spendable, conn_privkey="03", opts=test_opts
     )
-    # merge the two events
-    pre_events = merge_events_sequences(pre_events_conn, pre_events)
     channel_idx = channel_id()
 
     script = BitcoinUtils.build_valid_script()
@@ -107,16 +97,9 @@ def test_close_channel_shutdown_msg_normal_case_sender_side(runner: Runner) -> N
     """
     # the option that the helper method feels for us
     test_opts = {}
-    pre_events_conn = connect_to_node_helper(
-        runner=runner,
-        tx_spendable=tx_spendable,
-        conn_privkey="03",
+    pre_events = open_channel_snapshot_helper(
+        runner, tx_spendable, conn_privkey="03", opts=test_opts
     )
-    pre_events = open_and_announce_channel_helper(
-        runner, conn_privkey="03", opts=test_opts
-    )
-    # merge the two events
-    pre_events = merge_events_sequences(pre_events_conn, pre_events)
 
     short_channel_id = test_opts["short_channel_id"]
     test = [
@@ -144,16 +127,9 @@ def test_close_channel_shutdown_msg_wrong_script_pubkey_receiver_side(
     """
     # the option that the helper method feels for us
     test_opts = {}
-    pre_events_conn = connect_to_node_helper(
-        runner=runner,
-        tx_spendable=tx_spendable,
-        conn_privkey="03",
-    )
-    pre_events = open_and_announce_channel_helper(
-        runner, conn_privkey="03", opts=test_opts
+    pre_events = open_channel_snapshot_helper(
+        runner, tx_spendable, conn_privkey="03", opts=test_opts
     )
-    # merge the two events
-    pre_events = merge_events_sequences(pre_events_conn, pre_events)
 
     script = BitcoinUtils.build_valid_script(ScriptType.INVALID_CLOSE_SCRIPT)
 
@@ -0,0 +1,23 @@
+#! /usr/bin/env python3
+# Add and remove HTLCs, round after round: how many updates per second?
+import os
+
+import pytest
+
+from lnprototest import HtlcChurn, Runner
+from lnprototest.utils import run_runner, merge_events_sequences, tx_spendable
+from lnprototest.utils.ln_spec_utils import open_channel_snapshot_helper
+
+ROUNDS = int(os.getenv("LNPROTOTEST_CHURN_ROUNDS", "10"))
+
+
+# c-lightning accepts 30 HTLCs at once by default.
+@pytest.mark.parametrize("htlcs_per_round", [1, 10, 30])
+def test_htlc_churn(runner: Runner, htlcs_per_round: int) -> None:
+    pre_events = open_channel_snapshot_helper(runner, tx_spendable, conn_privkey="02")
+    churn = HtlcChurn(ROUNDS, htlcs_per_round)
+    run_runner(runner, merge_events_sequences(pre=pre_events, post=[churn]))
+
+    results = runner.stash["HtlcChurn"]
+    assert results["updates"] == 2 * ROUNDS * htlcs_per_round
+    assert runner.get_stash(churn, "Commit").htlcs == {}
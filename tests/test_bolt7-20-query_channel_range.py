@@ -17,15 +17,13 @@ from lnprototest import (
     Sequence,
     CheckEq,
     EventError,
-    namespace,
+    gossip_query,
 )
 from lnprototest.utils import BitcoinUtils, tx_spendable, utxo
 from typing import Optional
 import pytest
 import time
 import io
-import zlib
-import crc32c
 from pyln.spec.bolt7 import channel_update_timestamps
 from pyln.proto.message import Message
 
@@ -63,20 +61,15 @@ def decode_timestamps(runner: "Runner", event: Event, field: str) -> str:
     # Get timestamps from last reply_channel_range msg
     timestamps = runner.get_stash(event, "ExpectMsg")[-1][1]["tlvs"]["timestamps_tlv"]
 
-    # BOLT #7:
-    # Encoding types:
-    # * `0`: uncompressed array of `short_channel_id` types, in ascending
-    #   order.
-    # * `1`: array of `short_channel_id` types, in ascending order, compressed
-    #   with zlib deflate<sup>[1](#reference-1)</sup>
-    if timestamps["encoding_type"] == 0:
-        b = bytes.fromhex(timestamps["encoded_timestamps"])
-    elif timestamps["encoding_type"] == 1:
-        b = zlib.decompress(bytes.fromhex(timestamps["encoded_timestamps"]))
-    else:
-        raise EventError(event, "Unknown encoding type: {}".format(timestamps))
+    try:
+        pairs = gossip_query.decode_u32_pairs(
+            bytes.fromhex(timestamps["encoded_timestamps"]),
+            timestamps["encoding_type"],
+        )
+    except ValueError as ve:
+        raise EventError(event, "Bad timestamps {}: {}".format(timestamps, ve))
 
-    return b.hex()
+    return gossip_query.encode_u32_pairs(pairs).hex()
 
 
 def decode_scids(runner: "Runner", event: Event, field: str) -> str:
@@ -88,52 +81,20 @@ def decode_scids(runner: "Runner", event: Event, field: str) -> str:
     encoded = bytes.fromhex(
         runner.get_stash(event, "ExpectMsg")[-1][1]["encoded_short_ids"]
     )
-    # BOLT #7:
-    # Encoding types:
-    # * `0`: uncompressed array of `short_channel_id` types, in ascending
-    #   order.
-    # * `1`: array of `short_channel_id` types, in ascending order, compressed
-    #   with zlib deflate<sup>[1](#reference-1)</sup>
-    if encoded[0] == 0:
-        b = encoded[1:]
-    elif encoded[0] == 1:
-        b = zlib.decompress(encoded[1:])
-    else:
+    try:
+        scids = gossip_query.decode_scids(encoded)
+    except ValueError as ve:
         raise EventError(
-            event, "Unknown encoding type {}: {}".format(encoded[0], encoded.hex())
+            event, "Bad encoded_short_ids {}: {}".format(encoded.hex(), ve)
         )
 
-    scidtype = namespace().get_fundamentaltype("short_channel_id")
-    arr = []
-    buf = io.BytesIO(b)
-    while True:
-        scid = scidtype.read(buf, {})
-        if scid is None:
-            break
-        arr.append(scid)
-
-    return ",".join([scidtype.val_to_str(a, {}) for a in arr])
+    return ",".join([gossip_query.scid_to_str(s) for s in scids])
 
 
 def calc_checksum(update: Message) -> int:
-    # BOLT #7: The checksum of a `channel_update` is the CRC32C checksum as
-    # specified in [RFC3720](https://tools.ietf.org/html/rfc3720#appendix-B.4)
-    # of this `channel_update` without its `signature` and `timestamp` fields.
     bufio = io.BytesIO()
     update.write(bufio)
-    buf = bufio.getvalue()
-
-    # BOLT #7:
-    # 1. type: 258 (`channel_update`)
-    # 2. data:
-    #     * [`signature`:`signature`]
-    #     * [`chain_hash`:`chain_hash`]
-    #     * [`short_channel_id`:`short_channel_id`]
-    #     * [`u32`:`timestamp`]
-    #     * [`byte`:`message_flags`]
-
-    # Note: 2 bytes for `type` field
-    return crc32c.crc32c(buf[2 + 64 : 2 + 64 + 32 + 8] + buf[2 + 64 + 32 + 8 + 4 :])
+    return gossip_query.update_checksum(bufio.getvalue())
 
 
 def update_checksums(update1: Optional[Message], update2: Optional[Message]) -> str:
@@ -0,0 +1,71 @@
+#! /usr/bin/env python3
+# query_channel_range over a big graph: how fast does the node page through
+# it, and does it get every reply right?
+import os
+
+import pytest
+
+from lnprototest import (
+    Block,
+    Connect,
+    ExpectMsg,
+    GossipCorpus,
+    GossipFlood,
+    Msg,
+    QueryChannelRange,
+    Runner,
+    Sequence,
+)
+from lnprototest.utils import run_runner, tx_spendable
+
+# 100k channels by default; the corpus is cached after the first run.
+CHANNELS = int(os.getenv("LNPROTOTEST_STRESS_CHANNELS", "100000"))
+
+
+def test_query_channel_range_many(runner: Runner) -> None:
+    if runner.has_option("option_gossip_queries") is None:
+        pytest.skip("Needs option_gossip_queries")
+
+    corpus = GossipCorpus(CHANNELS)
+    scids = corpus.short_channel_ids()
+    gossip_queries_ex = runner.has_option("option_gossip_queries_ex") is not None
+
+    test = [
+        Block(blockheight=102, txs=[tx_spendable]),
+        *corpus.block_events(),
+        Connect(connprivkey="03"),
+        ExpectMsg("init"),
+        Msg(
+            "init",
+            globalfeatures=runner.runner_features(globals=True),
+            features=runner.runner_features(),
+        ),
+        GossipFlood(corpus),
+        # New peer connects, with gossip_query option.
+        Connect(connprivkey="05"),
+        ExpectMsg("init"),
+        Msg(
+            "init",
+            globalfeatures=runner.runner_features(globals=True),
+            features=runner.runner_features(additional_features=[7]),
+        ),
+        # Give it time to check all those funding outputs.
+        QueryChannelRange(0, 0xFFFFFFFF, expect_scids=scids, wait=600),
+        # Now it has them all, time a clean query.
+        QueryChannelRange(0, 0xFFFFFFFF, expect_scids=scids),
+        # Only part of the range.
+        QueryChannelRange(
+            104,
+            2,
+            expect_scids=[s for s in scids if s.split("x")[0] in ("104", "105")],
+        ),
+        Sequence(
+            enable=gossip_queries_ex,
+            events=[
+                QueryChannelRange(
+                    0, 0xFFFFFFFF, expect_scids=scids, query_option_flags=3
+                )
+            ],
+        ),
+    ]
+    run_runner(runner, test)
@@ -0,0 +1,35 @@
+#! /usr/bin/env python3
+# Feed the node a pile of valid gossip, as fast as it will take it.
+
+from lnprototest import (
+    Block,
+    Connect,
+    ExpectMsg,
+    GossipCorpus,
+    GossipFlood,
+    Msg,
+    Runner,
+)
+from lnprototest.utils import run_runner, tx_spendable
+
+
+def test_gossip_flood(runner: Runner) -> None:
+    corpus = GossipCorpus(200, nodes=20)
+    test = [
+        Block(blockheight=102, txs=[tx_spendable]),
+        *corpus.block_events(),
+        Connect(connprivkey="03"),
+        ExpectMsg("init"),
+        Msg(
+            "init",
+            globalfeatures=runner.runner_features(globals=True),
+            features=runner.runner_features(),
+        ),
+        GossipFlood(corpus),
+        # It reads in order, so once it answers this it has read them all
+        # (and didn't hang up on us over any of them).
+        Msg("ping", num_pong_bytes=1, ignored="00"),
+        ExpectMsg("pong", ignored="00", ignore=ExpectMsg.ignore_all_gossip),
+    ]
+    run_runner(runner, test)
+    assert runner.stash["GossipFlood"]["messages"] == 3 * 200 + 20
@@ -0,0 +1,46 @@
+#! /usr/bin/env python3
+# The node syncs a big graph from us: how long until it has it all?
+import os
+
+import pytest
+
+from lnprototest import (
+    Block,
+    Connect,
+    ExpectGossipSync,
+    ExpectMsg,
+    GossipCorpus,
+    GossipStore,
+    Msg,
+    Runner,
+    ServeGossip,
+)
+from lnprototest.utils import run_runner, tx_spendable
+
+# 100k channels by default; the corpus is cached after the first run.
+CHANNELS = int(os.getenv("LNPROTOTEST_STRESS_CHANNELS", "100000"))
+
+
+def test_gossip_sync(runner: Runner) -> None:
+    if runner.has_option("option_gossip_queries") is None:
+        pytest.skip("Needs option_gossip_queries")
+
+    corpus = GossipCorpus(CHANNELS)
+    store = GossipStore.from_corpus(corpus)
+
+    test = [
+        Block(blockheight=102, txs=[tx_spendable]),
+        *corpus.block_events(),
+        Connect(connprivkey="03"),
+        # Answer its queries from the moment it says hello.
+        ServeGossip(store),
+        ExpectMsg("init"),
+        Msg(
+            "init",
+            globalfeatures=runner.runner_features(globals=True),
+            features=runner.runner_features(additional_features=[7]),
+        ),
+        ExpectGossipSync(timeout=600),
+    ]
+    run_runner(runner, test)
+    assert runner.stash["GossipSync"]["served"] == CHANNELS
@@ -0,0 +1,101 @@
+#! /usr/bin/python3
+"""Measure (and guard) how long `import lnprototest` takes.
+
+Every pytest-xdist worker and every tool pays this, so the package only
+loads its heavier submodules on first use.  We time fresh interpreters,
+since a warm sys.modules tells us nothing.
+"""
+
+import statistics
+import subprocess
+import sys
+from argparse import ArgumentParser
+from typing import List
+
+# Nothing here should be loaded by a bare `import lnprototest`.
+LAZY_MODULES = [
+    "bitcoin",
+    "coincurve",
+    "pyln.proto.message",
+    "lnprototest.event",
+    "lnprototest.commit_tx",
+    "lnprototest.funding",
+]
+
+
+def import_time(statement: str) -> float:
+    """Seconds taken by statement, in a fresh interpreter"""
+    out = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import time; t = time.perf_counter(); {}; "
+            "print(time.perf_counter() - t)".format(statement),
+        ],
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout
+    return float(out)
+
+
+def loaded_modules(statement: str) -> List[str]:
+    """Which of LAZY_MODULES are in sys.modules after statement"""
+    out = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys; {}; print(' '.join(m for m in {!r} if m in sys.modules))".format(
+                statement, LAZY_MODULES
+            ),
+        ],
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout
+    return out.decode().split()
+
+
+def test_import_is_lazy() -> None:
+    assert loaded_modules("import lnprototest") == []
+    # Names still resolve, and only pull in what they need.
+    assert "lnprototest.funding" not in loaded_modules(
+        "from lnprototest import Runner, Event, Msg"
+    )
+    assert "lnprototest.funding" in loaded_modules(
+        "from lnprototest import CreateFunding"
+    )
+
+
+def main() -> None:
+    parser = ArgumentParser(description="Benchmark `import lnprototest`")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument(
+        "--max-ms", type=float, help="Fail if the median import exceeds this"
+    )
+    args = parser.parse_args()
+
+    medians = {}
+    for statement in (
+        "import lnprototest",
+        "from lnprototest import Runner, Event",
+        "from lnprototest import *",
+    ):
+        times = [import_time(statement) * 1000 for _ in range(args.runs)]
+        medians[statement] = statistics.median(times)
+        print(
+            "{}: median {:.1f}ms, min {:.1f}ms".format(
+                statement, medians[statement], min(times)
+            )
+        )
+
+    eager = loaded_modules("import lnprototest")
+    if eager:
+        print("import lnprototest loaded: {}".format(" ".join(eager)))
+        sys.exit(1)
+    median = medians["import lnprototest"]
+    if args.max_ms is not None and median > args.max_ms:
+        print("import lnprototest took {:.1f}ms > {}ms".format(median, args.max_ms))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#! /usr/bin/python3
+"""Ping/pong throughput against a runner.
+
+Opens --conns connections, does the init exchange on each, then runs a
+PingBench: --pings pings per conn, --depth in flight at once.  With the
+default DummyRunner this measures lnprototest's own ceiling (encoding,
+checking and timing messages); with lnprototest.clightning.Runner it
+measures the node.
+"""
+
+import importlib
+import json
+from argparse import ArgumentParser
+from typing import Any, Dict, List
+
+from lnprototest import Connect, ExpectMsg, Msg, PingBench, Runner
+from lnprototest.event import Event
+
+
+class Config(object):
+    """Enough of pytest's config for a runner"""
+
+    def __init__(self, runner_args: List[str], verbose: bool):
+        self.options = {"runner_args": runner_args, "verbose": verbose}
+
+    def getoption(self, name: str) -> Any:
+        return self.options[name]
+
+
+def make_runner(name: str, runner_args: List[str], verbose: bool = False) -> Runner:
+    parts = name.rpartition(".")
+    return getattr(importlib.import_module(parts[0]), parts[2])(
+        Config(runner_args, verbose)
+    )
+
+
+def bench(
+    runner: Runner,
+    conns: int,
+    pings: int,
+    num_pong_bytes: int,
+    byteslen: int,
+    depth: int,
+) -> Dict[str, Any]:
+    keys = ["{:02x}".format(i + 2) for i in range(conns)]
+    events: List[Event] = []
+    for key in keys:
+        events += [
+            Connect(connprivkey=key),
+            ExpectMsg("init"),
+            Msg(
+                "init",
+                globalfeatures=runner.runner_features(globals=True),
+                features=runner.runner_features(),
+            ),
+        ]
+    events.append(PingBench(keys, pings, num_pong_bytes, byteslen, depth))
+    try:
+        runner.run(events)
+    finally:
+        runner.teardown()
+    return runner.stash["PingBench"]
+
+
+def test_bench_pings() -> None:
+    results = bench(make_runner("lnprototest.DummyRunner", []), 3, 10, 100, 0, 4)
+    assert results["pongs"] == 30 and results["msgs_per_sec"] > 0
+
+
+def main() -> None:
+    parser = ArgumentParser(description="Benchmark ping/pong against a runner")
+    parser.add_argument("--runner", default="lnprototest.DummyRunner")
+    parser.add_argument("--runner-args", action="append", default=[])
+    parser.add_argument("--conns", type=int, default=4)
+    parser.add_argument("--pings", type=int, default=1000, help="per conn")
+    parser.add_argument("--num-pong-bytes", type=int, default=0)
+    parser.add_argument("--byteslen", type=int, default=0)
+    parser.add_argument("--depth", type=int, default=8)
+    parser.add_argument("--json", action="store_true", help="print all results")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    results = bench(
+        make_runner(args.runner, args.runner_args, args.verbose),
+        args.conns,
+        args.pings,
+        args.num_pong_bytes,
+        args.byteslen,
+        args.depth,
+    )
+    if args.json:
+        print(json.dumps(results, indent=1))
+        return
+    lat = results["latency"]
+    print(
+        "{} conns, {} pongs in {:.3f}s: {:.0f} msgs/sec, {:.0f} bytes/sec".format(
+            results["conns"],
+            results["pongs"],
+            results["seconds"],
+            results["msgs_per_sec"],
+            results["bytes_per_sec"],
+        )
+    )
+    print(
+        "latency us: p50 {} p90 {} p99 {} p99.9 {} max {}".format(
+            lat["p50"], lat["p90"], lat["p99"], lat["p99.9"], lat["max"]
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
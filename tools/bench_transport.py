@@ -0,0 +1,128 @@
+#! /usr/bin/python3
+"""Compare TCP and unix socket transports for peer connections.
+
+We run a BOLT 8 responder (with the node key clightning.Runner forces on
+lightningd) in a thread, connect to it with CLightningConn exactly as the
+runner does, and time the handshake and ping/pong round trips over each.
+"""
+
+import os
+import socket
+import statistics
+import struct
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from typing import Dict, List, Union
+
+import pyln.proto.wire
+
+from lnprototest.clightning.clightning import CLightningConn
+
+NODE_PRIVKEY = bytes(31) + b"\x01"
+PING = struct.pack(">HHH", 18, 1, 0)
+
+
+def _serve(listener: socket.socket) -> None:
+    """Answer every ping with a pong, until the listener is closed"""
+    while True:
+        try:
+            sock, _ = listener.accept()
+        except OSError:
+            return
+        if sock.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = pyln.proto.wire.LightningConnection(
+            sock, None, pyln.proto.wire.PrivateKey(NODE_PRIVKEY), is_initiator=False
+        )
+        try:
+            conn.shake()
+            while True:
+                msg = conn.read_message()
+                num_pong_bytes = struct.unpack(">H", msg[2:4])[0]
+                conn.send_message(
+                    struct.pack(">HH", 19, num_pong_bytes) + bytes(num_pong_bytes)
+                )
+        except Exception:
+            sock.close()
+
+
+def bench(addr: Union[int, str], conns: int, roundtrips: int) -> Dict[str, float]:
+    """Median and p99 microseconds for handshakes and round trips"""
+    handshakes: List[float] = []
+    rtts: List[float] = []
+    for i in range(conns):
+        start = time.perf_counter()
+        conn = CLightningConn("{:064x}".format(i + 2), addr)
+        handshakes.append(time.perf_counter() - start)
+        for _ in range(roundtrips):
+            start = time.perf_counter()
+            conn.connection.send_message(PING)
+            conn.connection.read_message()
+            rtts.append(time.perf_counter() - start)
+        conn.close()
+
+    def pct(vals: List[float], p: float) -> float:
+        vals = sorted(vals)
+        return vals[min(len(vals) - 1, int(len(vals) * p))] * 1e6
+
+    return {
+        "handshake_median_us": statistics.median(handshakes) * 1e6,
+        "handshake_p99_us": pct(handshakes, 0.99),
+        "rtt_median_us": statistics.median(rtts) * 1e6,
+        "rtt_p99_us": pct(rtts, 0.99),
+    }
+
+
+def run(conns: int, roundtrips: int) -> Dict[str, Dict[str, float]]:
+    results = {}
+    with tempfile.TemporaryDirectory() as d:
+        tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tcp.bind(("127.0.0.1", 0))
+        unix = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        unix.bind(os.path.join(d, "peer-socket"))
+        for name, listener, addr in (
+            ("tcp", tcp, tcp.getsockname()[1]),
+            ("unix", unix, unix.getsockname()),
+        ):
+            listener.listen()
+            server = threading.Thread(target=_serve, args=(listener,), daemon=True)
+            server.start()
+            try:
+                results[name] = bench(addr, conns, roundtrips)
+            finally:
+                listener.shutdown(socket.SHUT_RDWR)
+                listener.close()
+                server.join(5)
+    return results
+
+
+def test_transports() -> None:
+    results = run(2, 5)
+    assert set(results) == {"tcp", "unix"}
+    for r in results.values():
+        assert r["handshake_median_us"] > 0 and r["rtt_median_us"] > 0
+
+
+def main() -> None:
+    parser = ArgumentParser(description="Benchmark peer connection transports")
+    parser.add_argument("--conns", type=int, default=50)
+    parser.add_argument("--roundtrips", type=int, default=200)
+    args = parser.parse_args()
+
+    for name, r in run(args.conns, args.roundtrips).items():
+        print(
+            "{}: handshake median {:.0f}us p99 {:.0f}us, "
+            "ping/pong median {:.0f}us p99 {:.0f}us".format(
+                name,
+                r["handshake_median_us"],
+                r["handshake_p99_us"],
+                r["rtt_median_us"],
+                r["rtt_p99_us"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()